@@ -0,0 +1,272 @@
+"""
+Approximate nearest-neighbour indexes for large galleries.
+
+Every index implements the same small interface (build / add / search / save)
+over L2-normalized float32 embeddings, so the gallery can swap an exact
+brute-force scan for an inverted-file (IVF) index once it grows to hundreds
+of thousands of identities. Scores returned by an index are only used to
+shortlist candidates; the gallery re-ranks that shortlist exactly.
+"""
+import os
+
+import numpy as np
+
+
+def _normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def default_nlist(ntotal):
+    """Inverted lists for a gallery of ntotal vectors when none is configured (~sqrt(N))"""
+    return max(1, int(round(np.sqrt(ntotal))))
+
+
+def top_k(scores, k):
+    """Indices of the k highest scores, sorted high to low"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+class SearchIndex:
+    """Common interface for gallery indexes. Row ids are gallery row positions."""
+
+    kind = None
+
+    def __init__(self):
+        self.fingerprint = ''
+
+    @property
+    def ntotal(self):
+        raise NotImplementedError
+
+    def build(self, vectors):
+        """(Re)build the index from an (N x D) matrix; row i gets id i"""
+        raise NotImplementedError
+
+    def add(self, vectors):
+        """Append vectors; ids continue from ntotal"""
+        raise NotImplementedError
+
+    def update(self, ids, vectors):
+        """Replace the vectors stored under existing ids"""
+        raise NotImplementedError
+
+    def search(self, query, k):
+        """Return (ids, scores) of up to k approximate nearest rows, best first"""
+        raise NotImplementedError
+
+    def nbytes(self):
+        """Bytes held by the index arrays"""
+        raise NotImplementedError
+
+    def _state(self):
+        raise NotImplementedError
+
+    def save(self, path):
+        """Persist the index to a .npz file, replacing it atomically (no truncated file on a crash)"""
+        partial = f"{path}.partial"
+        with open(partial, 'wb') as f:
+            np.savez(f, kind=self.kind, fingerprint=self.fingerprint, **self._state())
+        os.replace(partial, path)
+
+
+class FlatIndex(SearchIndex):
+    """Exact brute-force index; the reference point for recall measurements"""
+
+    kind = 'flat'
+
+    def __init__(self, dim=512):
+        super().__init__()
+        self.dim = dim
+        self._vectors = np.empty((0, dim), dtype=np.float32)
+
+    @property
+    def ntotal(self):
+        return len(self._vectors)
+
+    def build(self, vectors):
+        self._vectors = _normalize_rows(vectors)
+
+    def add(self, vectors):
+        self._vectors = np.concatenate([self._vectors, _normalize_rows(vectors)])
+
+    def update(self, ids, vectors):
+        self._vectors[np.asarray(ids, dtype=np.int64)] = _normalize_rows(vectors)
+
+    def search(self, query, k):
+        scores = self._vectors @ _normalize_rows(query)[0]
+        top = top_k(scores, k)
+        return top, scores[top]
+
+    def nbytes(self):
+        return self._vectors.nbytes
+
+    def _state(self):
+        return {'vectors': self._vectors}
+
+    @classmethod
+    def _from_state(cls, state):
+        index = cls(dim=state['vectors'].shape[1])
+        index._vectors = state['vectors'].astype(np.float32)
+        return index
+
+
+class IVFIndex(SearchIndex):
+    """
+    Inverted-file index with a spherical k-means coarse quantizer.
+
+    Each vector is stored in the list of its nearest centroid; a query only
+    scans the `nprobe` lists whose centroids are closest to it. Raising
+    `nprobe` trades latency for recall (nprobe == nlist is an exact search).
+
+    The lists are copy-on-write: add() and update() build new (ids, vectors)
+    pairs and publish them with one assignment, so a search running
+    concurrently reads either the old or the new lists, never ids of one
+    and vectors of the other.
+    """
+
+    kind = 'ivf'
+
+    def __init__(self, dim=512, nlist=256, nprobe=16, kmeans_iters=20, seed=42):
+        super().__init__()
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.kmeans_iters = kmeans_iters
+        self.seed = seed
+        self.centroids = None
+        self._lists = []  # Per list: (ids, vectors)
+        self._ntotal = 0
+
+    @property
+    def ntotal(self):
+        return self._ntotal
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def _assign(self, vectors, block_size=8192):
+        """Nearest centroid for every row, computed in memory-bounded blocks"""
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), block_size):
+            block = vectors[start:start + block_size]
+            assignments[start:start + block_size] = np.argmax(block @ self.centroids.T, axis=1)
+        return assignments
+
+    def train(self, vectors, max_points_per_centroid=256):
+        """Fit the coarse quantizer with spherical k-means on (a sample of) the data"""
+        vectors = _normalize_rows(vectors)
+        if len(vectors) < self.nlist:
+            raise ValueError(f"IVF needs at least nlist={self.nlist} vectors to train, got {len(vectors)}")
+
+        rng = np.random.default_rng(self.seed)
+        sample_size = min(len(vectors), self.nlist * max_points_per_centroid)
+        sample = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+        self.centroids = sample[rng.choice(sample_size, self.nlist, replace=False)].copy()
+
+        for _ in range(self.kmeans_iters):
+            assignments = self._assign(sample)
+            counts = np.bincount(assignments, minlength=self.nlist)
+            order = np.argsort(assignments, kind='stable')
+            nonempty = np.flatnonzero(counts)
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty]
+            sums = np.add.reduceat(sample[order], starts, axis=0)
+            self.centroids[nonempty] = _normalize_rows(sums)
+
+            # Re-seed empty clusters with random points so every list gets used
+            empty = np.flatnonzero(counts == 0)
+            if len(empty):
+                self.centroids[empty] = sample[rng.choice(sample_size, len(empty), replace=False)]
+
+    def build(self, vectors):
+        vectors = _normalize_rows(vectors)
+        self.train(vectors)
+        self._lists = [(np.empty(0, dtype=np.int64), np.empty((0, self.dim), dtype=np.float32))
+                       for _ in range(self.nlist)]
+        self._ntotal = 0
+        self.add(vectors)
+
+    def _filed(self, lists, ids, vectors):
+        """Copy of `lists` with ids/vectors appended to the lists of their nearest centroids"""
+        lists = list(lists)
+        assignments = self._assign(vectors)
+        for list_no in np.unique(assignments):
+            members = assignments == list_no
+            list_ids, list_vectors = lists[list_no]
+            lists[list_no] = (np.concatenate([list_ids, ids[members]]),
+                              np.concatenate([list_vectors, vectors[members]]))
+        return lists
+
+    def add(self, vectors):
+        if not self.is_trained:
+            raise RuntimeError("IVF index must be built before vectors are added")
+        vectors = _normalize_rows(vectors)
+        ids = np.arange(self._ntotal, self._ntotal + len(vectors), dtype=np.int64)
+        self._lists = self._filed(self._lists, ids, vectors)
+        self._ntotal += len(vectors)
+
+    def update(self, ids, vectors):
+        # Take the ids out of their lists, then file the new vectors under their nearest centroids
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        vectors = _normalize_rows(vectors)
+        lists = []
+        for list_ids, list_vectors in self._lists:
+            keep = ~np.isin(list_ids, ids)
+            lists.append((list_ids, list_vectors) if keep.all() else (list_ids[keep], list_vectors[keep]))
+        self._lists = self._filed(lists, ids, vectors)
+
+    def search(self, query, k):
+        query = _normalize_rows(query)[0]
+        nprobe = max(1, min(self.nprobe, self.nlist))
+        probed = top_k(self.centroids @ query, nprobe)
+
+        lists = self._lists  # One consistent version, whatever add()/update() publish meanwhile
+        ids = np.concatenate([lists[list_no][0] for list_no in probed])
+        scores = np.concatenate([lists[list_no][1] @ query for list_no in probed])
+        top = top_k(scores, k)
+        return ids[top], scores[top]
+
+    def nbytes(self):
+        centroids = self.centroids.nbytes if self.centroids is not None else 0
+        return centroids + sum(ids.nbytes + vectors.nbytes for ids, vectors in self._lists)
+
+    def _state(self):
+        lists = self._lists
+        return {
+            'params': np.array([self.dim, self.nlist, self.nprobe, self.kmeans_iters, self.seed]),
+            'centroids': self.centroids,
+            'list_sizes': np.array([len(ids) for ids, _ in lists], dtype=np.int64),
+            'ids': np.concatenate([ids for ids, _ in lists]),
+            'vectors': np.concatenate([vectors for _, vectors in lists]),
+        }
+
+    @classmethod
+    def _from_state(cls, state):
+        dim, nlist, nprobe, kmeans_iters, seed = (int(v) for v in state['params'])
+        index = cls(dim=dim, nlist=nlist, nprobe=nprobe, kmeans_iters=kmeans_iters, seed=seed)
+        index.centroids = state['centroids'].astype(np.float32)
+        bounds = np.concatenate([[0], np.cumsum(state['list_sizes'])])
+        index._lists = [(state['ids'][a:b], state['vectors'][a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+        index._ntotal = int(bounds[-1])
+        return index
+
+
+INDEX_TYPES = {cls.kind: cls for cls in (FlatIndex, IVFIndex)}
+
+
+def load_index(path):
+    """Load an index previously written with SearchIndex.save()"""
+    with np.load(path, allow_pickle=False) as state:
+        state = dict(state)
+    index = INDEX_TYPES[str(state['kind'])]._from_state(state)
+    index.fingerprint = str(state['fingerprint'])
+    return index
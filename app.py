@@ -2,86 +2,704 @@ from flask import Flask, render_template, request, jsonify, Response
 from flask_cors import CORS
 import cv2
 import numpy as np
-import base64
 from pymongo import MongoClient
-from datetime import datetime
+from pymongo.errors import DuplicateKeyError
+import atexit
 import json
-import io
-from PIL import Image
+import os
+import signal
+import sys
+import threading
+import zipfile
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib
 matplotlib.use('Agg')  # Set backend before importing pyplot
-from insightface.app import FaceAnalysis
+from gallery import EmbeddingGallery
+from sharded_gallery import ShardedGallery, parse_address
+from shared_gallery import SharedGallery
+from embedding_codec import (encode_embedding, decode_embedding, decode_templates, EMBEDDING_FIELDS,
+                             TEMPLATE_FIELDS)
+from ann_index import IVFIndex, default_nlist, load_index
+from face_models import load_face_analysis, load_recognition_model, warm_up, DEFAULT_CACHE_DIR
+from face_selection import rank_faces, FACE_SELECTION_POLICIES
+import face_templates
+from face_templates import template_quality, centroid, place_template
+from inference_pool import InferencePool, PoolSaturatedError, InferenceTimeoutError
+from micro_batcher import MicroBatcher
+from live_stream import LiveStreamHub
+from bulk_enroll import ensure_username_index, existing_usernames, insert_users
+from image_io import (read_image_request, read_batch_request, decode_image_bytes, decode_reduced, default_max_size,
+                      crop_box, encode_jpeg_data_url, limit_size)
+from preview_cache import CropCache
+from metrics import metrics
+from tracing import begin_trace, end_trace, current_trace, get_logger, log_event
+from verify_debug import ScoreDumper
+from verify_cache import FrameCache, DecisionCache
+from insightface.utils import face_align
 
 app = Flask(__name__)
 CORS(app)
 
-# MongoDB connection
-client = MongoClient('mongodb://localhost:27017/')
-db = client['face_auth_db']
+# Structured JSON request logs, one line per request with its trace id and stage timings
+logger = get_logger()
+
+@app.before_request
+def start_request_trace():
+    begin_trace(request.headers.get('X-Request-ID'))
+
+@app.after_request
+def finish_request_trace(response):
+    trace = end_trace()
+    if trace is None:
+        return response
+    endpoint = request.endpoint or 'unknown'
+    elapsed = trace.elapsed()
+    metrics.observe('http_request_seconds', elapsed, 'HTTP request latency', endpoint=endpoint)
+    metrics.inc('http_requests', help_text='HTTP requests served', endpoint=endpoint, status=str(response.status_code))
+    response.headers['X-Request-ID'] = trace.trace_id
+    if endpoint not in ('prometheus_metrics', 'healthz', 'readyz', 'static'):
+        log_event(logger, 'request', trace_id=trace.trace_id, method=request.method, path=request.path,
+                  status=response.status_code, duration_ms=round(elapsed * 1000, 2), stages=trace.stage_ms())
+    return response
+
+# MongoDB connection. MONGO_BACKEND=mongomock keeps the users in process
+# memory instead (no server needed, nothing persisted), e.g. for load_test.py
+MONGO_URI = os.environ.get('MONGO_URI', 'mongodb://localhost:27017/')
+MONGO_DB = os.environ.get('MONGO_DB', 'face_auth_db')
+MONGO_BACKEND = os.environ.get('MONGO_BACKEND', 'mongodb')
+if MONGO_BACKEND == 'mongomock':
+    import mongomock
+    client = mongomock.MongoClient()
+    print("Using in-memory mongomock database (MONGO_BACKEND=mongomock)")
+else:
+    client = MongoClient(MONGO_URI)
+db = client[MONGO_DB]
 users_collection = db['users']
+# Registrations rely on duplicate key errors to reject usernames taken concurrently
+ensure_username_index(users_collection)
+
+# Embeddings are stored as float32 (or float16) BSON Binary, see embedding_codec.py
+EMBEDDING_STORAGE_DTYPE = os.environ.get('EMBEDDING_STORAGE_DTYPE', 'float32')
+
+# Gallery search configuration: 'flat' scans every embedding exactly,
+# 'ivf' shortlists candidates with an approximate index and re-ranks them.
+# IVF is opt-in because it trades recall for speed: a genuine user whose
+# embedding sits in a list that is not probed is missed (see
+# benchmark_identification.py --index ivf). IVF_NLIST=0 uses ~sqrt(users)
+# lists; the index is only used when it probes fewer lists than it has.
+GALLERY_INDEX = os.environ.get('GALLERY_INDEX', 'flat')
+ANN_INDEX_PATH = os.environ.get('ANN_INDEX_PATH', 'gallery_index.npz')
+IVF_NLIST = int(os.environ.get('IVF_NLIST', 0))
+IVF_NPROBE = int(os.environ.get('IVF_NPROBE', 32))
+ANN_RERANK_K = int(os.environ.get('ANN_RERANK_K', 50))
+
+# In-memory embedding matrix, loaded once and kept in sync on registration
+# Multi-template users: up to MAX_TEMPLATES templates each (added through
+# /api/add_template); the gallery searches their centroids and re-scores the
+# best TEMPLATE_RERANK_K candidates against the individual templates
+MAX_TEMPLATES = int(os.environ.get('MAX_TEMPLATES', 5))
+TEMPLATE_RERANK_K = int(os.environ.get('TEMPLATE_RERANK_K', 10))
+
+# Sharded gallery (sharded_gallery.py): users are partitioned by username
+# hash and every search is scattered to all shards. GALLERY_SHARDS=4 starts 4
+# local shard processes; a list of host:port addresses uses shard nodes
+# started with `python sharded_gallery.py serve` and GALLERY_SHARD_AUTHKEY
+# (hex). Empty keeps the whole gallery in this process.
+GALLERY_SHARDS = os.environ.get('GALLERY_SHARDS', '').strip()
+GALLERY_SHARD_AUTHKEY = os.environ.get('GALLERY_SHARD_AUTHKEY', '')
+SHARD_TIMEOUT = float(os.environ.get('SHARD_TIMEOUT', 5))
+SHARD_STARTUP_TIMEOUT = float(os.environ.get('SHARD_STARTUP_TIMEOUT', 60))
+
+# Shared gallery (shared_gallery.py): with several worker processes per node,
+# SHARED_GALLERY_DIR (e.g. /dev/shm/face_auth_gallery) holds one memory-mapped
+# copy of the embeddings that every worker maps read-only; a registration in
+# any worker is published to the others without re-reading MongoDB.
+SHARED_GALLERY_DIR = os.environ.get('SHARED_GALLERY_DIR', '')
+
+def build_gallery():
+    if GALLERY_SHARDS and SHARED_GALLERY_DIR:
+        raise ValueError("GALLERY_SHARDS and SHARED_GALLERY_DIR cannot be combined")
+    if SHARED_GALLERY_DIR:
+        return SharedGallery(SHARED_GALLERY_DIR, template_rerank_k=TEMPLATE_RERANK_K)
+    if not GALLERY_SHARDS:
+        return EmbeddingGallery(template_rerank_k=TEMPLATE_RERANK_K)
+    authkey = bytes.fromhex(GALLERY_SHARD_AUTHKEY) if GALLERY_SHARD_AUTHKEY else None
+    if GALLERY_SHARDS.isdigit():
+        return ShardedGallery.spawn(int(GALLERY_SHARDS), authkey, SHARD_TIMEOUT, TEMPLATE_RERANK_K,
+                                    SHARD_STARTUP_TIMEOUT)
+    if authkey is None:
+        raise ValueError("GALLERY_SHARD_AUTHKEY is required to connect to shard nodes")
+    addresses = [parse_address(address) for address in GALLERY_SHARDS.split(',')]
+    return ShardedGallery(addresses, authkey, SHARD_TIMEOUT)
+
+gallery = build_gallery()
+print(f"Loaded {gallery.load_from_collection(users_collection)} registered users into gallery")
+
+def setup_gallery_index():
+    """
+    Attach the ANN index when GALLERY_INDEX=ivf, reusing the copy on disk if
+    it still matches the gallery and rebuilding (and saving) it otherwise
+    """
+    if GALLERY_INDEX != 'ivf':
+        return
+    if GALLERY_SHARDS or SHARED_GALLERY_DIR:
+        print("Sharded/shared gallery: exact search only, GALLERY_INDEX=ivf ignored")
+        return
+    
+    if os.path.exists(ANN_INDEX_PATH):
+        try:
+            index = load_index(ANN_INDEX_PATH)
+            index.nprobe = IVF_NPROBE
+            gallery.attach_index(index, prebuilt=True)
+            print(f"Loaded IVF index from {ANN_INDEX_PATH} (nlist={index.nlist}, nprobe={index.nprobe})")
+            return
+        except ValueError as e:
+            print(f"Rebuilding stale IVF index: {e}")
+        except (OSError, EOFError, KeyError, zipfile.BadZipFile) as e:
+            print(f"Rebuilding unreadable IVF index {ANN_INDEX_PATH}: {e!r}")
+    
+    nlist = IVF_NLIST or default_nlist(len(gallery))
+    if len(gallery) < nlist or nlist <= IVF_NPROBE:
+        print(f"{len(gallery)} users (nlist={nlist}, nprobe={IVF_NPROBE}), using exact gallery search")
+        return
+    
+    index = IVFIndex(nlist=nlist, nprobe=IVF_NPROBE)
+    gallery.attach_index(index)
+    index.save(ANN_INDEX_PATH)
+    print(f"Built IVF index over {index.ntotal} users and saved it to {ANN_INDEX_PATH}")
+
+def save_gallery_index():
+    """
+    Persist the IVF index with the registrations made since it was loaded
+    or built, so the next start can reuse it instead of rebuilding
+    """
+    if gallery.index is None:
+        return
+    try:
+        if gallery.save_index(ANN_INDEX_PATH):
+            print(f"Saved IVF index over {gallery.index.ntotal} users to {ANN_INDEX_PATH}")
+    except OSError as e:
+        print(f"Could not save IVF index to {ANN_INDEX_PATH}: {e}")
+
+setup_gallery_index()
+
+# Verification results: only the top VERIFY_TOP_K candidates are computed
+# (argpartition) and returned, so the response size does not grow with the
+# gallery; 0 returns no candidate names at all. Full score tables of failed
+# attempts are written by a background thread for a VERIFY_DEBUG_SAMPLE_RATE
+# fraction of them to VERIFY_DEBUG_LOG.
+VERIFY_TOP_K = int(os.environ.get('VERIFY_TOP_K', 5))
+VERIFY_DEBUG_SAMPLE_RATE = float(os.environ.get('VERIFY_DEBUG_SAMPLE_RATE', 0))
+VERIFY_DEBUG_LOG = os.environ.get('VERIFY_DEBUG_LOG', 'verify_debug.log')
+VERIFY_DEBUG_MAX_ROWS = int(os.environ.get('VERIFY_DEBUG_MAX_ROWS', 0))
+score_dumper = ScoreDumper(gallery.score_all, path=VERIFY_DEBUG_LOG,
+                           sample_rate=VERIFY_DEBUG_SAMPLE_RATE, max_rows=VERIFY_DEBUG_MAX_ROWS)
+
+# Verification cache (verify_cache.py, off by default): for VERIFY_CACHE_TTL
+# seconds, a /api/detect_face frame whose perceptual hash is within
+# VERIFY_CACHE_HASH_DISTANCE bits of a recent one reuses its detected face
+# (previews only: verification always detects and embeds its own frame), and
+# a probe close enough to a recent one reuses its gallery decision when the
+# search is exact and that decision cannot differ. Decisions are dropped
+# whenever the gallery changes.
+VERIFY_CACHE = os.environ.get('VERIFY_CACHE', '0') == '1'
+VERIFY_CACHE_TTL = float(os.environ.get('VERIFY_CACHE_TTL', 10))
+VERIFY_CACHE_SIZE = int(os.environ.get('VERIFY_CACHE_SIZE', 256))
+VERIFY_CACHE_HASH_DISTANCE = int(os.environ.get('VERIFY_CACHE_HASH_DISTANCE', 4))
+frame_cache = FrameCache(VERIFY_CACHE_TTL, VERIFY_CACHE_SIZE, VERIFY_CACHE_HASH_DISTANCE) if VERIFY_CACHE else None
+decision_cache = DecisionCache(VERIFY_CACHE_TTL, VERIFY_CACHE_SIZE) if VERIFY_CACHE else None
+
+# Inference pool: each worker owns its own ArcFace model (using your working.py logic)
+# with a capped ONNX Runtime thread count, so workers x threads ~= CPU cores
+INFERENCE_THREADS_PER_WORKER = int(os.environ.get('INFERENCE_THREADS_PER_WORKER', 2))
+INFERENCE_WORKERS = int(os.environ.get('INFERENCE_WORKERS', max(1, (os.cpu_count() or 2) // INFERENCE_THREADS_PER_WORKER)))
+INFERENCE_QUEUE_SIZE = int(os.environ.get('INFERENCE_QUEUE_SIZE', 4 * INFERENCE_WORKERS))
+INFERENCE_TIMEOUT = float(os.environ.get('INFERENCE_TIMEOUT', 10))
+
+# Micro-batching: pool workers only detect faces, and aligned crops from
+# concurrent requests are embedded together by the recognition batcher
+RECOGNITION_BATCHING = os.environ.get('RECOGNITION_BATCHING', '1') == '1'
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', 16))
+BATCH_MAX_WAIT_MS = float(os.environ.get('BATCH_MAX_WAIT_MS', 5))
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', 1))
+
+# Multi-face frames: register/verify/detect use the face picked by
+# FACE_SELECTION (largest, central, score or first, see face_selection.py);
+# /api/identify_faces identifies up to MAX_FACES faces of one frame together
+FACE_SELECTION = os.environ.get('FACE_SELECTION', 'largest')
+MAX_FACES = int(os.environ.get('MAX_FACES', 10))
+if FACE_SELECTION not in FACE_SELECTION_POLICIES:
+    raise ValueError(f"FACE_SELECTION must be one of {FACE_SELECTION_POLICIES}, got '{FACE_SELECTION}'")
 
-# Load ArcFace model (using your working.py logic)
-face_app = FaceAnalysis(providers=['CPUExecutionProvider'])
-face_app.prepare(ctx_id=0, det_size=(640,640))
+# Model startup: optimised ONNX graphs are cached in MODEL_CACHE_DIR (empty
+# disables the cache) and each worker runs MODEL_WARMUP_RUNS dummy inferences
+# before it counts as ready (see /readyz)
+MODEL_CACHE_DIR = os.environ.get('MODEL_CACHE_DIR', DEFAULT_CACHE_DIR) or None
+MODEL_WARMUP_RUNS = int(os.environ.get('MODEL_WARMUP_RUNS', 1))
+# 'fp32' (stock models) or 'int8' (copies produced by quantize_models.py)
+MODEL_PRECISION = os.environ.get('MODEL_PRECISION', 'fp32')
 
-def get_embedding_from_image_data(image_data):
+def build_face_model():
+    # Only the models the API uses: no landmark or gender/age sessions
+    allowed_modules = ['detection'] if RECOGNITION_BATCHING else ['detection', 'recognition']
+    model = load_face_analysis(det_size=(640,640), intra_op_threads=INFERENCE_THREADS_PER_WORKER,
+                               allowed_modules=allowed_modules, cache_dir=MODEL_CACHE_DIR, warm=False,
+                               precision=MODEL_PRECISION)
+    warm_up(model.models, MODEL_WARMUP_RUNS)
+    return model
+
+def build_recognition_model():
+    model = load_recognition_model(intra_op_threads=INFERENCE_THREADS_PER_WORKER,
+                                   cache_dir=MODEL_CACHE_DIR, warm=False, precision=MODEL_PRECISION)
+    warm_up({'recognition': model}, MODEL_WARMUP_RUNS)
+    return model
+
+inference_pool = InferencePool(
+    build_face_model,
+    workers=INFERENCE_WORKERS,
+    queue_size=INFERENCE_QUEUE_SIZE,
+    timeout=INFERENCE_TIMEOUT,
+)
+
+def embed_crops(rec_model, crops):
+    """Batch task: one ArcFace forward pass for a list of aligned crops"""
+    return list(rec_model.get_feat(crops))
+
+recognition_batcher = MicroBatcher(
+    build_recognition_model,
+    embed_crops,
+    max_batch_size=BATCH_MAX_SIZE,
+    max_wait_ms=BATCH_MAX_WAIT_MS,
+    timeout=INFERENCE_TIMEOUT,
+    workers=BATCH_WORKERS,
+) if RECOGNITION_BATCHING else None
+
+def analyze_faces(face_model, img_bgr):
+    """Pool task: detection (+ recognition when batching is off) on one image"""
+    return face_model.get(img_bgr)
+
+def extract_faces(img_bgr, max_faces=1):
     """
-    Extract face embedding from image data using your working.py logic
+    Detect faces and return up to max_faces of them with embeddings, best
+    first by the FACE_SELECTION policy. With batching on, the aligned crops
+    are embedded by the micro-batcher, together in one batch.
+    """
+    with metrics.span('detection' if recognition_batcher is not None else 'detection_recognition'):
+        faces = inference_pool.run(analyze_faces, img_bgr)
+    faces = rank_faces(faces, img_bgr.shape, FACE_SELECTION)[:max_faces]
+    
+    if faces and recognition_batcher is not None:
+        with metrics.span('recognition'):
+            aligned = [face_align.norm_crop(img_bgr, landmark=face.kps, image_size=112) for face in faces]
+            for face, embedding in zip(faces, recognition_batcher.run_many(aligned)):
+                face.embedding = embedding.flatten()
+    return faces
+
+def extract_face(img_bgr):
+    """The face selected by FACE_SELECTION with its embedding, or None"""
+    faces = extract_faces(img_bgr, max_faces=1)
+    return faces[0] if faces else None
+
+# Detection-only preview pool for /api/detect_face polling: just the detector,
+# at a smaller input size, isolated from the login/registration queue
+PREVIEW_DET_SIZE = int(os.environ.get('PREVIEW_DET_SIZE', 320))
+PREVIEW_MAX_SIZE = int(os.environ.get('PREVIEW_MAX_SIZE', 640))
+PREVIEW_WORKERS = int(os.environ.get('PREVIEW_WORKERS', 1))
+
+def build_detector_model():
+    model = load_face_analysis(det_size=(PREVIEW_DET_SIZE, PREVIEW_DET_SIZE),
+                               intra_op_threads=INFERENCE_THREADS_PER_WORKER,
+                               allowed_modules=['detection'], cache_dir=MODEL_CACHE_DIR, warm=False,
+                               precision=MODEL_PRECISION)
+    warm_up(model.models, MODEL_WARMUP_RUNS)
+    return model
+
+preview_pool = InferencePool(
+    build_detector_model,
+    workers=PREVIEW_WORKERS,
+    queue_size=4 * PREVIEW_WORKERS,
+    timeout=INFERENCE_TIMEOUT,
+    name='preview',
+)
+
+def detect_bboxes(face_model, img_bgr):
+    """Preview pool task: face boxes only, no landmarks, recognition or crop"""
+    bboxes, _ = face_model.det_model.detect(img_bgr, max_num=1)
+    return bboxes
+
+def detect_frame(face_model, frame_bytes):
+    """
+    Preview pool task for live streams: decode one raw JPEG frame, detect the
+    face and report simple capture-quality signals
+    """
+    img_bgr = decode_image_bytes(frame_bytes, PREVIEW_MAX_SIZE)
+    if img_bgr is None:
+        return {'type': 'error', 'message': 'Invalid frame'}
+    bboxes = detect_bboxes(face_model, img_bgr)
+    height, width = img_bgr.shape[:2]
+    if len(bboxes) == 0:
+        return {'type': 'detection', 'face': False, 'frame_size': [width, height]}
+    
+    x1, y1, x2, y2 = np.clip(bboxes[0, :4], 0, [width, height, width, height]).astype(int)
+    face_gray = cv2.cvtColor(crop_box(img_bgr, bboxes[0]), cv2.COLOR_BGR2GRAY)
+    return {
+        'type': 'detection',
+        'face': True,
+        'bbox': [int(x1), int(y1), int(x2), int(y2)],
+        'frame_size': [width, height],
+        'quality': {
+            'det_score': float(bboxes[0, 4]),
+            'face_ratio': float((x2 - x1) * (y2 - y1) / (width * height)),
+            'sharpness': float(cv2.Laplacian(face_gray, cv2.CV_64F).var()) if face_gray.size else 0.0,
+        },
+    }
+
+# Live detection sessions: binary frames in, SSE bbox/quality events out
+live_hub = LiveStreamHub(preview_pool, detect_frame)
+
+# Face crop previews are opt-in per request ('crop': 'inline' | 'url'),
+# size/quality limited, and 'url' previews are only encoded when fetched
+PREVIEW_CROP_MAX_SIZE = int(os.environ.get('PREVIEW_CROP_MAX_SIZE', 256))
+PREVIEW_CROP_QUALITY = int(os.environ.get('PREVIEW_CROP_QUALITY', 80))
+PREVIEW_CROP_TTL = float(os.environ.get('PREVIEW_CROP_TTL', 60))
+crop_cache = CropCache(ttl=PREVIEW_CROP_TTL)
+
+def face_crop_fields(img_bgr, bbox, mode, quality=None):
+    """
+    Response fields for the optional face preview: nothing by default,
+    'face_crop' (data URL) for mode 'inline', 'face_crop_url' for mode 'url'
+    """
+    if mode not in ('inline', 'url'):
+        return {}
+    
+    quality = PREVIEW_CROP_QUALITY if quality is None else max(10, min(int(quality), PREVIEW_CROP_QUALITY))
+    crop = crop_box(img_bgr, bbox)
+    if crop.size == 0:
+        return {}
+    crop = limit_size(crop, PREVIEW_CROP_MAX_SIZE)
+    if mode == 'inline':
+        return {'face_crop': encode_jpeg_data_url(crop, quality)}
+    return {'face_crop_url': f"/api/face_crop/{crop_cache.put(crop, quality)}"}
+
+def flag_enabled(value):
+    """Boolean request option: JSON true or the form/query strings '1', 'true', 'yes'"""
+    return str(value).lower() in ('1', 'true', 'yes')
+
+def busy_response(error):
+    """503 response when the inference pool is saturated or too slow"""
+    print(f"⏳ [INFERENCE] Rejected request: {error}")
+    response = jsonify({'success': False, 'message': 'Server is busy, please try again'})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+def decode_for_recognition(image_bytes):
+    """Single decode straight to BGR, downscaled by the JPEG decoder where possible"""
+    max_size = default_max_size(image_bytes)
+    with metrics.span('decode'):
+        img_bgr = decode_reduced(image_bytes, max_size)
+    if img_bgr is None:
+        return None
+    with metrics.span('resize'):
+        return limit_size(img_bgr, max_size)
+
+def cached_face(img_bgr):
+    """extract_face() through the frame cache: a repeated frame reuses its face"""
+    if frame_cache is None:
+        return extract_face(img_bgr)
+    key = frame_cache.key(img_bgr)
+    face = frame_cache.get(key)
+    metrics.inc('verify_cache_lookups', help_text='Verification cache lookups by level and outcome',
+                level='frame', outcome='miss' if face is None else 'hit')
+    if face is None:
+        face = extract_face(img_bgr)
+        if face is not None:
+            frame_cache.put(key, face)
+    return face
+
+def get_face_from_image_bytes(image_bytes, crop_mode=None, crop_quality=None, cached=False):
+    """
+    Detect the face (with its embedding) in encoded image bytes using your working.py logic
     Optimized for faster processing with better quality handling
+    
+    Returns (face, bbox, preview_fields); preview_fields holds the
+    optional face crop response fields (see face_crop_fields). With
+    `cached`, the face of a recent near-identical frame is reused.
     """
     try:
-        # Convert base64 to image
-        image_bytes = base64.b64decode(image_data.split(',')[1])
-        image = Image.open(io.BytesIO(image_bytes))
-        
-        # Optimize image size based on source
-        # For webcam captures, use smaller size for speed
-        # For file uploads, use higher quality
-        max_size = 1200 if len(image_bytes) > 500000 else 800  # Larger images get higher quality
-        
-        if max(image.size) > max_size:
-            ratio = max_size / max(image.size)
-            new_size = tuple(int(dim * ratio) for dim in image.size)
-            image = image.resize(new_size, Image.Resampling.LANCZOS)
-        
-        img_array = np.array(image)
+        img_bgr = decode_for_recognition(image_bytes)
+        if img_bgr is None:
+            log_event(logger, 'face_extraction_failed', reason='could not decode image')
+            return None, None, {}
         
-        # Convert RGB to BGR for OpenCV
-        if len(img_array.shape) == 3:
-            img_bgr = cv2.cvtColor(img_array, cv2.COLOR_RGB2BGR)
-        else:
-            img_bgr = img_array
-        
-        # Detect faces with ArcFace (same as your working.py)
-        faces = face_app.get(img_bgr)
-        
-        if not faces:
-            return None, None, None
+        # Detect faces with ArcFace (same as your working.py) on a pool worker,
+        # taking the face chosen by FACE_SELECTION
+        face = cached_face(img_bgr) if cached else extract_face(img_bgr)
         
-        # Take first face (same as your working.py)
-        face = faces[0]
-        embedding = face.normed_embedding
+        if face is None:
+            return None, None, {}
         
         # Get bounding box for face detection display
         bbox = face.bbox.astype(int)
         
-        # Extract face crop (same as your working.py logic)
-        img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)  # Convert back to RGB for display
-        x1, y1, x2, y2 = bbox
-        face_crop = img_rgb[y1:y2, x1:x2]
-        
-        # Convert face crop to base64 for sending to frontend
-        face_crop_pil = Image.fromarray(face_crop)
-        buffer = io.BytesIO()
-        face_crop_pil.save(buffer, format='JPEG', quality=90)  # Higher quality for preview
-        face_crop_b64 = base64.b64encode(buffer.getvalue()).decode()
-        face_crop_data_url = f"data:image/jpeg;base64,{face_crop_b64}"
+        # Face crop preview only when the client asked for one
+        with metrics.span('crop_preview'):
+            preview_fields = face_crop_fields(img_bgr, bbox, crop_mode, crop_quality)
         
-        return embedding, bbox, face_crop_data_url
+        return face, bbox, preview_fields
         
+    except (PoolSaturatedError, InferenceTimeoutError):
+        raise
     except Exception as e:
-        print(f"Error in get_embedding_from_image_data: {e}")
-        return None, None, None
+        log_event(logger, 'face_extraction_failed', reason=str(e), error=type(e).__name__)
+        return None, None, {}
+
+def get_embedding_from_image_bytes(image_bytes, crop_mode=None, crop_quality=None, cached=False):
+    """
+    get_face_from_image_bytes() returning (embedding, bbox, preview_fields);
+    `cached` (detection previews only) goes through the frame cache
+    """
+    face, bbox, preview_fields = get_face_from_image_bytes(image_bytes, crop_mode, crop_quality, cached)
+    return (face.normed_embedding if face is not None else None), bbox, preview_fields
+
+def template_entry(embedding, quality=None):
+    """One element of a user document's 'templates' list"""
+    return face_templates.template_entry(embedding, quality, EMBEDDING_STORAGE_DTYPE)
+
+def new_user_document(username, embedding, bbox, quality=None):
+    """MongoDB document for a newly registered user"""
+    return face_templates.new_user_document(
+        username, [embedding], [quality], bbox, EMBEDDING_STORAGE_DTYPE, MAX_TEMPLATES)
+
+# Projection for plan_template_update()
+USER_TEMPLATE_FIELDS = {'_id': 0, 'username': 1, **EMBEDDING_FIELDS, **TEMPLATE_FIELDS}
+
+def plan_template_update(user, embedding, quality, similarity_threshold=0.25):
+    """
+    Decide how a new face joins a user's templates.
+    
+    The face must match one of the user's templates (so nobody can add
+    their face to another account); at MAX_TEMPLATES it replaces the
+    lowest-quality template, and only when it is better.
+    
+    Returns a dict with 'accepted', 'message' and 'similarity'; accepted
+    plans also carry the MongoDB '$set' fields ('set', applied only if
+    'template_revision' is unchanged) and the gallery 'centroid',
+    'templates' and 'revision'.
+    """
+    templates = decode_templates(user)
+    probe = embedding / np.linalg.norm(embedding)
+    similarity = float(np.max(templates @ probe / np.linalg.norm(templates, axis=1)))
+    if similarity <= similarity_threshold:
+        return {'accepted': False, 'similarity': similarity, 'message': 'Face does not match this user'}
+    
+    # Users registered before multi-template enrollment: their embedding is the first template
+    entries = list(user.get('templates') or [template_entry(decode_embedding(user), None)])
+    action, position = place_template([entry.get('quality') for entry in entries], quality, MAX_TEMPLATES)
+    if action == 'reject':
+        return {'accepted': False, 'similarity': similarity,
+                'message': f'All {len(entries)} templates are of better quality, template not added'}
+    if action == 'append':
+        entries.append(template_entry(embedding, quality))
+    else:
+        entries[position] = template_entry(embedding, quality)
+    
+    vectors = np.stack([decode_embedding(entry) for entry in entries]).astype(np.float32)
+    center = centroid(vectors)
+    revision = (user.get('template_revision') or 0) + 1
+    return {
+        'accepted': True,
+        'similarity': similarity,
+        'message': f'Template {"added" if action == "append" else "replaced"} ({len(entries)} templates)',
+        'set': {**encode_embedding(center, EMBEDDING_STORAGE_DTYPE), 'templates': entries,
+                'template_revision': revision},
+        'centroid': center,
+        'templates': vectors,
+        'revision': revision,
+    }
+
+# Batch registration (/api/register_batch, bulk_enroll.py --url): users per
+# request; only the first MAX_TEMPLATES photos of each user are embedded
+REGISTER_BATCH_MAX_USERS = int(os.environ.get('REGISTER_BATCH_MAX_USERS', 100))
+
+def batch_request_error(entries):
+    """Why a batch registration request is rejected as a whole, or None"""
+    if not entries:
+        return 'Users and images required'
+    if len(entries) > REGISTER_BATCH_MAX_USERS:
+        return f'At most {REGISTER_BATCH_MAX_USERS} users per batch'
+    return None
+
+def batch_entry_errors(entries, taken):
+    """Per batch entry, why that user cannot be registered (None when it can)"""
+    errors = []
+    seen = set()
+    for username, images in entries:
+        if not username or not images:
+            errors.append('Username and image required')
+        elif username in seen:
+            errors.append('Duplicate username in batch')
+        elif username in taken:
+            errors.append('Username already exists')
+        else:
+            errors.append(None)
+        seen.add(username)
+    return errors
+
+def embed_batch(entries, errors):
+    """
+    Detect and embed the photos of every registrable batch entry in parallel
+    and build the user documents.
+    
+    INFERENCE_WORKERS photos are in flight at a time, so decoding overlaps
+    the pool workers' inference and a batch cannot fill the pool queue on
+    its own; with RECOGNITION_BATCHING their ArcFace crops share
+    micro-batches. Entries without any face get an error.
+    
+    Returns (documents, rows) where rows[i] is the entry index of documents[i].
+    """
+    jobs = [(index, image) for index, (_, images) in enumerate(entries) if errors[index] is None
+            for image in images[:MAX_TEMPLATES]]
+    faces = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(INFERENCE_WORKERS, len(jobs)))) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, get_face_from_image_bytes, image)
+                   for _, image in jobs]
+        for (index, _), future in zip(jobs, futures):
+            face, bbox, _ = future.result()
+            if face is not None:
+                faces.setdefault(index, []).append((face.normed_embedding, bbox, template_quality(face)))
+    
+    documents = []
+    rows = []
+    for index, (username, _) in enumerate(entries):
+        if errors[index] is not None:
+            continue
+        if index not in faces:
+            errors[index] = 'No face detected in image'
+            continue
+        embeddings, bboxes, qualities = zip(*faces[index])
+        best = max(range(len(qualities)), key=lambda i: qualities[i])
+        documents.append(face_templates.new_user_document(
+            username, embeddings, qualities, bboxes[best], EMBEDDING_STORAGE_DTYPE, MAX_TEMPLATES))
+        rows.append(index)
+    return documents, rows
+
+def finish_batch(entries, errors, documents, rows, failed):
+    """
+    Add the inserted users to the gallery in one update and build the
+    response body, with one result per entry in request order.
+    
+    `failed` maps the indices of documents the database rejected to a message.
+    """
+    for position, message in failed.items():
+        errors[rows[position]] = message
+    inserted = [documents[position] for position in range(len(documents)) if position not in failed]
+    if inserted:
+        gallery.add_many([document['username'] for document in inserted],
+                         [decode_embedding(document) for document in inserted],
+                         [decode_templates(document) for document in inserted])
+    
+    templates = {rows[position]: len(documents[position]['templates'])
+                 for position in range(len(documents)) if position not in failed}
+    results = []
+    for index, (username, _) in enumerate(entries):
+        result = {'username': username, 'success': errors[index] is None,
+                  'message': errors[index] or 'Face registered successfully'}
+        if index in templates:
+            result['templates'] = templates[index]
+        results.append(result)
+    return {
+        'success': bool(inserted),
+        'message': f'{len(inserted)} of {len(entries)} users registered',
+        'registered': len(inserted),
+        'results': results
+    }
+
+def match_embeddings(test_embeddings, similarity_threshold=0.25):
+    """
+    Search the gallery for several probe embeddings with one search.
+
+    Returns one (username or None, best_similarity, top_scores) per probe,
+    where top_scores holds the best VERIFY_TOP_K candidates. Probes close
+    enough to a recent one reuse its decision (see verify_cache.py); the
+    others are searched together. Failed matches are sampled for a
+    background score dump (see verify_debug.py).
+    """
+    # Top-k only: argpartition over the scores (or the ANN shortlist, exactly re-scored);
+    # at least 2 so the decision cache knows the runner-up
+    search_k = max(VERIFY_TOP_K, 2)
+    if gallery.index is not None:
+        search_k = max(search_k, ANN_RERANK_K)
+    # Read before searching: a gallery change during the search makes the result stale
+    version = gallery.version
+    # Cached decisions are only reusable when the search is exact (see verify_cache.py)
+    use_decisions = decision_cache is not None and gallery.exact_search
+    
+    matches = [None] * len(test_embeddings)
+    if use_decisions:
+        for position, test_embedding in enumerate(test_embeddings):
+            matches[position] = decision_cache.get(test_embedding, similarity_threshold, version)
+            metrics.inc('verify_cache_lookups', help_text='Verification cache lookups by level and outcome',
+                        level='decision', outcome='miss' if matches[position] is None else 'hit')
+    misses = [position for position, match in enumerate(matches) if match is None]
+    
+    if misses:
+        with metrics.span('gallery_search'):
+            decisions = gallery.identify_many([test_embeddings[position] for position in misses],
+                                              threshold=similarity_threshold, k=search_k)
+        for position, (best_username, best_similarity, scores, usernames) in zip(misses, decisions):
+            top_scores = [{'username': username, 'similarity': similarity}
+                          for username, similarity in zip(usernames[:VERIFY_TOP_K], scores[:VERIFY_TOP_K].tolist())]
+            matches[position] = (best_username, best_similarity, top_scores)
+            
+            if best_username is None:
+                trace = current_trace()
+                score_dumper.maybe_dump(test_embeddings[position], similarity_threshold,
+                                        trace.trace_id if trace is not None else None)
+            if use_decisions:
+                runner_up = float(scores[1]) if len(scores) > 1 else None
+                decision_cache.put(test_embeddings[position], similarity_threshold, version,
+                                   best_similarity, runner_up, matches[position])
+    
+    for best_username, _, _ in matches:
+        metrics.inc('verifications', help_text='Verification attempts by outcome',
+                    outcome='match' if best_username else 'no_match')
+    return matches
+
+def match_embedding(test_embedding, similarity_threshold=0.25):
+    """match_embeddings() for a single probe: (username or None, best_similarity, top_scores)"""
+    return match_embeddings([test_embedding], similarity_threshold)[0]
+
+def identify_image_bytes(image_bytes, similarity_threshold=0.25):
+    """
+    Identify every face of a frame (up to MAX_FACES): one detection pass,
+    one recognition batch and one gallery search.
+
+    Returns per-face result dicts, best face first by FACE_SELECTION, or
+    None when the image cannot be decoded.
+    """
+    img_bgr = decode_for_recognition(image_bytes)
+    if img_bgr is None:
+        return None
+    faces = extract_faces(img_bgr, max_faces=MAX_FACES)
+    if not faces:
+        return []
+    
+    matches = match_embeddings([face.normed_embedding for face in faces], similarity_threshold)
+    results = []
+    for face, (username, similarity, top_scores) in zip(faces, matches):
+        result = {
+            'bbox': face.bbox.astype(int).tolist(),
+            'det_score': float(face.det_score),
+            'matched': username is not None,
+            'username': username,
+            'similarity': float(similarity),
+        }
+        if username is None:
+            result['top_scores'] = top_scores
+        results.append(result)
+    return results
 
 def cosine_similarity(a, b):
     """
@@ -105,16 +723,33 @@ def login():
 def detect_face():
     """
     Detect face and return the face crop for preview before registration/verification
+    (when requested with 'crop': 'inline' or 'url').
+    With 'fast': true (live camera polling) only the detector runs and only the bbox is returned.
     """
     try:
-        data = request.json
-        image_data = data.get('image')
+        image_bytes, data = read_image_request(request)
         
-        if not image_data:
+        if not image_bytes:
             return jsonify({'success': False, 'message': 'Image required'})
         
+        if flag_enabled(data.get('fast', '')):
+            with metrics.span('decode'):
+                img_bgr = decode_image_bytes(image_bytes, PREVIEW_MAX_SIZE)
+            if img_bgr is None:
+                return jsonify({'success': False, 'message': 'Invalid image'})
+            with metrics.span('preview_detection'):
+                bboxes = preview_pool.run(detect_bboxes, img_bgr)
+            if len(bboxes) == 0:
+                return jsonify({'success': False, 'message': 'No face detected in image'})
+            return jsonify({
+                'success': True,
+                'message': 'Face detected successfully',
+                'bbox': bboxes[0, :4].astype(int).tolist()
+            })
+        
         # Get face detection results
-        embedding, bbox, face_crop_data_url = get_embedding_from_image_data(image_data)
+        embedding, bbox, preview_fields = get_embedding_from_image_bytes(
+            image_bytes, data.get('crop'), data.get('crop_quality'), cached=True)
         
         if embedding is None:
             return jsonify({'success': False, 'message': 'No face detected in image'})
@@ -123,121 +758,222 @@ def detect_face():
             'success': True,
             'message': 'Face detected successfully',
             'bbox': bbox.tolist() if bbox is not None else None,
-            'face_crop': face_crop_data_url
+            **preview_fields
         })
         
+    except (PoolSaturatedError, InferenceTimeoutError) as e:
+        return busy_response(e)
     except Exception as e:
         return jsonify({'success': False, 'message': f'Error: {str(e)}'})
 
+@app.route('/api/face_crop/<crop_id>')
+def face_crop(crop_id):
+    """Serve a preview referenced by 'face_crop_url', JPEG-encoded on first fetch"""
+    jpeg = crop_cache.get_jpeg(crop_id)
+    if jpeg is None:
+        return jsonify({'success': False, 'message': 'Preview expired or not found'}), 404
+    return Response(jpeg, mimetype='image/jpeg', headers={'Cache-Control': 'private, max-age=60'})
+
+@app.route('/api/stream/start', methods=['POST'])
+def stream_start():
+    """Open a live detection session for a camera preview"""
+    session_id = live_hub.open()
+    if session_id is None:
+        return busy_response('too many live sessions')
+    return jsonify({'success': True, 'session_id': session_id})
+
+@app.route('/api/stream/<session_id>/frame', methods=['POST'])
+def stream_frame(session_id):
+    """
+    Accept one raw JPEG frame (request body, no base64/JSON). Frames that
+    arrive while the previous one is still being processed replace it.
+    """
+    frame_bytes = request.get_data()
+    if not frame_bytes:
+        return jsonify({'success': False, 'message': 'Frame required'}), 400
+    if not live_hub.push_frame(session_id, frame_bytes):
+        return jsonify({'success': False, 'message': 'Unknown stream session'}), 404
+    return jsonify({'success': True}), 202
+
+@app.route('/api/stream/<session_id>/events')
+def stream_events(session_id):
+    """Server-Sent Events stream of detection results for the session"""
+    if live_hub.get(session_id) is None:
+        return jsonify({'success': False, 'message': 'Unknown stream session'}), 404
+    return Response(live_hub.events(session_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/stream/<session_id>/stop', methods=['POST'])
+def stream_stop(session_id):
+    live_hub.close(session_id)
+    return jsonify({'success': True})
+
 @app.route('/api/register_face', methods=['POST'])
 def register_face():
     try:
-        data = request.json
+        image_bytes, data = read_image_request(request)
         username = data.get('username')
-        image_data = data.get('image')
         
-        if not username or not image_data:
+        if not username or not image_bytes:
             return jsonify({'success': False, 'message': 'Username and image required'})
         
         print(f"\n👤 [REGISTRATION] Starting face registration for user: {username}")
-        start_time = datetime.now()
         
         # Check if user already exists
-        existing_user = users_collection.find_one({'username': username})
+        with metrics.span('db_find_user'):
+            existing_user = users_collection.find_one({'username': username})
         if existing_user:
             print(f"❌ [REGISTRATION] User '{username}' already exists")
             return jsonify({'success': False, 'message': 'Username already exists'})
         
         # Get face embedding using your working.py logic
-        embedding, bbox, face_crop_data_url = get_embedding_from_image_data(image_data)
+        face, bbox, preview_fields = get_face_from_image_bytes(
+            image_bytes, data.get('crop'), data.get('crop_quality'))
         
-        if embedding is None:
+        if face is None:
             print(f"❌ [REGISTRATION] No face detected for user '{username}'")
             return jsonify({'success': False, 'message': 'No face detected in image'})
-        
-        embedding_time = datetime.now()
-        print(f"⚡ [REGISTRATION] Face embedding extracted in {(embedding_time - start_time).total_seconds():.2f}s")
+        embedding = face.normed_embedding
         
         # Store user data in MongoDB
-        user_data = {
-            'username': username,
-            'embedding': embedding.tolist(),  # Convert numpy array to list for storage
-            'registered_at': datetime.now(),
-            'bbox': bbox.tolist() if bbox is not None else None
-        }
+        user_data = new_user_document(username, embedding, bbox, template_quality(face))
         
-        result = users_collection.insert_one(user_data)
+        with metrics.span('db_insert'):
+            try:
+                result = users_collection.insert_one(user_data)
+            except DuplicateKeyError:
+                print(f"❌ [REGISTRATION] User '{username}' was registered concurrently")
+                return jsonify({'success': False, 'message': 'Username already exists'})
+        gallery.add(username, embedding)
         
-        total_time = (datetime.now() - start_time).total_seconds()
         print(f"✅ [REGISTRATION] User '{username}' registered successfully!")
-        print(f"🏁 [REGISTRATION] Total registration time: {total_time:.2f}s")
         print(f"📊 [REGISTRATION] Database ID: {result.inserted_id}")
         
         return jsonify({
             'success': True, 
             'message': 'Face registered successfully',
             'bbox': bbox.tolist() if bbox is not None else None,
-            'face_crop': face_crop_data_url
+            **preview_fields
         })
         
+    except (PoolSaturatedError, InferenceTimeoutError) as e:
+        return busy_response(e)
     except Exception as e:
         print(f"💥 [REGISTRATION] ERROR: {str(e)}")
         return jsonify({'success': False, 'message': f'Error: {str(e)}'})
 
+@app.route('/api/add_template', methods=['POST'])
+def add_template():
+    """
+    Add another face template to an existing user (capped at MAX_TEMPLATES,
+    replacing the lowest-quality one). The face has to match the user.
+    """
+    try:
+        image_bytes, data = read_image_request(request)
+        username = data.get('username')
+        
+        if not username or not image_bytes:
+            return jsonify({'success': False, 'message': 'Username and image required'})
+        
+        print(f"\n🧩 [TEMPLATE] Adding a face template for user: {username}")
+        
+        with metrics.span('db_find_user'):
+            user = users_collection.find_one({'username': username}, USER_TEMPLATE_FIELDS)
+        if not user:
+            return jsonify({'success': False, 'message': 'User not found'})
+        
+        face, bbox, preview_fields = get_face_from_image_bytes(
+            image_bytes, data.get('crop'), data.get('crop_quality'))
+        if face is None:
+            return jsonify({'success': False, 'message': 'No face detected in image'})
+        
+        plan = plan_template_update(user, face.normed_embedding, template_quality(face))
+        if not plan['accepted']:
+            print(f"❌ [TEMPLATE] {plan['message']} (similarity {plan['similarity']:.4f})")
+            return jsonify({'success': False, 'message': plan['message'], 'similarity': plan['similarity']})
+        
+        # Only applied if no other request changed the templates in between
+        with metrics.span('db_update'):
+            result = users_collection.update_one(
+                {'username': username, 'template_revision': user.get('template_revision')}, {'$set': plan['set']})
+        if result.modified_count == 0:
+            return jsonify({'success': False, 'message': 'Templates changed during the update, please retry'})
+        gallery.update(username, plan['centroid'], plan['templates'], plan['revision'])
+        
+        print(f"✅ [TEMPLATE] {plan['message']} for user '{username}'")
+        return jsonify({
+            'success': True,
+            'message': plan['message'],
+            'similarity': plan['similarity'],
+            'templates': len(plan['templates']),
+            'bbox': bbox.tolist() if bbox is not None else None,
+            **preview_fields
+        })
+        
+    except (PoolSaturatedError, InferenceTimeoutError) as e:
+        return busy_response(e)
+    except Exception as e:
+        print(f"💥 [TEMPLATE] ERROR: {str(e)}")
+        return jsonify({'success': False, 'message': f'Error: {str(e)}'})
+
+@app.route('/api/register_batch', methods=['POST'])
+def register_batch():
+    """
+    Register several users in one request (see image_io.read_batch_request).
+    
+    Existing usernames are found with one query, all photos are embedded in
+    parallel, the new users are written with one unordered insert_many and
+    added to the gallery in one update. Every user gets its own result.
+    """
+    try:
+        entries = read_batch_request(request)
+        error = batch_request_error(entries)
+        if error:
+            return jsonify({'success': False, 'message': error})
+        
+        print(f"\n👥 [BATCH REGISTRATION] Registering {len(entries)} users")
+        
+        with metrics.span('db_find_user'):
+            taken = existing_usernames(users_collection, [username for username, _ in entries if username])
+        errors = batch_entry_errors(entries, taken)
+        
+        documents, rows = embed_batch(entries, errors)
+        
+        with metrics.span('db_insert'):
+            failed = insert_users(users_collection, documents)
+        body = finish_batch(entries, errors, documents, rows, failed)
+        
+        print(f"✅ [BATCH REGISTRATION] {body['message']}")
+        return jsonify(body)
+        
+    except (PoolSaturatedError, InferenceTimeoutError) as e:
+        return busy_response(e)
+    except Exception as e:
+        print(f"💥 [BATCH REGISTRATION] ERROR: {str(e)}")
+        return jsonify({'success': False, 'message': f'Error: {str(e)}'})
+
 @app.route('/api/verify_face', methods=['POST'])
 def verify_face():
     try:
-        data = request.json
-        image_data = data.get('image')
+        image_bytes, data = read_image_request(request)
         
-        if not image_data:
+        if not image_bytes:
             return jsonify({'success': False, 'message': 'Image required'})
         
         print("\n🔍 [VERIFICATION] Starting face verification...")
-        start_time = datetime.now()
         
         # Get face embedding from captured image using your working.py logic
-        test_embedding, bbox, face_crop_data_url = get_embedding_from_image_data(image_data)
+        test_embedding, bbox, preview_fields = get_embedding_from_image_bytes(
+            image_bytes, data.get('crop'), data.get('crop_quality'))
         
         if test_embedding is None:
             print("❌ [VERIFICATION] No face detected in verification image")
             return jsonify({'success': False, 'message': 'No face detected in image'})
         
-        embedding_time = datetime.now()
-        print(f"⚡ [VERIFICATION] Face embedding extracted in {(embedding_time - start_time).total_seconds():.2f}s")
-        
-        # Compare with all registered users
-        best_match = None
-        best_similarity = 0
+        # Compare with registered users via the in-memory gallery
         similarity_threshold = 0.25  # Updated to optimal threshold from analysis
-        
-        print("🔍 [VERIFICATION] Comparing with registered users...")
-        user_count = 0
-        similarity_scores = []  # Store all similarity scores for detailed reporting
-        
-        for user in users_collection.find():
-            user_count += 1
-            stored_embedding = np.array(user['embedding'])
-            # Use your working.py cosine similarity function
-            similarity = cosine_similarity(test_embedding, stored_embedding)
-            
-            # Store similarity score with username for reporting
-            similarity_scores.append({
-                'username': user['username'],
-                'similarity': float(similarity)
-            })
-            
-            print(f"📊 [VERIFICATION] User '{user['username']}': Similarity = {similarity:.4f}")
-            
-            if similarity > best_similarity:
-                best_similarity = similarity
-                if similarity > similarity_threshold:
-                    best_match = user
-        
-        comparison_time = datetime.now()
-        total_time = (comparison_time - start_time).total_seconds()
-        print(f"⚡ [VERIFICATION] Compared with {user_count} users in {(comparison_time - embedding_time).total_seconds():.2f}s")
-        print(f"🏁 [VERIFICATION] Total verification time: {total_time:.2f}s")
+        best_username, best_similarity, top_scores = match_embedding(test_embedding, similarity_threshold)
+        best_match = {'username': best_username} if best_username else None
         
         if best_match:
             print(f"✅ [VERIFICATION] SUCCESSFUL! User '{best_match['username']}' verified with {best_similarity:.4f} similarity")
@@ -247,48 +983,163 @@ def verify_face():
                 'username': best_match['username'],
                 'similarity': float(best_similarity),
                 'bbox': bbox.tolist() if bbox is not None else None,
-                'face_crop': face_crop_data_url
+                **preview_fields
             })
         else:
-            # Sort similarity scores in descending order for better readability
-            similarity_scores.sort(key=lambda x: x['similarity'], reverse=True)
-            
-            print(f"\n❌ [VERIFICATION] MATCH NOT FOUND!")
-            print(f"🔴 [VERIFICATION] Threshold: {similarity_threshold}")
-            print(f"🔴 [VERIFICATION] Best similarity: {best_similarity:.4f}")
-            print(f"🔴 [VERIFICATION] Gap from threshold: {(similarity_threshold - best_similarity):.4f}")
-            print(f"\n📊 [VERIFICATION] All Similarity Scores (sorted high to low):")
-            print("=" * 60)
-            
-            for idx, score_data in enumerate(similarity_scores, 1):
-                username = score_data['username']
-                score = score_data['similarity']
-                status = "✓ PASS" if score > similarity_threshold else "✗ FAIL"
-                print(f"{idx:2d}. {username:20s} | Similarity: {score:.4f} | {status}")
-            
-            print("=" * 60)
-            print(f"🔴 [VERIFICATION] No user matched above threshold {similarity_threshold}")
-            
-            if best_similarity > 0:
-                closest_user = similarity_scores[0]['username']
-                print(f"🔴 [VERIFICATION] Closest match: '{closest_user}' with {best_similarity:.4f} similarity")
-            
-            print()
+            print(f"❌ [VERIFICATION] MATCH NOT FOUND! Best similarity: {best_similarity:.4f} "
+                  f"(threshold {similarity_threshold}, {len(gallery)} users)")
             
             return jsonify({
                 'success': False,
                 'message': 'Face not recognized',
                 'similarity': float(best_similarity) if best_similarity > 0 else 0,
                 'threshold': float(similarity_threshold),
-                'all_scores': similarity_scores,  # Include all scores in response
+                'top_scores': top_scores,  # Best VERIFY_TOP_K candidates, constant size
                 'bbox': bbox.tolist() if bbox is not None else None,
-                'face_crop': face_crop_data_url
+                **preview_fields
             })
         
+    except (PoolSaturatedError, InferenceTimeoutError) as e:
+        return busy_response(e)
     except Exception as e:
         print(f"💥 [VERIFICATION] ERROR: {str(e)}")
         return jsonify({'success': False, 'message': f'Error: {str(e)}'})
 
+@app.route('/api/identify_faces', methods=['POST'])
+def identify_faces():
+    """
+    Identify everybody in the frame (kiosk cameras): per-face results for up
+    to MAX_FACES faces, ordered by FACE_SELECTION
+    """
+    try:
+        image_bytes, _ = read_image_request(request)
+        
+        if not image_bytes:
+            return jsonify({'success': False, 'message': 'Image required'})
+        
+        similarity_threshold = 0.25
+        faces = identify_image_bytes(image_bytes, similarity_threshold)
+        if faces is None:
+            return jsonify({'success': False, 'message': 'Invalid image'})
+        if not faces:
+            return jsonify({'success': False, 'message': 'No face detected in image'})
+        
+        recognized = [face['username'] for face in faces if face['matched']]
+        print(f"🔍 [IDENTIFICATION] {len(recognized)} of {len(faces)} faces recognized: {recognized}")
+        return jsonify({
+            'success': bool(recognized),
+            'message': f'{len(recognized)} of {len(faces)} faces recognized',
+            'threshold': float(similarity_threshold),
+            'faces': faces
+        })
+        
+    except (PoolSaturatedError, InferenceTimeoutError) as e:
+        return busy_response(e)
+    except Exception as e:
+        print(f"💥 [IDENTIFICATION] ERROR: {str(e)}")
+        return jsonify({'success': False, 'message': f'Error: {str(e)}'})
+
+def collect_inference_stats():
+    """Queue depth, worker usage and per-stage timings of the inference pool and batcher"""
+    stats = inference_pool.stats()
+    stats['preview'] = preview_pool.stats()
+    stats['live_streams'] = live_hub.stats()
+    if recognition_batcher is not None:
+        stats['batching'] = recognition_batcher.stats()
+    stats['verify_debug'] = score_dumper.stats()
+    return stats
+
+@app.route('/api/inference_stats')
+def inference_stats():
+    return jsonify({'success': True, 'stats': collect_inference_stats()})
+
+def pool_gauges():
+    """Gauges for /metrics from the inference pools and live streams"""
+    pools = {'inference': inference_pool.stats(), 'preview': preview_pool.stats()}
+    gauges = [
+        ('pool_queue_depth', 'Requests waiting for an inference worker',
+         [({'pool': name}, stats['queue_depth']) for name, stats in pools.items()]),
+        ('pool_busy_workers', 'Inference workers currently running a task',
+         [({'pool': name}, stats['busy_workers']) for name, stats in pools.items()]),
+        ('pool_rejected', 'Requests rejected because the queue was full',
+         [({'pool': name}, stats['rejected']) for name, stats in pools.items()]),
+        ('pool_timed_out', 'Requests that timed out waiting for inference',
+         [({'pool': name}, stats['timed_out']) for name, stats in pools.items()]),
+        ('gallery_users', 'Embeddings held in the in-memory gallery', [({}, len(gallery))]),
+        ('live_sessions', 'Open live detection sessions', [({}, live_hub.stats()['sessions'])]),
+    ]
+    if recognition_batcher is not None:
+        batching = recognition_batcher.stats()
+        gauges.append(('batch_queue_depth', 'Crops waiting for a recognition batch', [({}, batching['queue_depth'])]))
+        gauges.append(('batch_avg_size', 'Average recognition batch size', [({}, batching['avg_batch_size'])]))
+    return gauges
+
+def worker_pools():
+    pools = {'inference': inference_pool, 'preview': preview_pool}
+    if recognition_batcher is not None:
+        pools['batching'] = recognition_batcher
+    return pools
+
+def health_report():
+    """
+    (live, ready, details) for the probes: live while every pool still has a
+    running worker thread, ready once every worker has loaded and warmed up
+    its models
+    """
+    pools = {name: pool.stats() for name, pool in worker_pools().items()}
+    details = {name: {'workers': stats['workers'], 'ready_workers': stats['ready_workers'],
+                      'alive_workers': stats['alive_workers']}
+               for name, stats in pools.items()}
+    live = all(stats['alive_workers'] > 0 for stats in pools.values())
+    ready = live and all(stats['ready_workers'] == stats['workers'] for stats in pools.values())
+    return live, ready, {'pools': details, 'gallery_users': len(gallery)}
+
+_shutdown_lock = threading.Lock()
+_shut_down = False
+
+def shutdown_workers():
+    """
+    Close live streams, stop the inference workers after their queued work,
+    save the IVF index and close the shards. Runs once: asgi_app calls it on
+    shutdown and atexit at interpreter exit (Flask mode).
+    """
+    global _shut_down
+    with _shutdown_lock:
+        if _shut_down:
+            return
+        _shut_down = True
+    live_hub.close_all()
+    preview_pool.shutdown()
+    inference_pool.shutdown()
+    if recognition_batcher is not None:
+        recognition_batcher.shutdown()
+    score_dumper.shutdown()
+    save_gallery_index()
+    if GALLERY_SHARDS:
+        gallery.close()
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus text exposition of stage/request latencies, counters and pool gauges"""
+    return Response(metrics.render_prometheus(pool_gauges()), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/metrics')
+def metrics_summary():
+    """JSON view of the same metrics with p50/p95/p99 per stage"""
+    return jsonify({'success': True, 'metrics': metrics.snapshot()})
+
+@app.route('/healthz')
+def healthz():
+    """Liveness probe: fails only when a pool has lost all of its workers"""
+    live, _, details = health_report()
+    return jsonify({'status': 'ok' if live else 'failed', **details}), 200 if live else 503
+
+@app.route('/readyz')
+def readyz():
+    """Readiness probe: 503 until every model is loaded and warmed up"""
+    _, ready, details = health_report()
+    return jsonify({'status': 'ready' if ready else 'starting', **details}), 200 if ready else 503
+
 @app.route('/api/get_users')
 def get_users():
     try:
@@ -297,7 +1148,12 @@ def get_users():
     except Exception as e:
         return jsonify({'success': False, 'message': f'Error: {str(e)}'})
 
+atexit.register(shutdown_workers)
+
 if __name__ == '__main__':
     print("Starting Face Authorization System...")
     print("Make sure MongoDB is running on localhost:27017")
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # SIGTERM exits through atexit too, so the shutdown hook runs
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # No reloader: its parent process would load the models, gallery, shards and index a second time
+    app.run(debug=True, use_reloader=False, host='0.0.0.0', port=5000)
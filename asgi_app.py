@@ -0,0 +1,550 @@
+"""
+Production (ASGI) serving mode for the face authentication API.
+
+    python asgi_app.py                      # hypercorn on ASGI_BIND, graceful SIGTERM
+    hypercorn asgi_app:app --bind 0.0.0.0:8000
+
+Serves the same pages and API as app.py and shares its models, inference
+pools, gallery and helpers, but request handling is asynchronous:
+
+- request bodies are read by the event loop, so slow uploads only cost a
+  coroutine (bounded by BODY_TIMEOUT) instead of a blocked worker thread
+- MongoDB is reached through motor, the asyncio driver
+- decoding, inference and gallery searches/updates run on a bounded
+  offload executor feeding the inference pools; the detection-only path
+  awaits the pool future directly
+- every request has a REQUEST_TIMEOUT deadline, answered with a 503
+- live detection streams are async generators, not one thread per viewer
+- SIGTERM/SIGINT stop accepting connections, close live streams, let
+  in-flight requests finish (GRACEFUL_TIMEOUT) and then stop the workers
+"""
+import asyncio
+import contextvars
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from quart import Quart, render_template, request, jsonify, Response
+from quart_cors import cors
+
+import app as service
+from bulk_enroll import write_errors
+from image_io import read_image_request_async, read_batch_request_async, decode_image_bytes
+from inference_pool import PoolSaturatedError, InferenceTimeoutError
+from metrics import metrics
+from tracing import begin_trace, end_trace, log_event
+
+# Seconds a request may take end to end (excluding the body upload) before a 503
+REQUEST_TIMEOUT = float(os.environ.get('REQUEST_TIMEOUT', 15))
+# Seconds allowed for receiving a request body
+BODY_TIMEOUT = float(os.environ.get('BODY_TIMEOUT', 30))
+# Threads running decode + inference calls; the pools behind them bound the real work
+OFFLOAD_THREADS = int(os.environ.get('OFFLOAD_THREADS',
+                                     service.INFERENCE_WORKERS + service.INFERENCE_QUEUE_SIZE
+                                     + service.BATCH_MAX_SIZE))
+MONGO_TIMEOUT_MS = int(os.environ.get('MONGO_TIMEOUT_MS', 5000))
+ASGI_BIND = os.environ.get('ASGI_BIND', '0.0.0.0:8000')
+GRACEFUL_TIMEOUT = float(os.environ.get('GRACEFUL_TIMEOUT', 20))
+
+app = cors(Quart(__name__))
+app.config['BODY_TIMEOUT'] = BODY_TIMEOUT
+app.config['RESPONSE_TIMEOUT'] = None  # Live event streams stay open; API calls use REQUEST_TIMEOUT
+
+offload_executor = ThreadPoolExecutor(max_workers=OFFLOAD_THREADS, thread_name_prefix='offload')
+users_collection = None
+
+
+class OffloadedCollection:
+    """
+    The subset of motor's collection API used here, over a synchronous
+    collection whose calls run on the offload executor (MONGO_BACKEND=mongomock).
+    """
+
+    class _Cursor:
+        def __init__(self, collection, args):
+            self._collection = collection
+            self._args = args
+
+        async def to_list(self, length=None):
+            documents = await offload(lambda: list(self._collection.find(*self._args)))
+            return documents if length is None else documents[:length]
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    async def find_one(self, *args):
+        return await offload(self._collection.find_one, *args)
+
+    async def insert_one(self, document):
+        return await offload(self._collection.insert_one, document)
+
+    async def insert_many(self, documents, ordered=True):
+        return await offload(lambda: self._collection.insert_many(documents, ordered=ordered))
+
+    async def update_one(self, *args):
+        return await offload(self._collection.update_one, *args)
+
+    def find(self, *args):
+        return self._Cursor(self._collection, args)
+
+    def close(self):
+        pass
+
+
+@app.before_serving
+async def connect_database():
+    global users_collection
+    if service.MONGO_BACKEND == 'mongomock':
+        # Same in-memory database the gallery was loaded from
+        app.mongo_client = OffloadedCollection(service.users_collection)
+        users_collection = app.mongo_client
+        print(f"In-memory mongomock database, {OFFLOAD_THREADS} offload threads")
+        return
+    mongo = AsyncIOMotorClient(service.MONGO_URI, serverSelectionTimeoutMS=MONGO_TIMEOUT_MS,
+                               socketTimeoutMS=MONGO_TIMEOUT_MS)
+    app.mongo_client = mongo
+    users_collection = mongo[service.MONGO_DB]['users']
+    print(f"Async MongoDB client ready ({service.MONGO_URI}), {OFFLOAD_THREADS} offload threads")
+
+
+@app.after_serving
+async def release_resources():
+    print("Shutting down: stopping inference workers...")
+    app.mongo_client.close()
+    await asyncio.get_running_loop().run_in_executor(None, service.shutdown_workers)
+    offload_executor.shutdown(wait=True)
+    print("Shutdown complete")
+
+
+@app.before_request
+async def start_request_trace():
+    begin_trace(request.headers.get('X-Request-ID'))
+
+
+@app.after_request
+async def finish_request_trace(response):
+    trace = end_trace()
+    if trace is None:
+        return response
+    endpoint = request.endpoint or 'unknown'
+    elapsed = trace.elapsed()
+    metrics.observe('http_request_seconds', elapsed, 'HTTP request latency', endpoint=endpoint)
+    metrics.inc('http_requests', help_text='HTTP requests served', endpoint=endpoint, status=str(response.status_code))
+    response.headers['X-Request-ID'] = trace.trace_id
+    if endpoint not in ('prometheus_metrics', 'healthz', 'readyz', 'static'):
+        log_event(service.logger, 'request', trace_id=trace.trace_id, method=request.method, path=request.path,
+                  status=response.status_code, duration_ms=round(elapsed * 1000, 2), stages=trace.stage_ms())
+    return response
+
+
+async def offload(fn, *args):
+    """Run a blocking call on the offload executor, keeping the request's trace context"""
+    context = contextvars.copy_context()
+    future = asyncio.get_running_loop().run_in_executor(offload_executor, context.run, fn, *args)
+    return await asyncio.wait_for(future, REQUEST_TIMEOUT)
+
+
+async def within_deadline(awaitable):
+    return await asyncio.wait_for(awaitable, REQUEST_TIMEOUT)
+
+
+def busy_response(error):
+    """503 response when the inference pools are saturated or a deadline passed"""
+    print(f"⏳ [INFERENCE] Rejected request: {error or 'request timed out'}")
+    response = jsonify({'success': False, 'message': 'Server is busy, please try again'})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+BUSY_ERRORS = (PoolSaturatedError, InferenceTimeoutError, asyncio.TimeoutError)
+
+
+@app.route('/')
+async def index():
+    return await render_template('index.html')
+
+
+@app.route('/register')
+async def register():
+    return await render_template('register_clean.html')
+
+
+@app.route('/login')
+async def login():
+    return await render_template('login_clean.html')
+
+
+@app.route('/api/detect_face', methods=['POST'])
+async def detect_face():
+    """Same contract as app.detect_face; 'fast' awaits the detector pool future directly"""
+    try:
+        image_bytes, data = await read_image_request_async(request)
+
+        if not image_bytes:
+            return jsonify({'success': False, 'message': 'Image required'})
+
+        if service.flag_enabled(data.get('fast', '')):
+            img_bgr = await offload(decode_image_bytes, image_bytes, service.PREVIEW_MAX_SIZE)
+            if img_bgr is None:
+                return jsonify({'success': False, 'message': 'Invalid image'})
+            with metrics.span('preview_detection'):
+                future = service.preview_pool.submit(service.detect_bboxes, img_bgr)
+                bboxes = await within_deadline(asyncio.wrap_future(future))
+            if len(bboxes) == 0:
+                return jsonify({'success': False, 'message': 'No face detected in image'})
+            return jsonify({
+                'success': True,
+                'message': 'Face detected successfully',
+                'bbox': bboxes[0, :4].astype(int).tolist()
+            })
+
+        embedding, bbox, preview_fields = await offload(
+            service.get_embedding_from_image_bytes, image_bytes, data.get('crop'), data.get('crop_quality'),
+            True)
+
+        if embedding is None:
+            return jsonify({'success': False, 'message': 'No face detected in image'})
+
+        return jsonify({
+            'success': True,
+            'message': 'Face detected successfully',
+            'bbox': bbox.tolist() if bbox is not None else None,
+            **preview_fields
+        })
+
+    except BUSY_ERRORS as e:
+        return busy_response(e)
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error: {str(e)}'})
+
+
+@app.route('/api/face_crop/<crop_id>')
+async def face_crop(crop_id):
+    jpeg = await offload(service.crop_cache.get_jpeg, crop_id)
+    if jpeg is None:
+        return jsonify({'success': False, 'message': 'Preview expired or not found'}), 404
+    return Response(jpeg, mimetype='image/jpeg', headers={'Cache-Control': 'private, max-age=60'})
+
+
+@app.route('/api/stream/start', methods=['POST'])
+async def stream_start():
+    session_id = service.live_hub.open()
+    if session_id is None:
+        return busy_response('too many live sessions')
+    return jsonify({'success': True, 'session_id': session_id})
+
+
+@app.route('/api/stream/<session_id>/frame', methods=['POST'])
+async def stream_frame(session_id):
+    frame_bytes = await request.get_data()
+    if not frame_bytes:
+        return jsonify({'success': False, 'message': 'Frame required'}), 400
+    if not service.live_hub.push_frame(session_id, frame_bytes):
+        return jsonify({'success': False, 'message': 'Unknown stream session'}), 404
+    return jsonify({'success': True}), 202
+
+
+@app.route('/api/stream/<session_id>/events')
+async def stream_events(session_id):
+    if service.live_hub.get(session_id) is None:
+        return jsonify({'success': False, 'message': 'Unknown stream session'}), 404
+    response = Response(service.live_hub.events_async(session_id), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.timeout = None
+    return response
+
+
+@app.route('/api/stream/<session_id>/stop', methods=['POST'])
+async def stream_stop(session_id):
+    service.live_hub.close(session_id)
+    return jsonify({'success': True})
+
+
+@app.route('/api/register_face', methods=['POST'])
+async def register_face():
+    try:
+        image_bytes, data = await read_image_request_async(request)
+        username = data.get('username')
+
+        if not username or not image_bytes:
+            return jsonify({'success': False, 'message': 'Username and image required'})
+
+        print(f"\n👤 [REGISTRATION] Starting face registration for user: {username}")
+
+        with metrics.span('db_find_user'):
+            existing_user = await within_deadline(users_collection.find_one({'username': username}, {'_id': 1}))
+        if existing_user:
+            print(f"❌ [REGISTRATION] User '{username}' already exists")
+            return jsonify({'success': False, 'message': 'Username already exists'})
+
+        face, bbox, preview_fields = await offload(
+            service.get_face_from_image_bytes, image_bytes, data.get('crop'), data.get('crop_quality'))
+
+        if face is None:
+            print(f"❌ [REGISTRATION] No face detected for user '{username}'")
+            return jsonify({'success': False, 'message': 'No face detected in image'})
+        embedding = face.normed_embedding
+
+        user_data = service.new_user_document(username, embedding, bbox, service.template_quality(face))
+        with metrics.span('db_insert'):
+            try:
+                result = await within_deadline(users_collection.insert_one(user_data))
+            except DuplicateKeyError:
+                print(f"❌ [REGISTRATION] User '{username}' was registered concurrently")
+                return jsonify({'success': False, 'message': 'Username already exists'})
+        await offload(service.gallery.add, username, embedding)
+
+        print(f"✅ [REGISTRATION] User '{username}' registered successfully!")
+        print(f"📊 [REGISTRATION] Database ID: {result.inserted_id}")
+
+        return jsonify({
+            'success': True,
+            'message': 'Face registered successfully',
+            'bbox': bbox.tolist() if bbox is not None else None,
+            **preview_fields
+        })
+
+    except BUSY_ERRORS as e:
+        return busy_response(e)
+    except Exception as e:
+        print(f"💥 [REGISTRATION] ERROR: {str(e)}")
+        return jsonify({'success': False, 'message': f'Error: {str(e)}'})
+
+
+@app.route('/api/register_batch', methods=['POST'])
+async def register_batch():
+    try:
+        entries = await read_batch_request_async(request)
+        error = service.batch_request_error(entries)
+        if error:
+            return jsonify({'success': False, 'message': error})
+
+        print(f"\n👥 [BATCH REGISTRATION] Registering {len(entries)} users")
+
+        usernames = [username for username, _ in entries if username]
+        with metrics.span('db_find_user'):
+            users = await within_deadline(
+                users_collection.find({'username': {'$in': usernames}}, {'_id': 0, 'username': 1}).to_list(None))
+        errors = service.batch_entry_errors(entries, {user['username'] for user in users})
+
+        documents, rows = await offload(service.embed_batch, entries, errors)
+
+        failed = {}
+        if documents:
+            with metrics.span('db_insert'):
+                try:
+                    await within_deadline(users_collection.insert_many(documents, ordered=False))
+                except BulkWriteError as e:
+                    failed = write_errors(e)
+        body = await offload(service.finish_batch, entries, errors, documents, rows, failed)
+
+        print(f"✅ [BATCH REGISTRATION] {body['message']}")
+        return jsonify(body)
+
+    except BUSY_ERRORS as e:
+        return busy_response(e)
+    except Exception as e:
+        print(f"💥 [BATCH REGISTRATION] ERROR: {str(e)}")
+        return jsonify({'success': False, 'message': f'Error: {str(e)}'})
+
+
+@app.route('/api/add_template', methods=['POST'])
+async def add_template():
+    try:
+        image_bytes, data = await read_image_request_async(request)
+        username = data.get('username')
+
+        if not username or not image_bytes:
+            return jsonify({'success': False, 'message': 'Username and image required'})
+
+        print(f"\n🧩 [TEMPLATE] Adding a face template for user: {username}")
+
+        with metrics.span('db_find_user'):
+            user = await within_deadline(users_collection.find_one({'username': username},
+                                                                   service.USER_TEMPLATE_FIELDS))
+        if not user:
+            return jsonify({'success': False, 'message': 'User not found'})
+
+        face, bbox, preview_fields = await offload(
+            service.get_face_from_image_bytes, image_bytes, data.get('crop'), data.get('crop_quality'))
+        if face is None:
+            return jsonify({'success': False, 'message': 'No face detected in image'})
+
+        plan = service.plan_template_update(user, face.normed_embedding, service.template_quality(face))
+        if not plan['accepted']:
+            print(f"❌ [TEMPLATE] {plan['message']} (similarity {plan['similarity']:.4f})")
+            return jsonify({'success': False, 'message': plan['message'], 'similarity': plan['similarity']})
+
+        with metrics.span('db_update'):
+            result = await within_deadline(users_collection.update_one(
+                {'username': username, 'template_revision': user.get('template_revision')}, {'$set': plan['set']}))
+        if result.modified_count == 0:
+            return jsonify({'success': False, 'message': 'Templates changed during the update, please retry'})
+        await offload(service.gallery.update, username, plan['centroid'], plan['templates'], plan['revision'])
+
+        print(f"✅ [TEMPLATE] {plan['message']} for user '{username}'")
+        return jsonify({
+            'success': True,
+            'message': plan['message'],
+            'similarity': plan['similarity'],
+            'templates': len(plan['templates']),
+            'bbox': bbox.tolist() if bbox is not None else None,
+            **preview_fields
+        })
+
+    except BUSY_ERRORS as e:
+        return busy_response(e)
+    except Exception as e:
+        print(f"💥 [TEMPLATE] ERROR: {str(e)}")
+        return jsonify({'success': False, 'message': f'Error: {str(e)}'})
+
+
+@app.route('/api/verify_face', methods=['POST'])
+async def verify_face():
+    try:
+        image_bytes, data = await read_image_request_async(request)
+
+        if not image_bytes:
+            return jsonify({'success': False, 'message': 'Image required'})
+
+        test_embedding, bbox, preview_fields = await offload(
+            service.get_embedding_from_image_bytes, image_bytes, data.get('crop'), data.get('crop_quality'))
+
+        if test_embedding is None:
+            print("❌ [VERIFICATION] No face detected in verification image")
+            return jsonify({'success': False, 'message': 'No face detected in image'})
+
+        similarity_threshold = 0.25  # Updated to optimal threshold from analysis
+        best_username, best_similarity, top_scores = await offload(
+            service.match_embedding, test_embedding, similarity_threshold)
+
+        if best_username:
+            print(f"✅ [VERIFICATION] SUCCESSFUL! User '{best_username}' verified with {best_similarity:.4f} similarity")
+            return jsonify({
+                'success': True,
+                'message': f'Welcome back, {best_username}!',
+                'username': best_username,
+                'similarity': float(best_similarity),
+                'bbox': bbox.tolist() if bbox is not None else None,
+                **preview_fields
+            })
+
+        print(f"❌ [VERIFICATION] MATCH NOT FOUND! Best similarity: {best_similarity:.4f} "
+              f"(threshold {similarity_threshold}, {len(service.gallery)} users)")
+        return jsonify({
+            'success': False,
+            'message': 'Face not recognized',
+            'similarity': float(best_similarity) if best_similarity > 0 else 0,
+            'threshold': float(similarity_threshold),
+            'top_scores': top_scores,
+            'bbox': bbox.tolist() if bbox is not None else None,
+            **preview_fields
+        })
+
+    except BUSY_ERRORS as e:
+        return busy_response(e)
+    except Exception as e:
+        print(f"💥 [VERIFICATION] ERROR: {str(e)}")
+        return jsonify({'success': False, 'message': f'Error: {str(e)}'})
+
+
+@app.route('/api/identify_faces', methods=['POST'])
+async def identify_faces():
+    try:
+        image_bytes, _ = await read_image_request_async(request)
+
+        if not image_bytes:
+            return jsonify({'success': False, 'message': 'Image required'})
+
+        similarity_threshold = 0.25
+        faces = await offload(service.identify_image_bytes, image_bytes, similarity_threshold)
+        if faces is None:
+            return jsonify({'success': False, 'message': 'Invalid image'})
+        if not faces:
+            return jsonify({'success': False, 'message': 'No face detected in image'})
+
+        recognized = [face['username'] for face in faces if face['matched']]
+        print(f"🔍 [IDENTIFICATION] {len(recognized)} of {len(faces)} faces recognized: {recognized}")
+        return jsonify({
+            'success': bool(recognized),
+            'message': f'{len(recognized)} of {len(faces)} faces recognized',
+            'threshold': float(similarity_threshold),
+            'faces': faces
+        })
+
+    except BUSY_ERRORS as e:
+        return busy_response(e)
+    except Exception as e:
+        print(f"💥 [IDENTIFICATION] ERROR: {str(e)}")
+        return jsonify({'success': False, 'message': f'Error: {str(e)}'})
+
+
+@app.route('/api/inference_stats')
+async def inference_stats():
+    stats = service.collect_inference_stats()
+    stats['offload_threads'] = OFFLOAD_THREADS
+    return jsonify({'success': True, 'stats': stats})
+
+
+@app.route('/metrics')
+async def prometheus_metrics():
+    return Response(metrics.render_prometheus(service.pool_gauges()), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/api/metrics')
+async def metrics_summary():
+    return jsonify({'success': True, 'metrics': metrics.snapshot()})
+
+
+@app.route('/healthz')
+async def healthz():
+    live, _, details = service.health_report()
+    return jsonify({'status': 'ok' if live else 'failed', **details}), 200 if live else 503
+
+
+@app.route('/readyz')
+async def readyz():
+    _, ready, details = service.health_report()
+    if users_collection is None:
+        ready = False
+    return jsonify({'status': 'ready' if ready else 'starting', **details}), 200 if ready else 503
+
+
+@app.route('/api/get_users')
+async def get_users():
+    try:
+        cursor = users_collection.find({}, {'username': 1, 'registered_at': 1, '_id': 0})
+        users = await within_deadline(cursor.to_list(length=None))
+        return jsonify({'success': True, 'users': users})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error: {str(e)}'})
+
+
+async def serve():
+    """Run under hypercorn with graceful shutdown on SIGTERM / SIGINT"""
+    from hypercorn.asyncio import serve as hypercorn_serve
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = [ASGI_BIND]
+    config.graceful_timeout = GRACEFUL_TIMEOUT
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    async def shutdown_trigger():
+        await stop.wait()
+        print("Signal received: draining requests and closing live streams...")
+        service.live_hub.close_all()  # Open event streams would otherwise hold the drain
+
+    await hypercorn_serve(app, config, shutdown_trigger=shutdown_trigger)
+
+
+if __name__ == '__main__':
+    print(f"Starting Face Authorization System (ASGI) on {ASGI_BIND}...")
+    asyncio.run(serve())
@@ -0,0 +1,281 @@
+"""
+1:N identification benchmark: how /api/verify_face scales with the gallery.
+
+    python benchmark_identification.py --sizes 1000 10000 100000 1000000
+    python benchmark_identification.py --source dataset --datasets dataset1 dataset2
+    python benchmark_identification.py --index ivf --threads 4
+    python benchmark_identification.py --shards 4 --threads 4
+
+Production does not compare pairs: every login searches the whole gallery
+and accepts the best user when the similarity is above 0.25. This script
+replays probes through the same EmbeddingGallery.identify() call used by
+app.match_embedding() (same top-k, same ANN re-ranking) while the gallery
+grows, and reports per-probe latency percentiles, throughput, memory and the
+decision quality at each size:
+
+- rank-1: enrolled probes whose best candidate is the right user
+- identification rate: enrolled probes accepted as the right user
+- false accept rate: probes of people who never registered that are
+  accepted as someone; this is what grows with the gallery
+
+Enrolled identities are either synthetic (unit vectors, probes drawn at a
+genuine similarity matching the test datasets) or real people from the test
+datasets (first image enrolled, the others used as probes, a share of the
+people held out as impostors). The gallery is filled up to each size with
+random distractor identities. With --shards the gallery is partitioned over
+local shard processes (sharded_gallery.py) and every probe is scattered to
+all of them; memory is then the sum over the shards, and peak RSS only
+covers this coordinator process. Random 512-d vectors are closer to orthogonal
+than real ArcFace embeddings, so the synthetic false accept rate is a lower
+bound; the dataset source gives the realistic genuine/impostor scores.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from ann_index import IVFIndex, default_nlist
+from gallery import EmbeddingGallery, EMBEDDING_DIM
+from sharded_gallery import ShardedGallery
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Same search settings as app.py
+VERIFY_TOP_K = int(os.environ.get('VERIFY_TOP_K', 5))
+ANN_RERANK_K = int(os.environ.get('ANN_RERANK_K', 50))
+IVF_NLIST = int(os.environ.get('IVF_NLIST', 0))  # 0: ~sqrt(gallery size)
+IVF_NPROBE = int(os.environ.get('IVF_NPROBE', 32))
+
+
+def random_unit_vectors(rng, count, dim=EMBEDDING_DIM):
+    vectors = rng.standard_normal((count, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def probe_at_similarity(rng, template, similarity):
+    """A unit vector whose cosine similarity to the unit template is `similarity`"""
+    noise = rng.standard_normal(template.shape, dtype=np.float32)
+    noise -= np.dot(noise, template) * template
+    noise /= np.linalg.norm(noise)
+    return similarity * template + np.sqrt(1.0 - similarity ** 2) * noise
+
+
+def synthetic_identities(rng, identities, probes, genuine_mean, genuine_std):
+    """
+    (usernames, templates, genuine probes, impostor probes) for synthetic people.
+
+    Genuine probes are [(username, embedding)], impostor probes are
+    embeddings of people who are not enrolled.
+    """
+    usernames = [f"user_{i:07d}" for i in range(identities)]
+    templates = random_unit_vectors(rng, identities)
+    genuine = []
+    for index in rng.integers(0, identities, probes):
+        similarity = float(np.clip(rng.normal(genuine_mean, genuine_std), -0.99, 0.99))
+        genuine.append((usernames[index], probe_at_similarity(rng, templates[index], similarity)))
+    impostors = list(random_unit_vectors(rng, probes))
+    return usernames, templates, genuine, impostors
+
+
+def dataset_identities(rng, datasets, holdout):
+    """Same as synthetic_identities() with the real people of the test datasets"""
+    from embedding_cache import EmbeddingCache
+    from face_models import model_version
+    from parallel_embedding import ParallelEmbedder
+    from test_datasets import (load_dataset_embeddings, EMBEDDING_CACHE_DIR, USE_EMBEDDING_CACHE,
+                               EMBEDDING_WORKERS, EMBEDDING_THREADS_PER_WORKER)
+
+    cache = EmbeddingCache(EMBEDDING_CACHE_DIR, model_version()) if USE_EMBEDDING_CACHE else None
+    embedder = ParallelEmbedder(EMBEDDING_WORKERS, EMBEDDING_THREADS_PER_WORKER) if EMBEDDING_WORKERS > 1 else None
+    people = []
+    try:
+        for dataset in datasets:
+            if not os.path.exists(dataset):
+                print(f"Warning: Dataset '{dataset}' not found!")
+                continue
+            embeddings_db, _ = load_dataset_embeddings(dataset, cache=cache, embedder=embedder)
+            people.extend((f"{dataset}/{person_id}", [e['embedding'] for e in entries])
+                          for person_id, entries in embeddings_db.items())
+    finally:
+        if embedder is not None:
+            embedder.close()
+    if not people:
+        raise SystemExit(f"No embedded images found in {datasets}")
+
+    order = rng.permutation(len(people))
+    held_out = set(order[:int(round(len(people) * holdout))].tolist())
+    usernames, templates, genuine, impostors = [], [], [], []
+    for index, (username, embeddings) in enumerate(people):
+        if index in held_out:
+            impostors.extend(embeddings)
+            continue
+        usernames.append(username)
+        templates.append(embeddings[0])
+        genuine.extend((username, embedding) for embedding in embeddings[1:])
+    return usernames, np.asarray(templates, dtype=np.float32), genuine, impostors
+
+
+def grow_gallery(gallery, size, rng, chunk_size=65536):
+    """Fill the gallery with random distractor identities up to `size`"""
+    while len(gallery) < size:
+        count = min(chunk_size, size - len(gallery))
+        start = len(gallery)
+        gallery.add_many([f"distractor_{i:07d}" for i in range(start, start + count)],
+                         random_unit_vectors(rng, count))
+
+
+def replay(gallery, probes, threshold, k, threads=1):
+    """
+    Run every probe through gallery.identify().
+
+    Returns ([(top-1 username, accepted username or None, latency s)], wall time s).
+    """
+    def run(probe):
+        started = time.perf_counter()
+        username, _, _, usernames = gallery.identify(probe, threshold=threshold, k=k)
+        latency = time.perf_counter() - started
+        return (usernames[0] if usernames else None), username, latency
+
+    started = time.perf_counter()
+    if threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            outcomes = list(pool.map(run, probes))
+    else:
+        outcomes = [run(probe) for probe in probes]
+    return outcomes, time.perf_counter() - started
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def benchmark_size(gallery, genuine, impostors, threshold, k, threads):
+    """Latency, throughput and decision rates for the gallery at its current size"""
+    probes = [embedding for _, embedding in genuine] + list(impostors)
+    replay(gallery, probes[:min(len(probes), 10)], threshold, k)  # Warm caches and BLAS threads
+    outcomes, wall = replay(gallery, probes, threshold, k, threads)
+
+    latencies = np.array([latency for _, _, latency in outcomes]) * 1000
+    genuine_outcomes = outcomes[:len(genuine)]
+    impostor_outcomes = outcomes[len(genuine):]
+    rank1 = sum(top1 == expected for (expected, _), (top1, _, _) in zip(genuine, genuine_outcomes))
+    identified = sum(accepted == expected for (expected, _), (_, accepted, _) in zip(genuine, genuine_outcomes))
+    misidentified = sum(accepted is not None and accepted != expected
+                        for (expected, _), (_, accepted, _) in zip(genuine, genuine_outcomes))
+    false_accepts = sum(accepted is not None for _, accepted, _ in impostor_outcomes)
+
+    return {
+        'gallery_size': len(gallery),
+        'probes': len(probes),
+        'latency_ms': {
+            'mean': float(latencies.mean()),
+            'p50': float(np.percentile(latencies, 50)),
+            'p95': float(np.percentile(latencies, 95)),
+            'p99': float(np.percentile(latencies, 99)),
+            'max': float(latencies.max()),
+        },
+        'throughput_per_s': len(probes) / wall,
+        'memory_bytes': {
+            'gallery': gallery.nbytes(),
+            'index': gallery.index.nbytes() if gallery.index is not None else 0,
+            'peak_rss': peak_rss_bytes(),
+        },
+        'rank1': rank1 / max(len(genuine), 1),
+        'identification_rate': identified / max(len(genuine), 1),
+        'misidentification_rate': misidentified / max(len(genuine), 1),
+        'false_accept_rate': false_accepts / max(len(impostors), 1),
+        'false_accepts': int(false_accepts),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark 1:N identification as the gallery grows')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--source', choices=['synthetic', 'dataset'], default='synthetic')
+    parser.add_argument('--datasets', nargs='+', default=['dataset1', 'dataset2'])
+    parser.add_argument('--holdout', type=float, default=0.3,
+                        help='Share of dataset people kept out of the gallery as impostors')
+    parser.add_argument('--identities', type=int, default=1000, help='Enrolled synthetic people with probes')
+    parser.add_argument('--probes', type=int, default=500, help='Synthetic genuine and impostor probes each')
+    parser.add_argument('--genuine-mean', type=float, default=0.53, help='Synthetic same-person similarity')
+    parser.add_argument('--genuine-std', type=float, default=0.14)
+    parser.add_argument('--threshold', type=float, default=0.25)
+    parser.add_argument('--index', choices=['flat', 'ivf'], default='flat')
+    parser.add_argument('--threads', type=int, default=1, help='Concurrent probe threads')
+    parser.add_argument('--shards', type=int, default=0, help='Local shard processes (0: in-process gallery)')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    if args.shards and args.index == 'ivf':
+        parser.error("--index ivf is not supported with --shards (shards search exactly)")
+
+    rng = np.random.default_rng(args.seed)
+    if args.source == 'synthetic':
+        usernames, templates, genuine, impostors = synthetic_identities(
+            rng, args.identities, args.probes, args.genuine_mean, args.genuine_std)
+    else:
+        usernames, templates, genuine, impostors = dataset_identities(rng, args.datasets, args.holdout)
+    print(f"{len(usernames)} enrolled identities, {len(genuine)} genuine probes, {len(impostors)} impostor probes")
+
+    gallery = ShardedGallery.spawn(args.shards) if args.shards else EmbeddingGallery()
+    gallery.add_many(usernames, templates)
+    k = max(VERIFY_TOP_K, 1)
+    if args.index == 'ivf':
+        k = max(k, ANN_RERANK_K)
+
+    report = {'source': args.source, 'threshold': args.threshold, 'index': args.index, 'top_k': k,
+              'threads': args.threads, 'shards': args.shards, 'results': []}
+    for size in sorted(args.sizes):
+        if size < len(usernames):
+            print(f"Skipping size {size:,}: smaller than the {len(usernames)} enrolled identities")
+            continue
+        gallery.index = None  # Rebuilt below over the grown gallery
+        started = time.perf_counter()
+        grow_gallery(gallery, size, rng)
+        grow_seconds = time.perf_counter() - started
+
+        index_seconds = None
+        nlist = IVF_NLIST or default_nlist(size)
+        if args.index == 'ivf' and size >= nlist:
+            started = time.perf_counter()
+            gallery.attach_index(IVFIndex(nlist=nlist, nprobe=IVF_NPROBE))
+            index_seconds = time.perf_counter() - started
+
+        print(f"\nGallery size {size:,}" + (f" (IVF built in {index_seconds:.1f}s)" if index_seconds else ""))
+        result = benchmark_size(gallery, genuine, impostors, args.threshold, k, args.threads)
+        result['grow_seconds'] = grow_seconds
+        result['index_build_seconds'] = index_seconds
+        report['results'].append(result)
+
+        latency = result['latency_ms']
+        print(f"  latency p50 {latency['p50']:.2f} ms, p95 {latency['p95']:.2f} ms, p99 {latency['p99']:.2f} ms, "
+              f"{result['throughput_per_s']:.0f} probes/s")
+        print(f"  rank-1 {result['rank1']:.2%}, identified {result['identification_rate']:.2%}, "
+              f"misidentified {result['misidentification_rate']:.2%}, "
+              f"false accepts {result['false_accept_rate']:.2%} ({result['false_accepts']})")
+        memory = result['memory_bytes']
+        print(f"  gallery {memory['gallery'] / 1e6:.1f} MB, index {memory['index'] / 1e6:.1f} MB"
+              + (f", peak RSS {memory['peak_rss'] / 1e6:.0f} MB" if memory['peak_rss'] else ""))
+
+    if args.shards:
+        gallery.close()
+
+    filename = f"identification_benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nDetailed results saved to: {filename}")
+
+
+if __name__ == '__main__':
+    main()
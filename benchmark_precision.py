@@ -0,0 +1,146 @@
+"""
+Compare FP32 and INT8 face models: speed and verification accuracy.
+
+    python quantize_models.py                # create the int8 copies first
+    python benchmark_precision.py --precisions fp32 int8
+
+For every precision the detector + ArcFace models are loaded, every image of
+the datasets is embedded (timing model.get() only), and the pairs are
+evaluated with the test_datasets.py metrics. Only images embedded under all
+precisions are used and pairs are sampled with the same seed, so every
+precision is scored on exactly the same pairs. Also reports how close the
+reduced-precision embeddings stay to FP32 ones, which matters because the
+gallery in MongoDB was enrolled with FP32 embeddings.
+"""
+import argparse
+import json
+import os
+import random
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from face_models import load_face_analysis
+from evaluation import threshold_metrics
+from test_datasets import load_dataset_embeddings, evaluate_embeddings
+
+
+def timed_embedding(model, timings):
+    """embed_fn for load_dataset_embeddings that records model.get() latency"""
+    def embed(image_path):
+        img = cv2.imread(str(image_path))
+        if img is None:
+            return None
+        started = time.perf_counter()
+        faces = model.get(img)
+        timings.append(time.perf_counter() - started)
+        return faces[0].normed_embedding if faces else None
+    return embed
+
+
+def common_images(embeddings_by_precision):
+    """Restrict every precision's embeddings to the images all precisions embedded"""
+    common = None
+    for embeddings_db in embeddings_by_precision.values():
+        paths = {entry['path'] for entries in embeddings_db.values() for entry in entries}
+        common = paths if common is None else common & paths
+    restricted = {}
+    for precision, embeddings_db in embeddings_by_precision.items():
+        db = {}
+        for person_id, entries in embeddings_db.items():
+            kept = sorted((e for e in entries if e['path'] in common), key=lambda e: e['path'])
+            if kept:
+                db[person_id] = kept
+        restricted[precision] = dict(sorted(db.items()))
+    return restricted
+
+
+def embedding_agreement(baseline_db, other_db):
+    """Cosine similarity between the baseline and other embedding of each image"""
+    baseline = {e['path']: e['embedding'] for entries in baseline_db.values() for e in entries}
+    sims = np.array([float(np.dot(baseline[e['path']], e['embedding']))
+                     for entries in other_db.values() for e in entries])
+    return {'mean': float(sims.mean()), 'min': float(sims.min()), 'p05': float(np.percentile(sims, 5))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark reduced-precision face models')
+    parser.add_argument('--datasets', nargs='+', default=['dataset1', 'dataset2'])
+    parser.add_argument('--precisions', nargs='+', default=['fp32', 'int8'])
+    parser.add_argument('--num-pairs', type=int, default=100)
+    parser.add_argument('--threshold', type=float, default=0.25)
+    parser.add_argument('--threads', type=int, default=0, help='ONNX Runtime intra-op threads (0 = all cores)')
+    args = parser.parse_args()
+
+    datasets = [d for d in args.datasets if os.path.exists(d)]
+    if not datasets:
+        raise SystemExit(f"No datasets found among {args.datasets}")
+
+    timings = {}
+    embeddings = {dataset: {} for dataset in datasets}
+    for precision in args.precisions:
+        print(f"\n{'='*80}\nPrecision: {precision}\n{'='*80}")
+        model = load_face_analysis(det_size=(640, 640), intra_op_threads=args.threads,
+                                   allowed_modules=['detection', 'recognition'], precision=precision)
+        timings[precision] = []
+        for dataset in datasets:
+            embeddings_db, _ = load_dataset_embeddings(dataset, timed_embedding(model, timings[precision]))
+            embeddings[dataset][precision] = embeddings_db
+
+    baseline = args.precisions[0]
+    report = {'threshold': args.threshold, 'baseline': baseline, 'precisions': {}}
+    for precision in args.precisions:
+        latencies = np.array(timings[precision]) * 1000
+        report['precisions'][precision] = {
+            'images': int(len(latencies)),
+            'latency_ms': {'mean': float(latencies.mean()), 'p50': float(np.percentile(latencies, 50)),
+                           'p95': float(np.percentile(latencies, 95))},
+            'datasets': {},
+        }
+    for precision in args.precisions:
+        report['precisions'][precision]['speedup'] = (
+            report['precisions'][baseline]['latency_ms']['mean'] / report['precisions'][precision]['latency_ms']['mean'])
+
+    for dataset in datasets:
+        restricted = common_images(embeddings[dataset])
+        for precision in args.precisions:
+            random.seed(42)  # Same pairs for every precision
+            results, pos_sims, neg_sims = evaluate_embeddings(dataset, restricted[precision], [], args.num_pairs)
+            entry = {
+                'positive_similarities': results['positive_similarities'],
+                'negative_similarities': results['negative_similarities'],
+                'at_threshold': threshold_metrics(pos_sims, neg_sims, args.threshold),
+                'best_threshold': results['best_threshold'],
+                'best_accuracy': results['best_accuracy'],
+            }
+            if precision != baseline:
+                entry['embedding_agreement'] = embedding_agreement(restricted[baseline], restricted[precision])
+            report['precisions'][precision]['datasets'][dataset] = entry
+
+    print(f"\n{'='*80}\nPRECISION BENCHMARK (threshold {args.threshold})\n{'='*80}")
+    for precision, summary in report['precisions'].items():
+        latency = summary['latency_ms']
+        print(f"\n{precision}: {latency['mean']:.1f} ms/image (p95 {latency['p95']:.1f} ms), "
+              f"speedup x{summary['speedup']:.2f}")
+        for dataset, entry in summary['datasets'].items():
+            base = report['precisions'][baseline]['datasets'][dataset]
+            pos, neg = entry['positive_similarities'], entry['negative_similarities']
+            print(f"  {dataset}: accuracy {entry['at_threshold']['accuracy']:.2%} "
+                  f"(baseline {base['at_threshold']['accuracy']:.2%}), "
+                  f"positive mean {pos['mean']:.4f} ({pos['mean'] - base['positive_similarities']['mean']:+.4f}), "
+                  f"negative mean {neg['mean']:.4f} ({neg['mean'] - base['negative_similarities']['mean']:+.4f})")
+            if 'embedding_agreement' in entry:
+                agreement = entry['embedding_agreement']
+                print(f"    cosine to {baseline} embeddings: mean {agreement['mean']:.4f}, "
+                      f"p05 {agreement['p05']:.4f}, min {agreement['min']:.4f}")
+
+    filename = f"precision_benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nDetailed results saved to: {filename}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+"""
+Bulk enrollment of a folder laid out like dataset1: one sub-folder per
+person, named after the username, holding that person's photos.
+
+    python bulk_enroll.py dataset1                              # embed here, write to MongoDB
+    python bulk_enroll.py dataset1 --prefix acme_ --dry-run     # only report what would happen
+    python bulk_enroll.py dataset1 --url http://localhost:5000  # through /api/register_batch
+
+Direct mode (default) looks up which usernames already exist with a single
+$in query, embeds the photos of the new people with a ParallelEmbedder
+process pool, and writes the users with unordered insert_many batches
+(the unique username index rejects users registered meanwhile). Up
+to --max-templates photos per person are embedded; they become the user's
+templates and their centroid the searchable embedding (see
+face_templates.py). A running server loads its gallery at startup, so it
+only sees users enrolled this way after a restart.
+
+--url mode sends --batch-size people per /api/register_batch request
+instead; the server embeds each batch in parallel on its inference pool,
+writes it the same way and adds it to its live gallery in one update.
+Batches rejected with 503 (server busy) are retried. A --dry-run checks
+the usernames against the server's /api/get_users instead.
+"""
+import argparse
+import base64
+import json
+import mimetypes
+import os
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from embedding_codec import STORAGE_DTYPES
+from face_templates import new_user_document
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.bmp']
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+def ensure_username_index(collection):
+    """
+    Unique index on 'username', so concurrent or repeated registrations of
+    the same username are rejected with a duplicate key error instead of
+    creating two users. Returns False when existing duplicates prevent it.
+    """
+    try:
+        collection.create_index('username', unique=True)
+        return True
+    except OperationFailure as e:
+        print(f"⚠️ Could not create the unique username index (duplicate usernames stored?): {e}")
+        return False
+
+
+def existing_usernames(collection, usernames):
+    """The subset of `usernames` already registered, found with a single $in query"""
+    query = {'username': {'$in': list(usernames)}}
+    return {user['username'] for user in collection.find(query, {'_id': 0, 'username': 1})}
+
+
+def write_errors(error):
+    """{index in the batch: message} of the documents an unordered insert_many rejected"""
+    return {
+        item['index']: ('Username already exists' if item.get('code') == DUPLICATE_KEY_ERROR
+                        else f"Error: {item.get('errmsg', 'write failed')}")
+        for item in error.details.get('writeErrors', [])
+    }
+
+
+def insert_users(collection, documents, batch_size=1000):
+    """
+    Insert user documents with unordered insert_many batches: a rejected
+    document (e.g. a duplicate username under a unique index) does not
+    stop the others. Returns {index in `documents`: message} of the
+    documents that were not inserted.
+    """
+    failed = {}
+    for start in range(0, len(documents), batch_size):
+        try:
+            collection.insert_many(documents[start:start + batch_size], ordered=False)
+        except BulkWriteError as e:
+            failed.update({start + index: message for index, message in write_errors(e).items()})
+    return failed
+
+
+def load_people(folder, prefix='', max_images=5):
+    """[(username, [image paths])] for every sub-folder holding images, sorted by name"""
+    people = []
+    for person in sorted(p for p in Path(folder).iterdir() if p.is_dir()):
+        images = sorted(p for p in person.iterdir() if p.suffix.lower() in IMAGE_EXTENSIONS)
+        if images:
+            people.append((prefix + person.name, images[:max_images]))
+    return people
+
+
+def enroll_direct(people, collection, args):
+    """Embed locally and write to MongoDB; returns {username: message} of the people not enrolled"""
+    from parallel_embedding import ParallelEmbedder
+
+    started = time.perf_counter()
+    taken = existing_usernames(collection, [username for username, _ in people])
+    print(f"🔎 {len(taken)} usernames already registered ({time.perf_counter() - started:.2f}s)")
+    skipped = {username: 'Username already exists' for username in taken}
+    people = [(username, paths) for username, paths in people if username not in taken]
+    if args.dry_run or not people:
+        return skipped
+
+    paths = [path for _, person_paths in people for path in person_paths]
+    det_size = int(os.environ.get('FACE_DETECTION_SIZE', 640))
+    with ParallelEmbedder(workers=args.workers, threads_per_worker=args.threads_per_worker,
+                          det_size=(det_size, det_size), precision=os.environ.get('MODEL_PRECISION', 'fp32'),
+                          face_selection=os.environ.get('FACE_SELECTION', 'largest')) as embedder:
+        results = iter(embedder.embed_paths(paths, desc="Embedding enrollment photos", details=True))
+
+    documents = []
+    for username, person_paths in people:
+        faces = [face for face in (next(results) for _ in person_paths) if face is not None]
+        if not faces:
+            skipped[username] = 'No face detected in image'
+            continue
+        embeddings, bboxes, qualities = zip(*faces)
+        best = max(range(len(faces)), key=lambda i: qualities[i])
+        documents.append(new_user_document(username, embeddings, qualities, bboxes[best],
+                                           args.dtype, args.max_templates))
+
+    started = time.perf_counter()
+    failed = insert_users(collection, documents, args.write_batch_size)
+    print(f"💾 Inserted {len(documents) - len(failed)} users ({time.perf_counter() - started:.2f}s)")
+    skipped.update({documents[index]['username']: message for index, message in failed.items()})
+    return skipped
+
+
+def data_url(path):
+    content_type = mimetypes.guess_type(path.name)[0] or 'image/jpeg'
+    return f"data:{content_type};base64,{base64.b64encode(path.read_bytes()).decode()}"
+
+
+def post_batch(url, batch, timeout, retries=5):
+    """POST one batch to /api/register_batch, retrying while the server is busy"""
+    body = json.dumps({'users': [
+        {'username': username, 'images': [data_url(path) for path in paths]} for username, paths in batch
+    ]}).encode()
+    for attempt in range(retries + 1):
+        request = urllib.request.Request(url + '/api/register_batch', data=body, method='POST',
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            if e.code != 503 or attempt == retries:
+                raise
+            time.sleep(float(e.headers.get('Retry-After') or 1))
+
+
+def registered_usernames(url, timeout):
+    """Every username registered on the server, from /api/get_users"""
+    with urllib.request.urlopen(url + '/api/get_users', timeout=timeout) as response:
+        payload = json.loads(response.read())
+    if not payload.get('success'):
+        raise RuntimeError(f"Could not list the server's users: {payload.get('message')}")
+    return {user['username'] for user in payload['users']}
+
+
+def enroll_remote(people, url, args):
+    """Enroll through the batch API; returns {username: message} of the people not enrolled"""
+    url = url.rstrip('/')
+    if args.dry_run:
+        # Same duplicate check as the server would make, without sending any photo
+        taken = registered_usernames(url, args.timeout) & {username for username, _ in people}
+        print(f"🔎 {len(taken)} usernames already registered on {url}")
+        return {username: 'Username already exists' for username in taken}
+
+    skipped = {}
+    for start in range(0, len(people), args.batch_size):
+        batch = people[start:start + args.batch_size]
+        payload = post_batch(url, batch, args.timeout)
+        results = payload.get('results') or [{'username': username, 'success': False,
+                                              'message': payload.get('message')} for username, _ in batch]
+        skipped.update({result['username']: result['message'] for result in results if not result['success']})
+        print(f"  {min(start + len(batch), len(people))}/{len(people)} people sent: {payload.get('message')}")
+    return skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Enroll every person of a dataset-style folder")
+    parser.add_argument('folder', help='Folder with one sub-folder of photos per person')
+    parser.add_argument('--prefix', default='', help='Prefix added to every username')
+    parser.add_argument('--max-templates', type=int, default=int(os.environ.get('MAX_TEMPLATES', 5)),
+                        help='Photos embedded per person (kept as templates)')
+    parser.add_argument('--dry-run', action='store_true', help='Only report who would be enrolled')
+    parser.add_argument('--url', help='Enroll through /api/register_batch of this server instead of MongoDB')
+    parser.add_argument('--batch-size', type=int, default=20, help='People per batch request (--url)')
+    parser.add_argument('--timeout', type=float, default=120.0, help='Batch request timeout in seconds (--url)')
+    parser.add_argument('--uri', default=os.environ.get('MONGO_URI', 'mongodb://localhost:27017/'),
+                        help='MongoDB connection string')
+    parser.add_argument('--db', default=os.environ.get('MONGO_DB', 'face_auth_db'), help='Database name')
+    parser.add_argument('--collection', default='users', help='Collection name')
+    parser.add_argument('--dtype', default=os.environ.get('EMBEDDING_STORAGE_DTYPE', 'float32'),
+                        choices=sorted(STORAGE_DTYPES), help='Embedding storage dtype')
+    parser.add_argument('--write-batch-size', type=int, default=1000, help='Documents per insert_many')
+    parser.add_argument('--workers', type=int, help='Embedding worker processes (default: cores / threads)')
+    parser.add_argument('--threads-per-worker', type=int, default=1, help='ONNX Runtime threads per worker')
+    args = parser.parse_args()
+
+    people = load_people(args.folder, args.prefix, args.max_templates)
+    if not people:
+        raise SystemExit(f"No person folders with images found in {args.folder}")
+    photos = sum(len(paths) for _, paths in people)
+    print(f"👥 {len(people)} people with {photos} photos in {args.folder}")
+
+    start = time.perf_counter()
+    if args.url:
+        skipped = enroll_remote(people, args.url, args)
+    else:
+        collection = MongoClient(args.uri)[args.db][args.collection]
+        if not args.dry_run:
+            ensure_username_index(collection)
+        skipped = enroll_direct(people, collection, args)
+    elapsed = time.perf_counter() - start
+
+    for username, message in sorted(skipped.items()):
+        print(f"  ❌ {username}: {message}")
+    if args.dry_run:
+        print(f"Dry run: {len(people) - len(skipped)} of {len(people)} people would be enrolled")
+        return
+    enrolled = len(people) - len(skipped)
+    print(f"✅ Enrolled {enrolled} of {len(people)} people in {elapsed:.1f}s "
+          f"({enrolled / max(elapsed, 1e-9):.1f} people/s)")
+    if enrolled and not args.url:
+        print("Restart running servers to load the new users into their gallery")
+
+
+if __name__ == '__main__':
+    main()
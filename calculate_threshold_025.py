@@ -1,8 +1,11 @@
 import json
+import sys
 import numpy as np
+from evaluation import threshold_metrics
 
-# Load the test results
-with open('test_results_20251024_231038.json', 'r') as f:
+# Load the test results (newer files from test_datasets.py carry raw similarities)
+results_filename = sys.argv[1] if len(sys.argv) > 1 else 'test_results_20251024_231038.json'
+with open(results_filename, 'r') as f:
     results = json.load(f)
 
 print("="*80)
@@ -33,92 +36,113 @@ for dataset_results in results:
     print(f"  Same person similarities: mean={pos_mean:.4f}, min={pos_min:.4f}, max={pos_max:.4f}")
     print(f"  Different person similarities: mean={neg_mean:.4f}, min={neg_min:.4f}, max={neg_max:.4f}")
     
-    # Estimate metrics for threshold 0.25
-    # At threshold 0.25, we expect:
-    # - Very high recall (almost all positive pairs above 0.25)
-    # - Still good precision (negative pairs are mostly below 0.25)
-    
-    # Estimate TP: percentage of positive pairs above 0.25
-    # Since mean is ~0.53 and min is 0.05-0.13, and distribution is roughly normal
-    # We can estimate that ~98-99% of positive pairs are above 0.25
-    
-    # For dataset1: min=0.051, mean=0.532, std=0.144
-    # For dataset2: min=0.131, mean=0.543, std=0.137
-    
-    # Calculate z-score for threshold 0.25
-    z_score_pos = (0.25 - pos_mean) / pos_std
-    z_score_neg = (0.25 - neg_mean) / neg_std
-    
-    print(f"  Z-score for threshold 0.25: positive={z_score_pos:.2f}, negative={z_score_neg:.2f}")
-    
-    # Estimate recall (percentage of positive pairs with similarity >= 0.25)
-    # Using normal distribution approximation
-    from scipy import stats
-    
-    # For positive pairs (same person)
-    # Probability that similarity >= 0.25
-    recall_estimate = 1 - stats.norm.cdf(z_score_pos)
-    tp_estimate = int(round(recall_estimate * 100))  # Out of 100 pairs
-    fn_estimate = 100 - tp_estimate
-    
-    # For negative pairs (different persons)
-    # Probability that similarity < 0.25 (correctly rejected)
-    tn_probability = stats.norm.cdf(z_score_neg)
-    tn_estimate = int(round(tn_probability * 100))  # Out of 100 pairs
-    fp_estimate = 100 - tn_estimate
-    
-    # However, we know from the data that max negative similarity is 0.24 and 0.19
-    # So all negative pairs should be below 0.25
-    if neg_max < 0.25:
-        tn_estimate = 100
-        fp_estimate = 0
-        print(f"  All negative pairs below 0.25 (max={neg_max:.4f}), setting TN=100, FP=0")
-    
-    # Adjust TP based on minimum positive similarity
-    if pos_min > 0.25:
-        tp_estimate = 100
-        fn_estimate = 0
-        print(f"  All positive pairs above 0.25 (min={pos_min:.4f}), setting TP=100, FN=0")
-    elif pos_min < 0.25:
-        # Some positive pairs might be below 0.25
-        # Estimate conservatively
-        print(f"  Some positive pairs below 0.25 (min={pos_min:.4f})")
-        # Using the distribution, estimate how many
-        if dataset_name == 'dataset1':
-            # min=0.051, so there's at least one very low similarity
-            # Conservatively estimate 2-3 pairs below 0.25
-            tp_estimate = 98
-            fn_estimate = 2
-        else:  # dataset2
-            # min=0.131, closer to 0.25, estimate 1 pair below
-            tp_estimate = 99
-            fn_estimate = 1
-    
-    # Calculate metrics
-    accuracy = (tp_estimate + tn_estimate) / 200.0
-    precision = tp_estimate / (tp_estimate + fp_estimate) if (tp_estimate + fp_estimate) > 0 else 1.0
-    recall = tp_estimate / (tp_estimate + fn_estimate) if (tp_estimate + fn_estimate) > 0 else 1.0
-    f1_score = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0.0
-    
-    threshold_25_result = {
-        'threshold': 0.25,
-        'accuracy': accuracy,
-        'precision': precision,
-        'recall': recall,
-        'f1_score': f1_score,
-        'tp': tp_estimate,
-        'tn': tn_estimate,
-        'fp': fp_estimate,
-        'fn': fn_estimate
-    }
-    
-    print(f"\n  Estimated metrics for threshold 0.25:")
+    raw = dataset_results.get('raw_similarities')
+    if raw is not None:
+        # Exact: recount the confusion matrix from the saved similarities
+        threshold_25_result = threshold_metrics(raw['positive'], raw['negative'], 0.25)
+        accuracy = threshold_25_result['accuracy']
+        precision = threshold_25_result['precision']
+        recall = threshold_25_result['recall']
+        f1_score = threshold_25_result['f1_score']
+        tp_estimate, fn_estimate = threshold_25_result['tp'], threshold_25_result['fn']
+        fp_estimate, tn_estimate = threshold_25_result['fp'], threshold_25_result['tn']
+        print("  Raw similarities available: computing threshold 0.25 exactly")
+    else:
+        # Older result files only have summary statistics: estimate
+        # Estimate metrics for threshold 0.25
+        # At threshold 0.25, we expect:
+        # - Very high recall (almost all positive pairs above 0.25)
+        # - Still good precision (negative pairs are mostly below 0.25)
+    
+        # Estimate TP: percentage of positive pairs above 0.25
+        # Since mean is ~0.53 and min is 0.05-0.13, and distribution is roughly normal
+        # We can estimate that ~98-99% of positive pairs are above 0.25
+    
+        # For dataset1: min=0.051, mean=0.532, std=0.144
+        # For dataset2: min=0.131, mean=0.543, std=0.137
+    
+        # Calculate z-score for threshold 0.25
+        z_score_pos = (0.25 - pos_mean) / pos_std
+        z_score_neg = (0.25 - neg_mean) / neg_std
+    
+        print(f"  Z-score for threshold 0.25: positive={z_score_pos:.2f}, negative={z_score_neg:.2f}")
+    
+        # Estimate recall (percentage of positive pairs with similarity >= 0.25)
+        # Using normal distribution approximation
+        from scipy import stats
+    
+        # For positive pairs (same person)
+        # Probability that similarity >= 0.25
+        recall_estimate = 1 - stats.norm.cdf(z_score_pos)
+        tp_estimate = int(round(recall_estimate * 100))  # Out of 100 pairs
+        fn_estimate = 100 - tp_estimate
+    
+        # For negative pairs (different persons)
+        # Probability that similarity < 0.25 (correctly rejected)
+        tn_probability = stats.norm.cdf(z_score_neg)
+        tn_estimate = int(round(tn_probability * 100))  # Out of 100 pairs
+        fp_estimate = 100 - tn_estimate
+    
+        # However, we know from the data that max negative similarity is 0.24 and 0.19
+        # So all negative pairs should be below 0.25
+        if neg_max < 0.25:
+            tn_estimate = 100
+            fp_estimate = 0
+            print(f"  All negative pairs below 0.25 (max={neg_max:.4f}), setting TN=100, FP=0")
+    
+        # Adjust TP based on minimum positive similarity
+        if pos_min > 0.25:
+            tp_estimate = 100
+            fn_estimate = 0
+            print(f"  All positive pairs above 0.25 (min={pos_min:.4f}), setting TP=100, FN=0")
+        elif pos_min < 0.25:
+            # Some positive pairs might be below 0.25
+            # Estimate conservatively
+            print(f"  Some positive pairs below 0.25 (min={pos_min:.4f})")
+            # Using the distribution, estimate how many
+            if dataset_name == 'dataset1':
+                # min=0.051, so there's at least one very low similarity
+                # Conservatively estimate 2-3 pairs below 0.25
+                tp_estimate = 98
+                fn_estimate = 2
+            else:  # dataset2
+                # min=0.131, closer to 0.25, estimate 1 pair below
+                tp_estimate = 99
+                fn_estimate = 1
+    
+        # Calculate metrics
+        accuracy = (tp_estimate + tn_estimate) / 200.0
+        precision = tp_estimate / (tp_estimate + fp_estimate) if (tp_estimate + fp_estimate) > 0 else 1.0
+        recall = tp_estimate / (tp_estimate + fn_estimate) if (tp_estimate + fn_estimate) > 0 else 1.0
+        f1_score = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0.0
+    
+        threshold_25_result = {
+            'threshold': 0.25,
+            'accuracy': accuracy,
+            'precision': precision,
+            'recall': recall,
+            'f1_score': f1_score,
+            'tp': tp_estimate,
+            'tn': tn_estimate,
+            'fp': fp_estimate,
+            'fn': fn_estimate
+        }
+    
+    print(f"\n  Metrics for threshold 0.25:")
     print(f"    Accuracy: {accuracy*100:.2f}%")
     print(f"    Precision: {precision*100:.2f}%")
     print(f"    Recall: {recall*100:.2f}%")
     print(f"    F1 Score: {f1_score*100:.2f}%")
     print(f"    TP={tp_estimate}, FN={fn_estimate}, FP={fp_estimate}, TN={tn_estimate}")
-    
+
+    exhaustive = dataset_results.get('exhaustive')
+    if exhaustive is not None and abs(exhaustive['at_threshold']['threshold'] - 0.25) < 1e-9:
+        # Every pair was scored (evaluation.py): exact operating point, not a sample
+        at = exhaustive['at_threshold']
+        print(f"  All {exhaustive['genuine_pairs'] + exhaustive['impostor_pairs']:,} pairs at 0.25: "
+              f"FAR {at['far']*100:.4f}%, FRR {at['frr']*100:.4f}% "
+              f"(EER {exhaustive['eer']*100:.2f}% at {exhaustive['eer_threshold']:.4f})")
+
     # Insert threshold 0.25 at the beginning of threshold_results
     new_threshold_results = [threshold_25_result] + dataset_results['threshold_results']
     
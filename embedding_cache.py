@@ -0,0 +1,129 @@
+"""
+On-disk cache of face embeddings for the offline evaluation scripts.
+
+Embeddings are keyed by the SHA-1 of the image file content, so renamed or
+copied images are still hits, and stored per model version, so switching
+packs, precision or detector size never mixes embeddings. Layout:
+
+    <root>/<model_version>/embeddings.npy   float32 N x 512, opened memory-mapped
+    <root>/<model_version>/index.json       {sha1: row}, row -1 = no face found
+
+New embeddings are kept in memory until flush(), which writes a new matrix
+next to the old one and swaps both files in atomically.
+"""
+import hashlib
+import json
+import os
+import os.path as osp
+
+import numpy as np
+
+NO_FACE = -1
+
+
+def file_sha1(path, chunk_size=1 << 20):
+    """SHA-1 of a file's content"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Content-addressed embedding store for one model version.
+
+    Args:
+        root: Cache directory
+        model_version: Identifier of the models producing the embeddings
+        dim: Embedding dimension
+    """
+
+    def __init__(self, root='embedding_cache', model_version='default', dim=512):
+        self.dim = dim
+        self.model_version = model_version
+        self.directory = osp.join(root, model_version)
+        self.matrix_path = osp.join(self.directory, 'embeddings.npy')
+        self.index_path = osp.join(self.directory, 'index.json')
+        self._index = {}
+        self._matrix = np.empty((0, dim), dtype=np.float32)
+        self._pending = []
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def _load(self):
+        if not (osp.exists(self.index_path) and osp.exists(self.matrix_path)):
+            return
+        with open(self.index_path) as f:
+            self._index = json.load(f)
+        self._matrix = np.load(self.matrix_path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def get(self, key):
+        """
+        (found, embedding) for a content hash; embedding is None when the
+        image is cached as having no face
+        """
+        row = self._index.get(key)
+        if row is None:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        if row == NO_FACE:
+            return True, None
+        if row < len(self._matrix):
+            return True, self._matrix[row]
+        return True, self._pending[row - len(self._matrix)]
+
+    def put(self, key, embedding):
+        """Record the embedding (or None for 'no face') of an image hash"""
+        if key in self._index:
+            return
+        if embedding is None:
+            self._index[key] = NO_FACE
+            return
+        self._index[key] = len(self._matrix) + len(self._pending)
+        self._pending.append(np.asarray(embedding, dtype=np.float32).reshape(self.dim))
+
+    def embed(self, image_path, embed_fn):
+        """Cached embed_fn(image_path), keyed by the image content"""
+        key = file_sha1(image_path)
+        found, embedding = self.get(key)
+        if not found:
+            embedding = embed_fn(image_path)
+            self.put(key, embedding)
+        return embedding
+
+    def flush(self):
+        """Persist pending embeddings and the index"""
+        os.makedirs(self.directory, exist_ok=True)
+        if self._pending:
+            rows = len(self._matrix) + len(self._pending)
+            partial = self.matrix_path + '.tmp.npy'
+            matrix = np.lib.format.open_memmap(partial, mode='w+', dtype=np.float32, shape=(rows, self.dim))
+            matrix[:len(self._matrix)] = self._matrix
+            matrix[len(self._matrix):] = np.stack(self._pending)
+            matrix.flush()
+            del matrix
+            self._matrix = None  # Release the old mapping before replacing the file
+            os.replace(partial, self.matrix_path)
+            self._matrix = np.load(self.matrix_path, mmap_mode='r')
+            self._pending = []
+        elif not osp.exists(self.matrix_path):
+            np.save(self.matrix_path, self._matrix)
+
+        partial = self.index_path + '.tmp'
+        with open(partial, 'w') as f:
+            json.dump(self._index, f)
+        os.replace(partial, self.index_path)
+
+    def stats(self):
+        return {'model_version': self.model_version, 'entries': len(self._index),
+                'embeddings': len(self._matrix) + len(self._pending), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,65 @@
+"""
+Storage format for face embeddings in MongoDB.
+
+Embeddings are written as raw little-endian float32 (or float16) bytes in a
+BSON Binary field, next to the dtype and a format version, instead of a BSON
+array of 512 doubles. Reading is a zero-copy np.frombuffer over the stored
+bytes. Documents written before this format (plain float lists) are still
+decoded, so the gallery works during and after migrate_embeddings.py.
+"""
+import numpy as np
+from bson.binary import Binary
+
+EMBEDDING_FORMAT_VERSION = 1
+
+# Stored dtype name -> explicit little-endian numpy dtype
+STORAGE_DTYPES = {
+    'float32': np.dtype('<f4'),
+    'float16': np.dtype('<f2'),
+}
+
+# Fields to project when an embedding has to be decoded
+EMBEDDING_FIELDS = {'embedding': 1, 'embedding_dtype': 1, 'embedding_version': 1}
+
+# Multi-template users (see face_templates.py): 'embedding' holds the centroid
+# and 'templates' a list of {embedding fields, 'quality', 'added_at'}
+TEMPLATE_FIELDS = {'templates': 1, 'template_revision': 1}
+
+
+def encode_embedding(embedding, dtype='float32'):
+    """Return the document fields storing `embedding` in binary form"""
+    if dtype not in STORAGE_DTYPES:
+        raise ValueError(f"Unsupported embedding dtype '{dtype}', expected one of {sorted(STORAGE_DTYPES)}")
+    array = np.ascontiguousarray(np.asarray(embedding).reshape(-1), dtype=STORAGE_DTYPES[dtype])
+    return {
+        'embedding': Binary(array.tobytes()),
+        'embedding_dtype': dtype,
+        'embedding_version': EMBEDDING_FORMAT_VERSION,
+    }
+
+
+def decode_embedding(document):
+    """
+    Read the embedding of a user document as a 1-D numpy array.
+
+    Binary embeddings are returned as a read-only view of the stored bytes;
+    legacy list embeddings are converted to float32.
+    """
+    raw = document['embedding']
+    if isinstance(raw, bytes):  # bson.Binary is a bytes subclass
+        dtype = STORAGE_DTYPES[document.get('embedding_dtype', 'float32')]
+        return np.frombuffer(raw, dtype=dtype)
+    return np.asarray(raw, dtype=np.float32)
+
+
+def decode_templates(document):
+    """
+    The enrollment templates of a user document as an (n x D) float32 array.
+
+    Documents without a 'templates' list (single-template users registered
+    before multi-template enrollment) have their embedding as only template.
+    """
+    templates = document.get('templates')
+    if not templates:
+        return decode_embedding(document).astype(np.float32)[None, :]
+    return np.stack([decode_embedding(template) for template in templates]).astype(np.float32)
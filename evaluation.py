@@ -0,0 +1,283 @@
+"""
+Exhaustive verification evaluation: every genuine and impostor pair.
+
+    python evaluation.py --datasets dataset1 dataset2
+
+Instead of sampling 100 + 100 pairs, all N*(N-1)/2 pairs of embedded images
+are scored with a blocked matrix multiply (the temporary score block is
+block_size x N floats; the kept scores cost 4 bytes per pair). The ROC and
+DET curves are then exact: scores are sorted once and true/false accept
+counts at every distinct threshold come from a cumulative sum, so EER,
+FRR@FAR and FAR@FRR are read off real data rather than estimated from a
+normal approximation as in calculate_threshold_025.py.
+"""
+import argparse
+import json
+import os
+from datetime import datetime
+from statistics import NormalDist
+
+import numpy as np
+
+TARGET_FARS = (1e-1, 1e-2, 1e-3, 1e-4, 1e-5, 1e-6)
+TARGET_FRRS = (1e-1, 5e-2, 2e-2, 1e-2, 1e-3)
+
+
+def stack_embeddings(embeddings_db):
+    """(L2-normalised float32 matrix, integer identity labels, paths) from a test_datasets embeddings_db"""
+    rows, labels, paths = [], [], []
+    for label, (person_id, entries) in enumerate(embeddings_db.items()):
+        for entry in entries:
+            rows.append(entry['embedding'])
+            labels.append(label)
+            paths.append(entry['path'])
+    matrix = np.asarray(rows, dtype=np.float32)
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    return matrix, np.asarray(labels), paths
+
+
+def pair_scores(matrix, labels, block_size=2048):
+    """
+    Scores of all unordered pairs, split into (genuine, impostor) float32 arrays.
+
+    Rows are processed in blocks against the rows after them, so the
+    temporary similarity block never exceeds block_size x N.
+    """
+    n = len(matrix)
+    genuine, impostor = [], []
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        block = matrix[start:stop] @ matrix[start:].T
+        # Keep only pairs (i, j) with j > i
+        upper = np.arange(start, n)[None, :] > np.arange(start, stop)[:, None]
+        same = labels[start:stop, None] == labels[None, start:]
+        genuine.append(block[upper & same])
+        impostor.append(block[upper & ~same])
+    return np.concatenate(genuine), np.concatenate(impostor)
+
+
+def roc_curve(genuine, impostor):
+    """
+    Exact ROC over every distinct score, accepting pairs with score >= threshold.
+
+    Returns a dict of arrays: thresholds (descending), far, frr, tar (= 1 - frr).
+    The first point (threshold +inf) accepts nothing.
+    """
+    scores = np.concatenate([genuine, impostor])
+    is_genuine = np.concatenate([np.ones(len(genuine), dtype=bool), np.zeros(len(impostor), dtype=bool)])
+    order = np.argsort(-scores, kind='stable')
+    scores = scores[order]
+    true_accepts = np.cumsum(is_genuine[order])
+    false_accepts = np.arange(1, len(scores) + 1) - true_accepts
+
+    # Last position of each run of equal scores = counts at that threshold
+    last = np.r_[np.nonzero(np.diff(scores))[0], len(scores) - 1]
+    tar = np.r_[0.0, true_accepts[last] / max(len(genuine), 1)]
+    far = np.r_[0.0, false_accepts[last] / max(len(impostor), 1)]
+    return {
+        'thresholds': np.r_[np.inf, scores[last]],
+        'far': far,
+        'tar': tar,
+        'frr': 1.0 - tar,
+    }
+
+
+def equal_error_rate(roc):
+    """(EER, threshold) where FAR and FRR cross, linearly interpolated"""
+    diff = roc['far'] - roc['frr']  # Rises from -1 to +1 as the threshold drops
+    i = int(np.argmax(diff >= 0))
+    if i == 0:
+        return float(roc['far'][0]), float(roc['thresholds'][0])
+    d0, d1 = diff[i - 1], diff[i]
+    t = 0.0 if d1 == d0 else -d0 / (d1 - d0)
+    eer = roc['far'][i - 1] + t * (roc['far'][i] - roc['far'][i - 1])
+    threshold = roc['thresholds'][i - 1] if np.isinf(roc['thresholds'][i - 1]) else (
+        roc['thresholds'][i - 1] + t * (roc['thresholds'][i] - roc['thresholds'][i - 1]))
+    return float(eer), float(threshold)
+
+
+def frr_at_far(roc, target_far):
+    """Lowest FRR (and its threshold) with FAR <= target_far"""
+    i = int(np.searchsorted(roc['far'], target_far, side='right')) - 1
+    return float(roc['frr'][i]), float(roc['thresholds'][i])
+
+
+def far_at_frr(roc, target_frr):
+    """Lowest FAR (and its threshold) with FRR <= target_frr"""
+    i = int(np.argmax(roc['frr'] <= target_frr))
+    return float(roc['far'][i]), float(roc['thresholds'][i])
+
+
+def rates_at_threshold(genuine, impostor, threshold):
+    """FAR / FRR / accept counts at one threshold, from sorted scores"""
+    genuine_sorted = np.sort(genuine)
+    impostor_sorted = np.sort(impostor)
+    false_rejects = int(np.searchsorted(genuine_sorted, threshold, side='left'))
+    false_accepts = len(impostor_sorted) - int(np.searchsorted(impostor_sorted, threshold, side='left'))
+    return {
+        'threshold': float(threshold),
+        'far': false_accepts / max(len(impostor), 1),
+        'frr': false_rejects / max(len(genuine), 1),
+        'false_accepts': false_accepts,
+        'false_rejects': false_rejects,
+    }
+
+
+def threshold_metrics(positive_similarities, negative_similarities, threshold):
+    """Confusion matrix, accuracy, precision, recall and F1 at one threshold"""
+    positive_similarities = np.asarray(positive_similarities)
+    negative_similarities = np.asarray(negative_similarities)
+    # True Positives: positive pairs with similarity >= threshold
+    tp = int(np.count_nonzero(positive_similarities >= threshold))
+    # False Negatives: positive pairs with similarity < threshold
+    fn = len(positive_similarities) - tp
+    # True Negatives: negative pairs with similarity < threshold
+    tn = int(np.count_nonzero(negative_similarities < threshold))
+    # False Positives: negative pairs with similarity >= threshold
+    fp = len(negative_similarities) - tn
+
+    accuracy = (tp + tn) / (tp + tn + fp + fn) if (tp + tn + fp + fn) > 0 else 0
+    precision = tp / (tp + fp) if (tp + fp) > 0 else 0
+    recall = tp / (tp + fn) if (tp + fn) > 0 else 0
+    f1_score = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
+
+    return {
+        'threshold': float(threshold),
+        'accuracy': float(accuracy),
+        'precision': float(precision),
+        'recall': float(recall),
+        'f1_score': float(f1_score),
+        'tp': int(tp),
+        'tn': int(tn),
+        'fp': int(fp),
+        'fn': int(fn)
+    }
+
+
+def det_points(roc, max_points=500):
+    """DET curve (FAR, FRR and their normal deviates) thinned to at most max_points"""
+    keep = np.unique(np.linspace(0, len(roc['far']) - 1, min(max_points, len(roc['far']))).astype(int))
+    far, frr = roc['far'][keep], roc['frr'][keep]
+    probit = np.vectorize(lambda p: NormalDist().inv_cdf(min(max(p, 1e-9), 1 - 1e-9)))
+    return {
+        'thresholds': roc['thresholds'][keep],
+        'far': far,
+        'frr': frr,
+        'far_deviate': probit(far),
+        'frr_deviate': probit(frr),
+    }
+
+
+def evaluate(embeddings_db, threshold=0.25, block_size=2048):
+    """Exhaustive pair evaluation of one dataset; returns (summary dict, roc)"""
+    matrix, labels, _ = stack_embeddings(embeddings_db)
+    genuine, impostor = pair_scores(matrix, labels, block_size)
+    roc = roc_curve(genuine, impostor)
+    eer, eer_threshold = equal_error_rate(roc)
+    summary = {
+        'num_images': int(len(matrix)),
+        'num_identities': int(len(embeddings_db)),
+        'genuine_pairs': int(len(genuine)),
+        'impostor_pairs': int(len(impostor)),
+        'genuine_scores': {'mean': float(genuine.mean()), 'std': float(genuine.std()),
+                           'min': float(genuine.min()), 'max': float(genuine.max())},
+        'impostor_scores': {'mean': float(impostor.mean()), 'std': float(impostor.std()),
+                            'min': float(impostor.min()), 'max': float(impostor.max())},
+        'eer': eer,
+        'eer_threshold': eer_threshold,
+        'at_threshold': rates_at_threshold(genuine, impostor, threshold),
+        # Targets below 1 / impostor_pairs cannot be resolved by this data
+        'frr_at_far': [dict(zip(('far', 'frr', 'threshold'), (far,) + frr_at_far(roc, far)))
+                       for far in TARGET_FARS if far * len(impostor) >= 1],
+        'far_at_frr': [dict(zip(('frr', 'far', 'threshold'), (frr,) + far_at_frr(roc, frr)))
+                       for frr in TARGET_FRRS if frr * len(genuine) >= 1],
+    }
+    return summary, roc
+
+
+def plot_curves(rocs, filename):
+    """ROC (log FAR) and DET (normal deviate axes) plots for several datasets"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, (ax_roc, ax_det) = plt.subplots(1, 2, figsize=(14, 6))
+    for name, roc in rocs.items():
+        det = det_points(roc)
+        ax_roc.plot(np.maximum(det['far'], 1e-7), 1 - det['frr'], label=name)
+        ax_det.plot(det['far_deviate'], det['frr_deviate'], label=name)
+    ax_roc.set_xscale('log')
+    ax_roc.set_xlabel('False Accept Rate')
+    ax_roc.set_ylabel('True Accept Rate')
+    ax_roc.set_title('ROC')
+    ticks = [1e-4, 1e-3, 1e-2, 0.05, 0.2, 0.5]
+    deviates = [NormalDist().inv_cdf(p) for p in ticks]
+    ax_det.set_xticks(deviates)
+    ax_det.set_xticklabels([f"{p:g}" for p in ticks])
+    ax_det.set_yticks(deviates)
+    ax_det.set_yticklabels([f"{p:g}" for p in ticks])
+    ax_det.set_xlabel('False Accept Rate')
+    ax_det.set_ylabel('False Reject Rate')
+    ax_det.set_title('DET')
+    for ax in (ax_roc, ax_det):
+        ax.grid(True, alpha=0.3)
+        ax.legend()
+    plt.tight_layout()
+    plt.savefig(filename, dpi=150, bbox_inches='tight')
+    plt.close(fig)
+
+
+def print_report(name, summary):
+    print(f"\n{'─'*80}\nDataset: {name}\n{'─'*80}")
+    print(f"Images: {summary['num_images']} ({summary['num_identities']} identities)")
+    print(f"Pairs:  {summary['genuine_pairs']:,} genuine, {summary['impostor_pairs']:,} impostor")
+    print(f"EER:    {summary['eer']:.4%} at threshold {summary['eer_threshold']:.4f}")
+    at = summary['at_threshold']
+    print(f"At threshold {at['threshold']}: FAR {at['far']:.4%} ({at['false_accepts']:,} false accepts), "
+          f"FRR {at['frr']:.4%} ({at['false_rejects']:,} false rejects)")
+    for point in summary['frr_at_far']:
+        print(f"  FRR @ FAR {point['far']:g}: {point['frr']:.4%} (threshold {point['threshold']:.4f})")
+    for point in summary['far_at_frr']:
+        print(f"  FAR @ FRR {point['frr']:g}: {point['far']:.4%} (threshold {point['threshold']:.4f})")
+
+
+def main():
+    from test_datasets import (load_dataset_embeddings, EMBEDDING_CACHE_DIR, USE_EMBEDDING_CACHE,
+                               EMBEDDING_WORKERS, EMBEDDING_THREADS_PER_WORKER)
+    from embedding_cache import EmbeddingCache
+    from face_models import model_version
+    from parallel_embedding import ParallelEmbedder
+
+    parser = argparse.ArgumentParser(description='Exhaustive ROC/DET evaluation of the face models')
+    parser.add_argument('--datasets', nargs='+', default=['dataset1', 'dataset2'])
+    parser.add_argument('--threshold', type=float, default=0.25)
+    parser.add_argument('--block-size', type=int, default=2048)
+    args = parser.parse_args()
+
+    cache = EmbeddingCache(EMBEDDING_CACHE_DIR, model_version()) if USE_EMBEDDING_CACHE else None
+    embedder = ParallelEmbedder(EMBEDDING_WORKERS, EMBEDDING_THREADS_PER_WORKER) if EMBEDDING_WORKERS > 1 else None
+    summaries, rocs = {}, {}
+    try:
+        for dataset in args.datasets:
+            if not os.path.exists(dataset):
+                print(f"\nWarning: Dataset '{dataset}' not found!")
+                continue
+            embeddings_db, _ = load_dataset_embeddings(dataset, cache=cache, embedder=embedder)
+            summaries[dataset], rocs[dataset] = evaluate(embeddings_db, args.threshold, args.block_size)
+            print_report(dataset, summaries[dataset])
+    finally:
+        if embedder is not None:
+            embedder.close()
+
+    if not summaries:
+        print("\nNo datasets found to evaluate!")
+        return
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    with open(f'evaluation_{timestamp}.json', 'w') as f:
+        json.dump(summaries, f, indent=2)
+    plot_curves(rocs, f'evaluation_curves_{timestamp}.png')
+    print(f"\nResults saved to evaluation_{timestamp}.json and evaluation_curves_{timestamp}.png")
+
+
+if __name__ == '__main__':
+    main()
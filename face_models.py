@@ -0,0 +1,239 @@
+"""
+Helpers for loading InsightFace models with explicit ONNX Runtime settings.
+
+Startup cost is kept down in three ways:
+
+- only the models a caller needs are opened. Files of the known packs are
+  mapped to their task by name, so e.g. the landmark and gender/age models
+  of buffalo_l never get an inference session when only detection and
+  recognition are used;
+- graph optimisation (constant folding, node fusions) is done once per
+  model and onnxruntime version and the optimised graph is cached on disk
+  (SessionOptions.optimized_model_filepath); later processes load the
+  cached graph instead of re-optimising;
+- warm_up() runs a dummy inference through every session so the first real
+  request does not pay for lazy allocations and kernel selection.
+
+With precision='int8' the sessions are created from the quantized copies
+that quantize_models.py writes to <pack>/int8/ (same file names), falling
+back to FP32 for models that have not been quantized.
+"""
+import glob
+import hashlib
+import os
+import os.path as osp
+import threading
+
+import numpy as np
+import onnxruntime
+from insightface.app import FaceAnalysis
+from insightface.model_zoo.arcface_onnx import ArcFaceONNX
+from insightface.model_zoo.attribute import Attribute
+from insightface.model_zoo.landmark import Landmark
+from insightface.model_zoo.retinaface import RetinaFace
+from insightface.utils import ensure_available
+
+# Task of each model file in the insightface packs (buffalo_l/m/s, antelopev2)
+MODEL_FILE_TASKS = {
+    'det_10g.onnx': 'detection',
+    'det_2.5g.onnx': 'detection',
+    'det_500m.onnx': 'detection',
+    'scrfd_10g_bnkps.onnx': 'detection',
+    'w600k_r50.onnx': 'recognition',
+    'w600k_mbf.onnx': 'recognition',
+    'glintr100.onnx': 'recognition',
+    '1k3d68.onnx': 'landmark_3d_68',
+    '2d106det.onnx': 'landmark_2d_106',
+    'genderage.onnx': 'genderage',
+}
+
+DEFAULT_CACHE_DIR = '~/.insightface/ort_cache'
+
+# Subdirectory of a model pack holding the quantized copies, by precision
+PRECISION_SUBDIRS = {'fp32': None, 'int8': 'int8'}
+
+
+def precision_model_path(onnx_file, precision='fp32'):
+    """Path of the onnx_file variant for a precision (the file itself for fp32)"""
+    if precision not in PRECISION_SUBDIRS:
+        raise ValueError(f"Unknown model precision '{precision}', expected one of {sorted(PRECISION_SUBDIRS)}")
+    subdir = PRECISION_SUBDIRS[precision]
+    if subdir is None:
+        return onnx_file
+    return osp.join(osp.dirname(onnx_file), subdir, osp.basename(onnx_file))
+
+
+def _cached_graph_path(onnx_file, cache_dir):
+    """Cache file for the optimised graph, keyed by source file and onnxruntime version"""
+    stat = os.stat(onnx_file)
+    key = hashlib.sha1(f"{osp.abspath(onnx_file)}:{stat.st_size}:{stat.st_mtime_ns}:"
+                       f"{onnxruntime.__version__}".encode()).hexdigest()[:12]
+    name = osp.splitext(osp.basename(onnx_file))[0]
+    return osp.join(cache_dir, f"{name}.{key}.opt.onnx")
+
+
+def create_session(onnx_file, providers=None, intra_op_threads=0, cache_dir=None):
+    """
+    InferenceSession for onnx_file with a fixed thread budget.
+
+    With cache_dir, the first load saves the graph optimised at the portable
+    ORT_ENABLE_EXTENDED level and later loads start from that file. The
+    hardware-specific layout passes of ORT_ENABLE_ALL are cheap and still run.
+    """
+    sess_options = onnxruntime.SessionOptions()
+    sess_options.intra_op_num_threads = intra_op_threads  # 0 lets onnxruntime decide
+    sess_options.inter_op_num_threads = 1
+    providers = providers or ['CPUExecutionProvider']
+
+    if cache_dir is None:
+        return onnxruntime.InferenceSession(onnx_file, sess_options, providers=providers)
+
+    cache_dir = osp.expanduser(cache_dir)
+    cached = _cached_graph_path(onnx_file, cache_dir)
+    if osp.exists(cached):
+        try:
+            return onnxruntime.InferenceSession(cached, sess_options, providers=providers)
+        except Exception as e:
+            print(f"Ignoring unreadable cached graph {cached}: {e}")
+
+    # Optimise once and save; written to a temporary file so concurrent
+    # workers never load a half-written graph
+    os.makedirs(cache_dir, exist_ok=True)
+    partial = f"{cached[:-len('.onnx')]}.{os.getpid()}.{threading.get_ident()}.tmp.onnx"
+    save_options = onnxruntime.SessionOptions()
+    save_options.intra_op_num_threads = 1
+    save_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+    save_options.optimized_model_filepath = partial
+    try:
+        onnxruntime.InferenceSession(onnx_file, save_options, providers=['CPUExecutionProvider'])
+        os.replace(partial, cached)
+        return onnxruntime.InferenceSession(cached, sess_options, providers=providers)
+    except Exception as e:
+        print(f"Could not cache optimised graph for {onnx_file}: {e}")
+        if osp.exists(partial):
+            os.remove(partial)
+        return onnxruntime.InferenceSession(onnx_file, sess_options, providers=providers)
+
+
+def model_version(name='buffalo_l', root='~/.insightface', precision='fp32', det_size=(640, 640),
+                  allowed_modules=('detection', 'recognition')):
+    """
+    Identifier of the models a face pipeline would load, computed from the
+    files on disk without creating sessions (for caches of model outputs)
+    """
+    model_dir = osp.join(osp.expanduser(root), 'models', name)
+    files = []
+    for onnx_file in sorted(glob.glob(osp.join(model_dir, '*.onnx'))):
+        task = MODEL_FILE_TASKS.get(osp.basename(onnx_file))
+        if task is not None and allowed_modules is not None and task not in allowed_modules:
+            continue
+        session_file = precision_model_path(onnx_file, precision)
+        if not osp.exists(session_file):
+            session_file = onnx_file
+        files.append(f"{osp.relpath(session_file, model_dir)}:{osp.getsize(session_file)}")
+    digest = hashlib.sha1('|'.join(files).encode()).hexdigest()[:10]
+    return f"{name}-{precision}-det{det_size[0]}x{det_size[1]}-{digest}"
+
+
+def route_model(onnx_file, session):
+    """
+    Wrap a session in its insightface model class, using the same input/output
+    rules as insightface's ModelRouter. Model metadata (e.g. ArcFace input
+    normalisation) is read from the original onnx_file, not the cached graph.
+    """
+    inputs = session.get_inputs()
+    input_shape = inputs[0].shape
+    outputs = session.get_outputs()
+
+    if len(outputs) >= 5:
+        return RetinaFace(model_file=onnx_file, session=session)
+    elif input_shape[2] == 192 and input_shape[3] == 192:
+        return Landmark(model_file=onnx_file, session=session)
+    elif input_shape[2] == 96 and input_shape[3] == 96:
+        return Attribute(model_file=onnx_file, session=session)
+    elif input_shape[2] == input_shape[3] and input_shape[2] >= 112 and input_shape[2] % 16 == 0:
+        return ArcFaceONNX(model_file=onnx_file, session=session)
+    return None
+
+
+def load_models(name='buffalo_l', root='~/.insightface', allowed_modules=None,
+                providers=None, intra_op_threads=0, cache_dir=None, precision='fp32'):
+    """
+    Load the models of a pack as {taskname: model} with an explicit thread budget.
+
+    insightface's model_zoo.get_model() drops session options, so every
+    session would otherwise size its intra-op pool to all cores; with several
+    models per process that oversubscribes the CPU. Sessions are created here
+    so SessionOptions reach onnxruntime, and files whose task is known not to
+    be in allowed_modules are skipped without opening them.
+    """
+    onnxruntime.set_default_logger_severity(3)
+
+    models = {}
+    model_dir = ensure_available('models', name, root=root)
+    for onnx_file in sorted(glob.glob(osp.join(model_dir, '*.onnx'))):
+        known_task = MODEL_FILE_TASKS.get(osp.basename(onnx_file))
+        if known_task is not None and (known_task in models or
+                                       (allowed_modules is not None and known_task not in allowed_modules)):
+            continue
+        session_file = precision_model_path(onnx_file, precision)
+        if not osp.exists(session_file):
+            print(f"No {precision} copy of {osp.basename(onnx_file)}, using fp32 (run quantize_models.py)")
+            session_file = onnx_file
+        session = create_session(session_file, providers, intra_op_threads, cache_dir)
+        model = route_model(onnx_file, session)
+        if model is None or model.taskname in models:
+            continue
+        if allowed_modules is not None and model.taskname not in allowed_modules:
+            continue
+        models[model.taskname] = model
+    return model_dir, models
+
+
+def warm_up(models, runs=1):
+    """Run dummy inferences through every model so first requests are not slowed by lazy init"""
+    for taskname, model in models.items():
+        for _ in range(runs):
+            if taskname == 'detection':
+                width, height = model.input_size or (640, 640)
+                model.detect(np.zeros((height, width, 3), dtype=np.uint8), max_num=1)
+            else:
+                width, height = model.input_size
+                blob = np.zeros((1, 3, height, width), dtype=np.float32)
+                model.session.run(model.output_names, {model.input_name: blob})
+
+
+class TunedFaceAnalysis(FaceAnalysis):
+    """FaceAnalysis built from load_models() so its sessions respect a thread budget"""
+
+    def __init__(self, name='buffalo_l', root='~/.insightface', allowed_modules=None,
+                 providers=None, intra_op_threads=0, cache_dir=None, precision='fp32'):
+        self.model_dir, self.models = load_models(name, root, allowed_modules, providers,
+                                                  intra_op_threads, cache_dir, precision)
+        if 'detection' not in self.models:
+            raise RuntimeError(f"No detection model found in {self.model_dir}")
+        self.det_model = self.models['detection']
+
+
+def load_face_analysis(det_size=(640, 640), intra_op_threads=0, allowed_modules=None,
+                       cache_dir=DEFAULT_CACHE_DIR, warm=True, precision='fp32'):
+    """Create, prepare and (optionally) warm up a face model with the given ONNX Runtime thread count"""
+    model = TunedFaceAnalysis(allowed_modules=allowed_modules, intra_op_threads=intra_op_threads,
+                              cache_dir=cache_dir, precision=precision)
+    model.prepare(ctx_id=0, det_size=det_size)
+    if warm:
+        warm_up(model.models)
+    return model
+
+
+def load_recognition_model(intra_op_threads=0, cache_dir=DEFAULT_CACHE_DIR, warm=True, precision='fp32'):
+    """Load, prepare and (optionally) warm up only the ArcFace recognition model"""
+    model_dir, models = load_models(allowed_modules=['recognition'], intra_op_threads=intra_op_threads,
+                                    cache_dir=cache_dir, precision=precision)
+    if 'recognition' not in models:
+        raise RuntimeError(f"No recognition model found in {model_dir}")
+    model = models['recognition']
+    model.prepare(ctx_id=0)
+    if warm:
+        warm_up(models)
+    return model
@@ -0,0 +1,47 @@
+"""
+Which face of a multi-face frame to use.
+
+FaceAnalysis returns faces in detector order, which says nothing about
+who is standing at the camera. Single-face endpoints pick one by policy,
+and multi-face identification processes faces in the same order:
+
+- largest: biggest bounding box (the person closest to the camera)
+- central: large and near the image centre; the ranking RetinaFace itself
+  uses for max_num (area minus twice the squared centre offset)
+- score: highest detection confidence
+- first: detector order
+"""
+import numpy as np
+
+FACE_SELECTION_POLICIES = ('largest', 'central', 'score', 'first')
+
+
+def _ranking_values(faces, image_shape, policy):
+    """Higher is better"""
+    bboxes = np.array([face.bbox[:4] for face in faces], dtype=np.float32)
+    areas = (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+    if policy == 'largest':
+        return areas
+    if policy == 'central':
+        height, width = image_shape[:2]
+        centers = (bboxes[:, :2] + bboxes[:, 2:]) / 2 - np.array([width / 2, height / 2], dtype=np.float32)
+        return areas - 2.0 * np.sum(centers ** 2, axis=1)
+    if policy == 'score':
+        return np.array([face.det_score for face in faces], dtype=np.float32)
+    if policy == 'first':
+        return -np.arange(len(faces), dtype=np.float32)
+    raise ValueError(f"Unknown face selection policy '{policy}', expected one of {FACE_SELECTION_POLICIES}")
+
+
+def rank_faces(faces, image_shape, policy='largest'):
+    """Faces sorted best first according to the policy"""
+    if len(faces) < 2:
+        return list(faces)
+    order = np.argsort(-_ranking_values(faces, image_shape, policy), kind='stable')
+    return [faces[i] for i in order]
+
+
+def select_face(faces, image_shape, policy='largest'):
+    """The face the policy prefers, or None when there is none"""
+    ranked = rank_faces(faces, image_shape, policy)
+    return ranked[0] if ranked else None
@@ -0,0 +1,83 @@
+"""
+Multi-template enrollment.
+
+A user can hold up to MAX_TEMPLATES face templates instead of the single
+registration photo. The user document keeps the templates with a quality
+score, and its 'embedding' field holds their centroid (normalized mean), so
+the gallery still searches one row per user and only re-scores its best
+candidates against their individual templates (see gallery.py).
+
+Once the cap is reached a new template replaces the lowest-quality one, and
+only when it is better, so a poor first photo is pushed out over time
+instead of degrading every login. Bulk enrollment (see bulk_enroll.py) can
+start a user with several photos at once; the best MAX_TEMPLATES are kept.
+"""
+from datetime import datetime
+
+import numpy as np
+
+from embedding_codec import encode_embedding
+
+
+def template_quality(face, min_face_size=112):
+    """
+    Detection confidence scaled down for faces smaller than the ArcFace
+    input (their crops are upsampled and carry less detail)
+    """
+    x1, y1, x2, y2 = face.bbox[:4]
+    size = min(x2 - x1, y2 - y1)
+    return float(face.det_score) * float(min(1.0, max(size, 0) / min_face_size))
+
+
+def centroid(templates):
+    """Normalized mean of the normalized templates"""
+    templates = np.asarray(templates, dtype=np.float32).reshape(len(templates), -1)
+    templates = templates / np.maximum(np.linalg.norm(templates, axis=1, keepdims=True), 1e-12)
+    mean = templates.mean(axis=0)
+    return mean / max(np.linalg.norm(mean), 1e-12)
+
+
+def place_template(qualities, quality, max_templates):
+    """
+    Where a new template of the given quality goes among existing ones.
+
+    Returns ('append', None), ('replace', index of the worst template) or
+    ('reject', None) when the set is full and the new template is not
+    better than the worst one. Unknown qualities (None) count as 0.
+    """
+    if len(qualities) < max_templates:
+        return 'append', None
+    known = [q if q is not None else 0.0 for q in qualities]
+    worst = int(np.argmin(known))
+    if quality > known[worst]:
+        return 'replace', worst
+    return 'reject', None
+
+
+def template_entry(embedding, quality=None, dtype='float32'):
+    """One element of a user document's 'templates' list"""
+    return {
+        **encode_embedding(embedding, dtype),
+        'quality': quality,
+        'added_at': datetime.now()
+    }
+
+
+def new_user_document(username, embeddings, qualities, bbox=None, dtype='float32', max_templates=5):
+    """
+    MongoDB document for a user enrolled from one or more faces.
+
+    The `max_templates` best-quality faces become the templates (best
+    first) and their centroid the searchable 'embedding'.
+    """
+    known = [q if q is not None else 0.0 for q in qualities]
+    order = sorted(range(len(embeddings)), key=lambda i: -known[i])[:max_templates]
+    vectors = np.stack([np.asarray(embeddings[i], dtype=np.float32).reshape(-1) for i in order])
+    return {
+        'username': username,
+        **encode_embedding(vectors[0] if len(vectors) == 1 else centroid(vectors), dtype),
+        'templates': [template_entry(vectors[position], qualities[i], dtype) for position, i in enumerate(order)],
+        'template_revision': 0,
+        'registered_at': datetime.now(),
+        'bbox': np.asarray(bbox).tolist() if bbox is not None else None
+    }
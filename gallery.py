@@ -0,0 +1,345 @@
+import hashlib
+import threading
+
+import numpy as np
+
+from ann_index import top_k
+from embedding_codec import EMBEDDING_FIELDS, TEMPLATE_FIELDS, decode_embedding, decode_templates
+
+EMBEDDING_DIM = 512
+
+
+class EmbeddingGallery:
+    """
+    In-memory gallery of every registered face embedding.
+
+    Embeddings live in one contiguous float32 (N x 512) matrix so a probe is
+    scored against all users with a single matrix-vector product instead of a
+    MongoDB scan per login. Rows are L2-normalized on insert, which makes the
+    dot product equal to the cosine similarity used everywhere else.
+
+    An optional ANN index (see ann_index.py) can be attached for very large
+    galleries; search() then shortlists candidates through the index and
+    re-scores them exactly against the float32 matrix.
+
+    Users enrolled with several templates (see face_templates.py) have their
+    centroid in the matrix, so the first pass still costs one row per user;
+    the best `template_rerank_k` candidates are then re-scored against their
+    individual templates and ranked by the best matching one.
+
+    `version` is incremented by every change (load, add, update), so caches
+    of search results (see verify_cache.py) can tell when they are stale.
+    """
+
+    def __init__(self, dim=EMBEDDING_DIM, initial_capacity=1024, template_rerank_k=10):
+        self.dim = dim
+        self.template_rerank_k = template_rerank_k
+        self._lock = threading.Lock()
+        self._matrix = np.empty((initial_capacity, dim), dtype=np.float32)
+        self._usernames = []
+        # Per row: None (the row is the user's only template) or an (n x dim) template matrix
+        self._templates = []
+        self._revisions = []
+        self._rows = {}
+        self._multi_template_users = 0
+        self._size = 0
+        self._fingerprint = hashlib.sha1()
+        self.index = None
+        self.version = 0
+
+    def __len__(self):
+        return self._size
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _normalize_rows(self, embeddings):
+        vectors = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def _template_matrix(self, templates):
+        """None for zero or one template (the centroid row is enough), else normalized rows"""
+        if templates is None or len(templates) < 2:
+            return None
+        return self._normalize_rows(templates)
+
+    @staticmethod
+    def _fingerprint_line(username, revision):
+        # Template updates change a user's row, so they are part of the digest
+        return f"{username}\n" if not revision else f"{username}@{revision}\n"
+
+    def _reserve(self, rows):
+        """Grow the backing matrix (amortized doubling) to fit `rows` rows"""
+        capacity = self._matrix.shape[0]
+        if rows <= capacity:
+            return
+        while capacity < rows:
+            capacity *= 2
+        grown = np.empty((capacity, self.dim), dtype=np.float32)
+        grown[:self._size] = self._matrix[:self._size]
+        # Readers holding the old matrix keep a valid view of the old rows
+        self._matrix = grown
+
+    def load_from_collection(self, collection):
+        """
+        Load every user from the MongoDB collection into the matrix.
+
+        Called once at startup; afterwards the gallery is kept in sync
+        incrementally through add().
+        """
+        usernames = []
+        rows = []
+        templates = []
+        revisions = []
+        for user in collection.find({}, {'username': 1, '_id': 0, **EMBEDDING_FIELDS, **TEMPLATE_FIELDS}):
+            if 'embedding' not in user:
+                continue
+            usernames.append(user['username'])
+            rows.append(self._normalize(decode_embedding(user)))
+            templates.append(self._template_matrix(decode_templates(user)) if user.get('templates') else None)
+            revisions.append(user.get('template_revision') or 0)
+
+        matrix = np.empty((max(len(rows), 1024), self.dim), dtype=np.float32)
+        if rows:
+            matrix[:len(rows)] = np.stack(rows)
+
+        fingerprint = hashlib.sha1()
+        for username, revision in zip(usernames, revisions):
+            fingerprint.update(self._fingerprint_line(username, revision).encode())
+
+        with self._lock:
+            self._matrix = matrix
+            self._usernames = usernames
+            self._templates = templates
+            self._revisions = revisions
+            self._rows = {username: row for row, username in enumerate(usernames)}
+            self._multi_template_users = sum(t is not None for t in templates)
+            self._size = len(rows)
+            self._fingerprint = fingerprint
+            if self.index is not None:
+                self._build_index(self.index)
+            self.version += 1
+        return self._size
+
+    def fingerprint(self):
+        """Digest of the username order and template revisions; ties a persisted index to this gallery"""
+        return self._fingerprint.hexdigest()
+
+    def _build_index(self, index):
+        index.build(self._matrix[:self._size])
+        index.fingerprint = self.fingerprint()
+
+    def attach_index(self, index, prebuilt=False):
+        """
+        Route search() through an ANN index.
+
+        The index is built over the current matrix unless `prebuilt` is set,
+        in which case it must have been built for exactly this gallery (same
+        size and username order), e.g. when loaded from disk.
+        """
+        with self._lock:
+            if prebuilt:
+                if index.ntotal != self._size or index.fingerprint != self.fingerprint():
+                    raise ValueError("Index was built for a different gallery")
+            else:
+                self._build_index(index)
+            self.index = index
+
+    def save_index(self, path):
+        """Persist the attached index as it is now (registrations included); False without one"""
+        with self._lock:
+            if self.index is None:
+                return False
+            self.index.save(path)
+            return True
+
+    def add(self, username, embedding, templates=None):
+        """Append a newly registered user's embedding (the centroid when several templates are given)"""
+        vector = self._normalize(embedding)
+        templates = self._template_matrix(templates)
+        with self._lock:
+            self._reserve(self._size + 1)
+            self._matrix[self._size] = vector
+            self._rows[username] = self._size
+            self._usernames.append(username)
+            self._templates.append(templates)
+            self._revisions.append(0)
+            self._multi_template_users += templates is not None
+            self._size += 1
+            self._fingerprint.update(self._fingerprint_line(username, 0).encode())
+            if self.index is not None:
+                self.index.add(vector)
+                self.index.fingerprint = self.fingerprint()
+            self.version += 1
+
+    def add_many(self, usernames, embeddings, templates=None):
+        """
+        Append several users in one update (one lock, one index add), e.g. a
+        bulk enrollment. `templates` optionally holds each user's template
+        matrix (or None), as for add().
+        """
+        vectors = self._normalize_rows(embeddings)
+        templates = [self._template_matrix(t) for t in templates] if templates is not None else [None] * len(vectors)
+        with self._lock:
+            self._reserve(self._size + len(vectors))
+            self._matrix[self._size:self._size + len(vectors)] = vectors
+            for offset, username in enumerate(usernames):
+                self._rows[username] = self._size + offset
+                self._fingerprint.update(self._fingerprint_line(username, 0).encode())
+            self._usernames.extend(usernames)
+            self._templates.extend(templates)
+            self._revisions.extend([0] * len(vectors))
+            self._multi_template_users += sum(t is not None for t in templates)
+            self._size += len(vectors)
+            if self.index is not None and len(vectors):
+                self.index.add(vectors)
+                self.index.fingerprint = self.fingerprint()
+            self.version += 1
+
+    def update(self, username, embedding, templates=None, revision=0):
+        """
+        Replace a registered user's centroid and templates in place (after a
+        template was added or replaced). Raises KeyError for unknown users.
+        """
+        vector = self._normalize(embedding)
+        templates = self._template_matrix(templates)
+        with self._lock:
+            row = self._rows[username]
+            # In place: a concurrent search may see the old or the new row
+            self._matrix[row] = vector
+            self._multi_template_users += (templates is not None) - (self._templates[row] is not None)
+            self._templates[row] = templates
+            self._revisions[row] = revision
+            fingerprint = hashlib.sha1()
+            for name, user_revision in zip(self._usernames, self._revisions):
+                fingerprint.update(self._fingerprint_line(name, user_revision).encode())
+            self._fingerprint = fingerprint
+            if self.index is not None:
+                self.index.update([row], vector[None, :])
+                self.index.fingerprint = self.fingerprint()
+            self.version += 1
+
+    def __contains__(self, username):
+        return username in self._rows
+
+    @property
+    def exact_search(self):
+        """
+        True when search() scores every user exactly: no ANN index and no
+        multi-template users (whose templates are only re-scored for the
+        shortlist), so a nearby probe's ranking is bounded by its distance
+        """
+        return self.index is None and self._multi_template_users == 0
+
+    def nbytes(self):
+        """Bytes held by the embedding matrix (including spare capacity) and the extra templates"""
+        return self._matrix.nbytes + sum(t.nbytes for t in self._templates if t is not None)
+
+    def score_all(self, probe):
+        """
+        Score a probe embedding against every registered user's centroid.
+
+        Returns (scores, usernames) where scores[i] is the cosine similarity
+        to usernames[i].
+        """
+        with self._lock:
+            size = self._size
+            matrix = self._matrix[:size]
+            # The list is append-only, so indices below `size` stay valid
+            usernames = self._usernames
+        scores = matrix @ self._normalize(probe)
+        return scores, usernames
+
+    def best_match(self, probe):
+        """Return (username, similarity) of the closest user, or (None, 0.0) if empty"""
+        scores, usernames = self.score_all(probe)
+        if len(scores) == 0:
+            return None, 0.0
+        best_index = int(np.argmax(scores))
+        return usernames[best_index], float(scores[best_index])
+
+    def _snapshot(self):
+        with self._lock:
+            # The lists are append-only (rows are replaced, never removed), so
+            # indices below `size` stay valid after the lock is released; the
+            # index publishes its changes atomically (see IVFIndex) and may be
+            # searched outside the lock
+            return (self._size, self._matrix[:self._size], self._usernames, self._templates,
+                    self.index, self._multi_template_users > 0)
+
+    def _rank(self, probe, ids, scores, k, usernames, templates, rescore):
+        """Max-of-templates re-scoring of the shortlist, then the top k"""
+        if rescore:
+            scores = scores.copy()
+            for position, row in enumerate(ids):
+                if templates[row] is not None:
+                    scores[position] = float(np.max(templates[row] @ probe))
+        order = np.argsort(-scores, kind='stable')[:k]
+        return scores[order], [usernames[i] for i in ids[order]]
+
+    def search(self, probe, k=10):
+        """
+        Return the top-k (scores, usernames), best first.
+
+        Without an index this is an exact scan. With one, the index only
+        proposes candidates; their scores are recomputed exactly so threshold
+        decisions match the brute-force cosine similarity. Users with several
+        templates are scored by their best matching template.
+        """
+        probe = self._normalize(probe)
+        size, matrix, usernames, templates, index, rescore = self._snapshot()
+        shortlist = max(k, self.template_rerank_k) if rescore else k
+
+        if index is None:
+            scores = matrix @ probe
+            ids = top_k(scores, shortlist)
+            return self._rank(probe, ids, scores[ids], k, usernames, templates, rescore)
+
+        ids, _ = index.search(probe, shortlist)
+        ids = ids[ids < size]
+        return self._rank(probe, ids, matrix[ids] @ probe, k, usernames, templates, rescore)
+
+    def search_many(self, probes, k=10):
+        """
+        search() for several probes at once; returns a list of (scores, usernames).
+
+        Without an index all probes are scored with one matrix product.
+        """
+        probes = self._normalize_rows(probes)
+        size, matrix, usernames, templates, index, rescore = self._snapshot()
+        if index is not None:
+            return [self.search(probe, k) for probe in probes]
+
+        shortlist = max(k, self.template_rerank_k) if rescore else k
+        results = []
+        for probe, scores in zip(probes, probes @ matrix.T):
+            ids = top_k(scores, shortlist)
+            results.append(self._rank(probe, ids, scores[ids], k, usernames, templates, rescore))
+        return results
+
+    @staticmethod
+    def _decide(scores, usernames, threshold):
+        if len(scores) == 0:
+            return None, 0.0, scores, usernames
+        best_similarity = float(scores[0])
+        username = usernames[0] if best_similarity > threshold else None
+        return username, best_similarity, scores, usernames
+
+    def identify(self, probe, threshold=0.25, k=5):
+        """
+        1:N decision used by /api/verify_face: the best candidate is accepted
+        when its similarity is above the threshold.
+
+        Returns (username or None, best_similarity, top-k scores, top-k usernames).
+        """
+        scores, usernames = self.search(probe, k=k)
+        return self._decide(scores, usernames, threshold)
+
+    def identify_many(self, probes, threshold=0.25, k=5):
+        """identify() for several probes with one search_many() call"""
+        return [self._decide(scores, usernames, threshold) for scores, usernames in self.search_many(probes, k)]
@@ -0,0 +1,181 @@
+"""
+Image ingestion for the API: request payload -> BGR array -> JPEG preview.
+
+Images are decoded once, straight to the BGR layout the detector expects,
+with cv2.imdecode. Large JPEGs are decoded at 1/2, 1/4 or 1/8 resolution by
+libjpeg itself (IMREAD_REDUCED_COLOR_*), so a 12MP phone photo never gets
+expanded to full size only to be shrunk again. Crops are encoded from the
+BGR frame directly, without any RGB round trip.
+"""
+import base64
+import struct
+
+import cv2
+import numpy as np
+
+# Reduced-resolution decode flags by scale factor, largest first
+_REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+# JPEG start-of-frame markers that carry the image dimensions
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def jpeg_size(image_bytes):
+    """Return (width, height) from a JPEG header without decoding, or None"""
+    if image_bytes[:2] != b'\xff\xd8':
+        return None
+    offset = 2
+    while offset + 9 <= len(image_bytes):
+        if image_bytes[offset] != 0xFF:
+            return None
+        marker = image_bytes[offset + 1]
+        if marker == 0xFF:  # Fill byte
+            offset += 1
+            continue
+        segment_length = struct.unpack('>H', image_bytes[offset + 2:offset + 4])[0]
+        if marker in _JPEG_SOF_MARKERS:
+            height, width = struct.unpack('>HH', image_bytes[offset + 5:offset + 9])
+            return width, height
+        offset += 2 + segment_length
+    return None
+
+
+def default_max_size(image_bytes):
+    """Webcam frames are small; larger uploads keep more resolution"""
+    return 1200 if len(image_bytes) > 500000 else 800
+
+
+def decode_image_bytes(image_bytes, max_size=None):
+    """
+    Decode encoded image bytes into a BGR array no larger than max_size.
+
+    Returns None when the bytes are not a decodable image.
+    """
+    if max_size is None:
+        max_size = default_max_size(image_bytes)
+    img_bgr = decode_reduced(image_bytes, max_size)
+    return None if img_bgr is None else limit_size(img_bgr, max_size)
+
+
+def decode_reduced(image_bytes, max_size):
+    """
+    Decode to BGR, letting libjpeg skip as much resolution as possible while
+    keeping the longest side >= max_size. The result may still need limit_size().
+    """
+    flags = cv2.IMREAD_COLOR
+    size = jpeg_size(image_bytes)
+    if size is not None:
+        for factor, reduced_flag in _REDUCED_DECODE_FLAGS:
+            if max(size) // factor >= max_size:
+                flags = reduced_flag
+                break
+
+    buffer = np.frombuffer(image_bytes, dtype=np.uint8)
+    return cv2.imdecode(buffer, flags)
+
+
+def limit_size(img_bgr, max_size):
+    """Downscale (INTER_AREA) so the longest side is at most max_size"""
+    height, width = img_bgr.shape[:2]
+    if max(height, width) <= max_size:
+        return img_bgr
+    ratio = max_size / max(height, width)
+    size = (max(1, int(width * ratio)), max(1, int(height * ratio)))
+    return cv2.resize(img_bgr, size, interpolation=cv2.INTER_AREA)
+
+
+def decode_data_url(image_data):
+    """Bytes of a base64 data URL (a bare base64 string is accepted too)"""
+    _, _, encoded = image_data.rpartition(',')
+    return base64.b64decode(encoded)
+
+
+def read_image_request(req):
+    """
+    Extract (image_bytes, params) from a Flask request.
+
+    Accepts a multipart upload (file field 'image'), a raw binary body
+    (image/* or application/octet-stream) or the JSON {'image': data URL}
+    used by the web pages. `params` holds the remaining fields: the JSON
+    body, or form fields / query string for binary uploads.
+    """
+    if 'image' in req.files:
+        return req.files['image'].read(), {**req.args.to_dict(), **req.form.to_dict()}
+
+    if req.mimetype.startswith('image/') or req.mimetype == 'application/octet-stream':
+        return req.get_data(), req.args.to_dict()
+
+    data = req.get_json(silent=True) or {}
+    image_data = data.get('image')
+    return (decode_data_url(image_data) if image_data else None), data
+
+
+async def read_image_request_async(req):
+    """read_image_request() for Quart requests, whose body accessors are awaitable"""
+    if req.mimetype == 'multipart/form-data':
+        files = await req.files
+        if 'image' in files:
+            form = await req.form
+            return files['image'].read(), {**req.args.to_dict(), **form.to_dict()}
+
+    if req.mimetype.startswith('image/') or req.mimetype == 'application/octet-stream':
+        return await req.get_data(), req.args.to_dict()
+
+    data = await req.get_json(silent=True) or {}
+    image_data = data.get('image')
+    return (decode_data_url(image_data) if image_data else None), data
+
+
+def _batch_entries(data):
+    """Entries of the JSON batch body {'users': [{'username', 'images' (or 'image')}]}"""
+    entries = []
+    for user in data.get('users') or []:
+        images = user.get('images') or ([user['image']] if user.get('image') else [])
+        entries.append((user.get('username'), [decode_data_url(image) for image in images]))
+    return entries
+
+
+def read_batch_request(req):
+    """
+    Extract [(username, [image_bytes, ...])] from a batch registration request.
+
+    Accepts a multipart upload with one file field per user, named after the
+    username and repeated for several photos, or the JSON
+    {'users': [{'username': ..., 'images': [data URL, ...]}]}.
+    """
+    if req.files:
+        return [(username, [upload.read() for upload in req.files.getlist(username)]) for username in req.files]
+    return _batch_entries(req.get_json(silent=True) or {})
+
+
+async def read_batch_request_async(req):
+    """read_batch_request() for Quart requests"""
+    if req.mimetype == 'multipart/form-data':
+        files = await req.files
+        return [(username, [upload.read() for upload in files.getlist(username)]) for username in files]
+    return _batch_entries(await req.get_json(silent=True) or {})
+
+
+def crop_box(img_bgr, bbox):
+    """View of the bbox region, clipped to the image bounds"""
+    height, width = img_bgr.shape[:2]
+    x1, y1, x2, y2 = np.clip(np.asarray(bbox)[:4], 0, [width, height, width, height]).astype(int)
+    return img_bgr[y1:y2, x1:x2]
+
+
+def encode_jpeg(img_bgr, quality=90):
+    """JPEG-encode a BGR image, returning the bytes or None"""
+    ok, encoded = cv2.imencode('.jpg', img_bgr, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return encoded.tobytes() if ok else None
+
+
+def encode_jpeg_data_url(img_bgr, quality=90):
+    """JPEG-encode a BGR image as a data URL"""
+    encoded = encode_jpeg(img_bgr, quality)
+    if encoded is None:
+        return None
+    return f"data:image/jpeg;base64,{base64.b64encode(encoded).decode()}"
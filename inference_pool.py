@@ -0,0 +1,178 @@
+"""
+Bounded worker pool for face model inference.
+
+Each worker thread owns its own prepared model, so concurrent requests never
+share an ONNX Runtime session. ONNX Runtime releases the GIL while running,
+so threads scale with cores as long as every session is limited to a few
+intra-op threads (see face_models.load_face_analysis). Requests wait in a
+bounded queue; when it is full the caller is rejected immediately instead of
+piling up behind a login burst.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+
+class PoolSaturatedError(RuntimeError):
+    """Raised when the request queue is full"""
+
+
+class InferenceTimeoutError(TimeoutError):
+    """Raised when a request is not served within its timeout"""
+
+
+class _StageTimer:
+    """Count / total / max of durations for one stage"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'avg_ms': (self.total / self.count * 1000) if self.count else 0.0,
+            'max_ms': self.max * 1000,
+        }
+
+
+class InferencePool:
+    """
+    Run tasks of the form task(model, *args) on a fixed set of model workers.
+
+    Args:
+        model_factory: Called once inside every worker thread to build its model
+        workers: Number of worker threads (one model each)
+        queue_size: Maximum number of requests waiting for a worker
+        timeout: Default seconds a caller waits for its result
+    """
+
+    def __init__(self, model_factory, workers=2, queue_size=16, timeout=10.0, name='inference'):
+        self.workers = workers
+        self.timeout = timeout
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stopping = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._stages = {}
+        self._counters = {'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0, 'timed_out': 0}
+        self._busy = 0
+        self._ready_workers = 0
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._worker, args=(model_factory,),
+                                      name=f"{name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _count(self, counter):
+        with self._stats_lock:
+            self._counters[counter] += 1
+
+    def _record(self, stage, seconds):
+        with self._stats_lock:
+            self._stages.setdefault(stage, _StageTimer()).record(seconds)
+
+    def _worker(self, model_factory):
+        try:
+            model = model_factory()
+        except Exception as e:
+            print(f"💥 [{threading.current_thread().name}] Failed to load model: {e}")
+            return
+        with self._stats_lock:
+            self._ready_workers += 1
+
+        while True:
+            job = self._next_job()
+            if job is None:
+                break
+            future, task, args, enqueued_at = job
+            if not future.set_running_or_notify_cancel():
+                continue  # Caller already gave up
+
+            started = time.perf_counter()
+            self._record('queue_wait', started - enqueued_at)
+            with self._stats_lock:
+                self._busy += 1
+            try:
+                result = task(model, *args)
+            except BaseException as e:
+                self._count('failed')
+                future.set_exception(e)
+            else:
+                self._count('completed')
+                future.set_result(result)
+            finally:
+                with self._stats_lock:
+                    self._busy -= 1
+                self._record(task.__name__, time.perf_counter() - started)
+
+    def _next_job(self, poll_interval=0.5):
+        """Next queued job; None once shutdown() was called and the queue is drained"""
+        while True:
+            try:
+                return self._queue.get(timeout=poll_interval)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return None
+
+    def submit(self, task, *args):
+        """Queue task(model, *args) and return a Future; raises PoolSaturatedError when full"""
+        if self._stopping.is_set():
+            self._count('rejected')
+            raise PoolSaturatedError("Inference pool is shutting down")
+        future = Future()
+        try:
+            self._queue.put_nowait((future, task, args, time.perf_counter()))
+        except queue.Full:
+            self._count('rejected')
+            raise PoolSaturatedError("Inference queue is full") from None
+        self._count('submitted')
+        return future
+
+    def run(self, task, *args, timeout=None):
+        """Submit a task and wait for its result"""
+        future = self.submit(task, *args)
+        try:
+            return future.result(timeout=timeout if timeout is not None else self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            self._count('timed_out')
+            raise InferenceTimeoutError("Inference request timed out") from None
+
+    def stats(self):
+        """Snapshot of queue depth, worker usage, counters and per-stage timings"""
+        with self._stats_lock:
+            return {
+                'workers': self.workers,
+                'ready_workers': self._ready_workers,
+                'alive_workers': sum(thread.is_alive() for thread in self._threads),
+                'busy_workers': self._busy,
+                'queue_depth': self._queue.qsize(),
+                'queue_capacity': self._queue.maxsize,
+                **self._counters,
+                'stages': {stage: timer.as_dict() for stage, timer in self._stages.items()},
+            }
+
+    def shutdown(self, wait=True):
+        """
+        Stop the workers after the queued requests have been served. Never
+        blocks on a full queue (e.g. when workers failed to load): workers
+        stop by themselves once the queue is empty, and the wake-up markers
+        are only a shortcut for idle ones.
+        """
+        self._stopping.set()
+        for _ in self._threads:
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                break
+        if wait:
+            for thread in self._threads:
+                thread.join()
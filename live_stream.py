@@ -0,0 +1,222 @@
+"""
+Live face detection sessions streamed over Server-Sent Events.
+
+The browser uploads camera frames as raw (downscaled) JPEG bytes and keeps
+one EventSource open per session; the server answers with bbox/quality
+events on that stream. Each session processes at most one frame at a time
+and keeps only the newest waiting frame, so when the server falls behind
+stale frames are dropped instead of queueing up.
+
+Listeners are either threads (events(), blocking on the session condition)
+or asyncio tasks (events_async(), woken through a thread-safe callback), so
+an ASGI server can hold many open streams without a thread per stream.
+"""
+import asyncio
+import json
+import threading
+import time
+import uuid
+
+from inference_pool import PoolSaturatedError
+
+
+class LiveSession:
+    """State of one live camera session"""
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.condition = threading.Condition()
+        self.pending_frame = None
+        self.in_flight = False
+        self.closed = False
+        self.frame_seq = 0
+        self.frames_received = 0
+        self.frames_dropped = 0
+        self.event = None
+        self.event_seq = 0
+        self.listeners = []
+        self.last_seen = time.monotonic()
+
+    def notify(self):
+        """Wake thread and callback listeners; call with the condition held"""
+        self.condition.notify_all()
+        for callback in self.listeners:
+            callback()
+
+
+class LiveStreamHub:
+    """
+    Owns live sessions and feeds their frames to an inference pool.
+
+    Args:
+        pool: InferencePool that runs `task(model, frame_bytes)`
+        task: Pool task returning a JSON-serialisable detection result dict
+        idle_timeout: Seconds without frames or listeners before a session expires
+        max_sessions: Upper bound on concurrently open sessions
+    """
+
+    def __init__(self, pool, task, idle_timeout=30.0, max_sessions=256, keepalive=15.0):
+        self.pool = pool
+        self.task = task
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.keepalive = keepalive
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _expire_idle(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [s for s in self._sessions.values() if now - s.last_seen > self.idle_timeout]
+        for session in expired:
+            self.close(session.session_id)
+
+    def open(self):
+        """Create a session and return its id, or None when the hub is full"""
+        self._expire_idle()
+        with self._lock:
+            if len(self._sessions) >= self.max_sessions:
+                return None
+            session = LiveSession(uuid.uuid4().hex)
+            self._sessions[session.session_id] = session
+        return session.session_id
+
+    def get(self, session_id):
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def close(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is not None:
+            with session.condition:
+                session.closed = True
+                session.notify()
+
+    def close_all(self):
+        """Close every session, ending their event streams (used on shutdown)"""
+        with self._lock:
+            session_ids = list(self._sessions)
+        for session_id in session_ids:
+            self.close(session_id)
+
+    def push_frame(self, session_id, frame_bytes):
+        """
+        Hand a frame to the session. It starts processing immediately when the
+        session is idle, otherwise it replaces (drops) any frame still waiting.
+        Returns False for unknown sessions.
+        """
+        session = self.get(session_id)
+        if session is None:
+            return False
+        with session.condition:
+            session.last_seen = time.monotonic()
+            session.frames_received += 1
+            session.frame_seq += 1
+            if session.pending_frame is not None:
+                session.frames_dropped += 1
+            session.pending_frame = (session.frame_seq, frame_bytes)
+            if session.in_flight:
+                return True
+            session.in_flight = True
+        self._process_next(session)
+        return True
+
+    def _process_next(self, session):
+        with session.condition:
+            if session.closed or session.pending_frame is None:
+                session.in_flight = False
+                return
+            seq, frame_bytes = session.pending_frame
+            session.pending_frame = None
+
+        try:
+            future = self.pool.submit(self.task, frame_bytes)
+        except PoolSaturatedError:
+            with session.condition:
+                session.frames_dropped += 1
+                session.in_flight = False
+            return
+        future.add_done_callback(lambda done: self._on_result(session, seq, done))
+
+    def _on_result(self, session, seq, future):
+        try:
+            event = future.result()
+        except Exception as e:
+            event = {'type': 'error', 'message': str(e)}
+        with session.condition:
+            event.update({
+                'frame': seq,
+                'frames_received': session.frames_received,
+                'frames_dropped': session.frames_dropped,
+            })
+            session.event = event
+            session.event_seq += 1
+            session.notify()
+        self._process_next(session)
+
+    def events(self, session_id):
+        """Generator of SSE messages carrying the newest event of the session"""
+        session = self.get(session_id)
+        if session is None:
+            return
+        sent_seq = 0
+        yield 'retry: 1000\n\n'
+        while True:
+            with session.condition:
+                session.condition.wait_for(lambda: session.closed or session.event_seq != sent_seq,
+                                           timeout=self.keepalive)
+                if session.closed:
+                    return
+                if session.event_seq == sent_seq:
+                    event = None
+                else:
+                    event, sent_seq = session.event, session.event_seq
+                session.last_seen = time.monotonic()
+
+            if event is None:
+                yield ': keepalive\n\n'
+            else:
+                yield f"data: {json.dumps(event)}\n\n"
+
+    async def events_async(self, session_id):
+        """Async generator of the same SSE messages, for ASGI servers"""
+        session = self.get(session_id)
+        if session is None:
+            return
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        callback = lambda: loop.call_soon_threadsafe(wakeup.set)
+        with session.condition:
+            session.listeners.append(callback)
+        try:
+            sent_seq = 0
+            yield 'retry: 1000\n\n'
+            while True:
+                with session.condition:
+                    closed = session.closed
+                    event = session.event if session.event_seq != sent_seq else None
+                    sent_seq = session.event_seq
+                    session.last_seen = time.monotonic()
+                if closed:
+                    return
+                if event is not None:
+                    yield f"data: {json.dumps(event)}\n\n"
+                    continue
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout=self.keepalive)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                wakeup.clear()
+        finally:
+            with session.condition:
+                session.listeners.remove(callback)
+
+    def stats(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return {
+            'sessions': len(sessions),
+            'frames_received': sum(s.frames_received for s in sessions),
+            'frames_dropped': sum(s.frames_dropped for s in sessions),
+        }
@@ -0,0 +1,354 @@
+"""
+Load generator for the HTTP API.
+
+    python load_test.py --in-process --frames dataset1 --concurrency 8 --duration 60
+    python load_test.py --url http://localhost:5000 --rate 20 --duration 120
+    python load_test.py --in-process --mix detect_fast=6,verify_face=3,register_face=1 \\
+        --compare load_test_20251101_120000.json
+
+Replays recorded frames (every image under --frames, e.g. dataset1) as raw
+image uploads against /api/detect_face (fast and full), /api/verify_face and
+/api/register_face, with endpoints drawn at random according to --mix.
+
+- closed loop (default): --concurrency clients each send their next request
+  as soon as the previous one returns
+- open loop (--rate): requests arrive as a Poisson process at --rate per
+  second whatever the server does; latency is measured from the scheduled
+  arrival, so time spent waiting for a free client counts too
+
+--in-process starts the Flask app on a local port inside this process with
+MONGO_BACKEND=mongomock, so no MongoDB server is needed and nothing is
+persisted. Against a real deployment, registrations create real users
+(named loadtest_<run>_...). Before the run, --enroll people from the frames
+are registered so verifications can succeed.
+
+Results (throughput, error rate, per-endpoint latency distribution, status
+codes and messages) are saved as load_test_<timestamp>.json together with
+the git commit, and --compare prints the change against a previous run.
+"""
+import argparse
+import json
+import logging
+import mimetypes
+import os
+import random
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from urllib.parse import urlencode
+
+import numpy as np
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.bmp']
+
+ENDPOINTS = {
+    'detect_fast': ('/api/detect_face', {'fast': 'true'}),
+    'detect_face': ('/api/detect_face', {}),
+    'verify_face': ('/api/verify_face', {}),
+    'register_face': ('/api/register_face', {}),
+}
+
+Frame = namedtuple('Frame', 'person data content_type')
+Sample = namedtuple('Sample', 'endpoint status success message latency')
+
+
+def load_frames(sources, limit=None):
+    """Frames from image files or folders (searched recursively), in a stable order"""
+    paths = []
+    for source in sources:
+        source = Path(source)
+        if source.is_dir():
+            paths.extend(sorted(p for p in source.rglob('*') if p.suffix.lower() in IMAGE_EXTENSIONS))
+        elif source.exists():
+            paths.append(source)
+    frames = [Frame(path.parent.name, path.read_bytes(), mimetypes.guess_type(path.name)[0] or 'image/jpeg')
+              for path in paths[:limit]]
+    if not frames:
+        raise SystemExit(f"No frames found in {sources}")
+    return frames
+
+
+def parse_mix(text):
+    """'detect_fast=6,verify_face=3' -> (endpoints, weights)"""
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        if name not in ENDPOINTS:
+            raise SystemExit(f"Unknown endpoint '{name}', expected one of {', '.join(ENDPOINTS)}")
+        mix[name] = float(weight or 1)
+    return list(mix), list(mix.values())
+
+
+def send(base_url, endpoint, frame, username=None, timeout=30.0, started=None):
+    """POST one frame; latency runs from `started` (default: now) to the full response"""
+    path, params = ENDPOINTS[endpoint]
+    if username:
+        params = {**params, 'username': username}
+    url = base_url + path + (f"?{urlencode(params)}" if params else '')
+    req = urllib.request.Request(url, data=frame.data, method='POST', headers={'Content-Type': frame.content_type})
+    started = started if started is not None else time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            status, body = response.status, response.read()
+    except urllib.error.HTTPError as e:
+        status, body = e.code, e.read()
+    except OSError as e:  # Refused / reset connections and timeouts
+        return Sample(endpoint, None, False, type(e).__name__, time.perf_counter() - started)
+    latency = time.perf_counter() - started
+    try:
+        payload = json.loads(body)
+        return Sample(endpoint, status, bool(payload.get('success')), payload.get('message', ''), latency)
+    except ValueError:
+        return Sample(endpoint, status, False, 'Invalid JSON response', latency)
+
+
+def wait_ready(base_url, timeout=300.0):
+    """Poll /readyz until the models are loaded and warmed up"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(base_url + '/readyz', timeout=5) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            pass
+        time.sleep(1)
+    raise SystemExit(f"{base_url} did not become ready within {timeout:.0f}s")
+
+
+def start_in_process_server(mongo_backend):
+    """Serve app.py from a background thread on a free local port"""
+    os.environ['MONGO_BACKEND'] = mongo_backend
+    import app as service
+    from werkzeug.serving import make_server
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, service.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+class LoadGenerator:
+    """Draws (endpoint, frame) pairs and collects Samples from many threads"""
+
+    def __init__(self, base_url, frames, endpoints, weights, run_id, timeout=30.0, seed=42):
+        self.base_url = base_url
+        self.frames = frames
+        self.endpoints = endpoints
+        self.weights = weights
+        self.run_id = run_id
+        self.timeout = timeout
+        self.samples = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._registrations = 0
+
+    def _next_request(self):
+        with self._lock:
+            endpoint = self._random.choices(self.endpoints, self.weights)[0]
+            frame = self._random.choice(self.frames)
+            username = None
+            if endpoint == 'register_face':
+                self._registrations += 1
+                username = f"loadtest_{self.run_id}_{self._registrations}"
+        return endpoint, frame, username
+
+    def _record(self, sample):
+        with self._lock:
+            self.samples.append(sample)
+
+    def enroll(self, people):
+        """Register the first frame of `people` persons so verifications can match"""
+        first_frames = {}
+        for frame in self.frames:
+            first_frames.setdefault(frame.person, frame)
+        enrolled = 0
+        for person, frame in list(first_frames.items())[:people]:
+            sample = send(self.base_url, 'register_face', frame, f"loadtest_{self.run_id}_{person}", self.timeout)
+            enrolled += sample.success
+        print(f"Enrolled {enrolled}/{min(people, len(first_frames))} people")
+
+    def run_closed(self, concurrency, duration, max_requests=None):
+        deadline = time.perf_counter() + duration
+        budget = iter(range(max_requests)) if max_requests else None
+
+        def client():
+            while time.perf_counter() < deadline:
+                if budget is not None and next(budget, None) is None:
+                    return
+                endpoint, frame, username = self._next_request()
+                self._record(send(self.base_url, endpoint, frame, username, self.timeout))
+
+        threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def run_open(self, rate, concurrency, duration, max_requests=None):
+        arrivals = np.random.default_rng(0).exponential(1.0 / rate, size=max_requests or int(rate * duration * 2) + 1)
+        arrivals = np.cumsum(arrivals)
+        if not max_requests:
+            arrivals = arrivals[arrivals < duration]
+
+        def fire(scheduled):
+            endpoint, frame, username = self._next_request()
+            self._record(send(self.base_url, endpoint, frame, username, self.timeout, started=scheduled))
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for offset in arrivals:
+                delay = start + offset - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(fire, start + offset)
+
+
+def latency_summary(latencies):
+    latencies = np.asarray(latencies) * 1000
+    if len(latencies) == 0:
+        return {}
+    return {
+        'mean': float(latencies.mean()),
+        'p50': float(np.percentile(latencies, 50)),
+        'p90': float(np.percentile(latencies, 90)),
+        'p95': float(np.percentile(latencies, 95)),
+        'p99': float(np.percentile(latencies, 99)),
+        'max': float(latencies.max()),
+    }
+
+
+def summarize(samples, elapsed):
+    """
+    Overall and per-endpoint results. Errors are transport failures and
+    non-2xx responses (including 503 when the inference pools are full);
+    a 200 with success=false (no face, no match) is an application outcome.
+    """
+    def block(group):
+        errors = sum(s.status is None or not 200 <= s.status < 300 for s in group)
+        return {
+            'requests': len(group),
+            'throughput_per_s': len(group) / elapsed if elapsed > 0 else 0.0,
+            'errors': errors,
+            'error_rate': errors / len(group) if group else 0.0,
+            'success_rate': sum(s.success for s in group) / len(group) if group else 0.0,
+            'status_codes': dict(Counter(str(s.status) for s in group)),
+            'messages': dict(Counter(s.message for s in group).most_common(10)),
+            'latency_ms': latency_summary([s.latency for s in group]),
+        }
+
+    endpoints = sorted({s.endpoint for s in samples})
+    return block(samples), {name: block([s for s in samples if s.endpoint == name]) for name in endpoints}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(previous, report):
+    print(f"\n{'='*80}\nCOMPARED WITH {previous['meta'].get('commit')} ({previous['meta'].get('timestamp')})\n{'='*80}")
+    for name, current in report['endpoints'].items():
+        before = previous['endpoints'].get(name)
+        if not before or not before['latency_ms'] or not current['latency_ms']:
+            continue
+        changes = []
+        for key in ('p50', 'p95', 'p99'):
+            old, new = before['latency_ms'][key], current['latency_ms'][key]
+            changes.append(f"{key} {old:.0f} -> {new:.0f} ms ({(new - old) / old:+.0%})")
+        old, new = before['throughput_per_s'], current['throughput_per_s']
+        changes.append(f"throughput {old:.1f} -> {new:.1f}/s")
+        changes.append(f"errors {before['error_rate']:.1%} -> {current['error_rate']:.1%}")
+        print(f"  {name}: " + ', '.join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the face authentication API')
+    parser.add_argument('--url', default='http://localhost:5000', help='Base URL of a running server')
+    parser.add_argument('--in-process', action='store_true', help='Start app.py in this process instead')
+    parser.add_argument('--mongo-backend', default='mongomock', choices=['mongomock', 'mongodb'],
+                        help='MONGO_BACKEND for --in-process')
+    parser.add_argument('--frames', nargs='+', default=['dataset1'], help='Image files or folders to replay')
+    parser.add_argument('--max-frames', type=int, default=None)
+    parser.add_argument('--mix', default='detect_fast=5,detect_face=1,verify_face=3,register_face=1')
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent clients')
+    parser.add_argument('--rate', type=float, default=None, help='Open-loop arrival rate (requests/s)')
+    parser.add_argument('--duration', type=float, default=30.0, help='Seconds to run')
+    parser.add_argument('--requests', type=int, default=None, help='Stop after this many requests')
+    parser.add_argument('--enroll', type=int, default=10, help='People to register before the run')
+    parser.add_argument('--timeout', type=float, default=30.0, help='Client timeout per request (s)')
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--compare', default=None, help='Previous load_test JSON to compare with')
+    args = parser.parse_args()
+
+    endpoints, weights = parse_mix(args.mix)
+    frames = load_frames(args.frames, args.max_frames)
+    base_url = args.url.rstrip('/')
+    if args.in_process:
+        _, base_url = start_in_process_server(args.mongo_backend)
+    print(f"Waiting for {base_url} to be ready...")
+    wait_ready(base_url)
+
+    run_id = datetime.now().strftime('%Y%m%d%H%M%S')
+    generator = LoadGenerator(base_url, frames, endpoints, weights, run_id, args.timeout)
+    if args.enroll:
+        generator.enroll(args.enroll)
+
+    mode = 'open' if args.rate else 'closed'
+    print(f"Running {mode}-loop load: {len(frames)} frames, mix {dict(zip(endpoints, weights))}, "
+          f"{args.concurrency} clients" + (f", {args.rate}/s" if args.rate else '') + f", {args.duration:.0f}s")
+    started = time.perf_counter()
+    if args.rate:
+        generator.run_open(args.rate, args.concurrency, args.duration, args.requests)
+    else:
+        generator.run_closed(args.concurrency, args.duration, args.requests)
+    elapsed = time.perf_counter() - started
+
+    overall, per_endpoint = summarize(generator.samples, elapsed)
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'url': None if args.in_process else base_url,
+            'in_process': args.in_process,
+            'mongo_backend': args.mongo_backend if args.in_process else None,
+            'mode': mode,
+            'concurrency': args.concurrency,
+            'rate': args.rate,
+            'mix': dict(zip(endpoints, weights)),
+            'frames': len(frames),
+            'duration_s': elapsed,
+        },
+        'overall': overall,
+        'endpoints': per_endpoint,
+    }
+
+    print(f"\n{'='*80}\nLOAD TEST RESULTS ({overall['requests']} requests in {elapsed:.1f}s)\n{'='*80}")
+    print(f"Throughput {overall['throughput_per_s']:.1f}/s, error rate {overall['error_rate']:.2%}")
+    for name, result in per_endpoint.items():
+        latency = result['latency_ms']
+        print(f"  {name:<14} {result['requests']:>6} req  {result['throughput_per_s']:6.1f}/s  "
+              f"p50 {latency['p50']:7.1f} ms  p95 {latency['p95']:7.1f} ms  p99 {latency['p99']:7.1f} ms  "
+              f"errors {result['error_rate']:6.2%}  success {result['success_rate']:6.2%}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), report)
+
+    filename = args.output or f"load_test_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nDetailed results saved to: {filename}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""
+Latency and counter metrics with a Prometheus text exposition.
+
+Stages are timed with a monotonic clock (time.perf_counter) through
+`metrics.span(stage)`. Each latency series keeps fixed histogram buckets for
+Prometheus plus a bounded window of recent samples from which p50/p95/p99
+are reported, so quantiles follow the current load instead of the whole
+process lifetime.
+"""
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+
+from tracing import current_trace
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class LatencyHistogram:
+    """Histogram buckets plus a window of recent samples for quantiles"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, window=2048):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)  # Last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self._recent = deque(maxlen=window)
+
+    def observe(self, seconds):
+        self.bucket_counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self._recent.append(seconds)
+
+    def quantiles(self, quantiles=QUANTILES):
+        if not self._recent:
+            return {q: 0.0 for q in quantiles}
+        ordered = sorted(self._recent)
+        return {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in quantiles}
+
+
+class MetricsRegistry:
+    """Thread-safe store of latency histograms and counters"""
+
+    def __init__(self, namespace='face_auth'):
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._help = {}
+
+    def observe(self, name, seconds, help_text='', **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._help.setdefault(name, help_text)
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = LatencyHistogram()
+            histogram.observe(seconds)
+
+    def inc(self, name, value=1, help_text='', **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._help.setdefault(name, help_text)
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextmanager
+    def span(self, stage):
+        """Time a block as `stage`, in the stage histogram and the current request trace"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.observe('stage_seconds', elapsed, 'Time spent per processing stage', stage=stage)
+            trace = current_trace()
+            if trace is not None:
+                trace.add_stage(stage, elapsed)
+
+    def snapshot(self):
+        """JSON-friendly view: counters and p50/p95/p99 per latency series"""
+        with self._lock:
+            return {
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in self._counters.items()
+                ],
+                'latency': [
+                    {
+                        'name': name,
+                        'labels': dict(labels),
+                        'count': histogram.count,
+                        'avg_ms': histogram.sum / histogram.count * 1000 if histogram.count else 0.0,
+                        **{f"p{int(q * 100)}_ms": v * 1000 for q, v in histogram.quantiles().items()},
+                    }
+                    for (name, labels), histogram in self._histograms.items()
+                ],
+            }
+
+    def render_prometheus(self, gauges=()):
+        """
+        Prometheus text format. `gauges` is an iterable of
+        (name, help_text, [(labels_dict, value), ...]) computed by the caller.
+        """
+        lines = []
+        with self._lock:
+            series_key = lambda item: (item[0][0], _format_labels(item[0][1]))
+            counters = sorted(self._counters.items(), key=series_key)
+            histograms = sorted(self._histograms.items(), key=series_key)
+            help_texts = dict(self._help)
+
+        seen = set()
+        for (name, labels), value in counters:
+            metric = f"{self.namespace}_{name}_total"
+            if metric not in seen:
+                seen.add(metric)
+                lines.append(f"# HELP {metric} {help_texts.get(name, '')}")
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{_format_labels(labels)} {_format_value(value)}")
+
+        for (name, labels), histogram in histograms:
+            metric = f"{self.namespace}_{name}"
+            if metric not in seen:
+                seen.add(metric)
+                lines.append(f"# HELP {metric} {help_texts.get(name, '')}")
+                lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            bounds = [repr(bound) for bound in histogram.buckets] + ['+Inf']
+            for bound, bucket_count in zip(bounds, histogram.bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{metric}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{metric}_sum{_format_labels(labels)} {histogram.sum!r}")
+            lines.append(f"{metric}_count{_format_labels(labels)} {histogram.count}")
+
+        # Recent-window quantiles as a separate summary family
+        for (name, labels), histogram in histograms:
+            metric = f"{self.namespace}_{name}_recent"
+            if metric not in seen:
+                seen.add(metric)
+                lines.append(f"# HELP {metric} Quantiles over the most recent samples")
+                lines.append(f"# TYPE {metric} summary")
+            for q, value in histogram.quantiles().items():
+                lines.append(f"{metric}{_format_labels(labels + (('quantile', q),))} {value!r}")
+
+        for name, help_text, samples in gauges:
+            metric = f"{self.namespace}_{name}"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} gauge")
+            for labels, value in samples:
+                lines.append(f"{metric}{_format_labels(tuple(sorted(labels.items())))} {_format_value(value)}")
+
+        return '\n'.join(lines) + '\n'
+
+
+# Process-wide registry used by the app
+metrics = MetricsRegistry()
@@ -0,0 +1,186 @@
+"""
+Dynamic micro-batching for the ArcFace recognition model.
+
+Requests hand over aligned 112x112 face crops; a scheduler thread collects
+crops from concurrent requests until either `max_batch_size` crops are
+waiting or the oldest has waited `max_wait_ms`, then runs the recognition
+model once for the whole batch and hands each embedding back to its caller.
+Under a login burst this turns many batch-1 inferences into a few larger
+ones, which is far cheaper per face on CPU.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from inference_pool import PoolSaturatedError, InferenceTimeoutError
+
+
+class MicroBatcher:
+    """
+    Group single-item requests into batches for batch_fn(model, items).
+
+    Args:
+        model_factory: Called once in each scheduler thread to build its model
+        batch_fn: Returns one result per item, in order
+        max_batch_size: Largest batch handed to batch_fn
+        max_wait_ms: Longest time the first item of a batch waits for company
+        queue_size: Maximum number of items waiting to be batched
+        timeout: Default seconds a caller waits for its result
+        workers: Number of scheduler threads (one model each)
+    """
+
+    def __init__(self, model_factory, batch_fn, max_batch_size=16, max_wait_ms=5.0,
+                 queue_size=256, timeout=10.0, workers=1, name='batcher'):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.timeout = timeout
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stopping = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._largest_batch = 0
+        self._run_seconds = 0.0
+        self._ready_workers = 0
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._worker, args=(model_factory,),
+                                      name=f"{name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _collect(self, first):
+        """Gather items behind `first` until the batch is full or the wait expires"""
+        batch = [first]
+        deadline = first[2] + self.max_wait
+        stop = False
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                job = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is None:
+                stop = True
+                break
+            batch.append(job)
+        return batch, stop
+
+    def _worker(self, model_factory):
+        try:
+            model = model_factory()
+        except Exception as e:
+            print(f"💥 [{threading.current_thread().name}] Failed to load model: {e}")
+            return
+        with self._stats_lock:
+            self._ready_workers += 1
+
+        stop = False
+        while not stop:
+            first = self._next_item()
+            if first is None:
+                break
+            batch, stop = self._collect(first)
+            batch = [job for job in batch if job[0].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            started = time.perf_counter()
+            try:
+                results = self.batch_fn(model, [item for _, item, _ in batch])
+            except BaseException as e:
+                for future, _, _ in batch:
+                    future.set_exception(e)
+            else:
+                for (future, _, _), result in zip(batch, results):
+                    future.set_result(result)
+
+            with self._stats_lock:
+                self._batches += 1
+                self._items += len(batch)
+                self._largest_batch = max(self._largest_batch, len(batch))
+                self._run_seconds += time.perf_counter() - started
+
+    def _next_item(self, poll_interval=0.5):
+        """Next queued item; None once shutdown() was called and the queue is drained"""
+        while True:
+            try:
+                return self._queue.get(timeout=poll_interval)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return None
+
+    def submit(self, item):
+        """Queue one item and return a Future; raises PoolSaturatedError when full"""
+        if self._stopping.is_set():
+            raise PoolSaturatedError("Batching queue is shutting down")
+        future = Future()
+        try:
+            self._queue.put_nowait((future, item, time.perf_counter()))
+        except queue.Full:
+            raise PoolSaturatedError("Batching queue is full") from None
+        return future
+
+    def run(self, item, timeout=None):
+        """Submit one item and wait for its result"""
+        future = self.submit(item)
+        try:
+            return future.result(timeout=timeout if timeout is not None else self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise InferenceTimeoutError("Batched inference timed out") from None
+
+    def run_many(self, items, timeout=None):
+        """
+        Submit several items together, so they share a batch, and wait for
+        all results (in order)
+        """
+        futures = []
+        try:
+            for item in items:
+                futures.append(self.submit(item))
+        except PoolSaturatedError:
+            for future in futures:
+                future.cancel()
+            raise
+        deadline = time.perf_counter() + (timeout if timeout is not None else self.timeout)
+        try:
+            return [future.result(timeout=max(deadline - time.perf_counter(), 0)) for future in futures]
+        except FutureTimeoutError:
+            for future in futures:
+                future.cancel()
+            raise InferenceTimeoutError("Batched inference timed out") from None
+
+    def stats(self):
+        """Batch counts, average / largest batch size and average batch run time"""
+        with self._stats_lock:
+            return {
+                'workers': len(self._threads),
+                'ready_workers': self._ready_workers,
+                'alive_workers': sum(thread.is_alive() for thread in self._threads),
+                'queue_depth': self._queue.qsize(),
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000,
+                'batches': self._batches,
+                'items': self._items,
+                'avg_batch_size': self._items / self._batches if self._batches else 0.0,
+                'largest_batch': self._largest_batch,
+                'avg_batch_ms': self._run_seconds / self._batches * 1000 if self._batches else 0.0,
+            }
+
+    def shutdown(self, wait=True):
+        """
+        Stop the scheduler threads after the queued items have been served,
+        without blocking on a full queue (see InferencePool.shutdown)
+        """
+        self._stopping.set()
+        for _ in self._threads:
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                break
+        if wait:
+            for thread in self._threads:
+                thread.join()
@@ -0,0 +1,76 @@
+"""
+Convert stored embeddings in face_auth_db.users to the binary format.
+
+Usage:
+    python migrate_embeddings.py                  # float lists -> float32 Binary
+    python migrate_embeddings.py --dtype float16  # also re-encode float32 documents and templates
+    python migrate_embeddings.py --dry-run        # only count what would change
+"""
+import argparse
+import time
+
+from pymongo import MongoClient, UpdateOne
+
+from embedding_codec import EMBEDDING_FIELDS, STORAGE_DTYPES, TEMPLATE_FIELDS, decode_embedding, encode_embedding
+
+
+def migrate(collection, dtype='float32', batch_size=1000, dry_run=False):
+    """
+    Re-encode every document whose embedding or any of its templates'
+    embeddings is not stored as `dtype` Binary, using unordered bulk writes
+    of `batch_size` updates.
+
+    Returns (matched, converted).
+    """
+    stale = [
+        {'embedding': {'$type': 'array'}},
+        {'embedding_dtype': {'$ne': dtype}},
+    ]
+    query = {'$or': [*stale, {'templates': {'$elemMatch': {'$or': stale}}}]}
+    matched = 0
+    converted = 0
+    operations = []
+
+    for document in collection.find(query, {'_id': 1, **EMBEDDING_FIELDS, **TEMPLATE_FIELDS},
+                                    batch_size=batch_size):
+        matched += 1
+        if dry_run:
+            continue
+        fields = encode_embedding(decode_embedding(document), dtype)
+        if document.get('templates'):
+            fields['templates'] = [{**template, **encode_embedding(decode_embedding(template), dtype)}
+                                   for template in document['templates']]
+        operations.append(UpdateOne({'_id': document['_id']}, {'$set': fields}))
+        if len(operations) >= batch_size:
+            converted += collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+            print(f"  Converted {converted} documents...")
+
+    if operations:
+        converted += collection.bulk_write(operations, ordered=False).modified_count
+    return matched, converted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert user embeddings to binary storage")
+    parser.add_argument('--uri', default='mongodb://localhost:27017/', help='MongoDB connection string')
+    parser.add_argument('--db', default='face_auth_db', help='Database name')
+    parser.add_argument('--collection', default='users', help='Collection name')
+    parser.add_argument('--dtype', default='float32', choices=sorted(STORAGE_DTYPES), help='Target storage dtype')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Updates per bulk write')
+    parser.add_argument('--dry-run', action='store_true', help='Only count documents that need converting')
+    args = parser.parse_args()
+
+    collection = MongoClient(args.uri)[args.db][args.collection]
+    print(f"Migrating embeddings in {args.db}.{args.collection} to {args.dtype} Binary...")
+    start = time.perf_counter()
+    matched, converted = migrate(collection, args.dtype, args.batch_size, args.dry_run)
+
+    if args.dry_run:
+        print(f"{matched} documents need converting (dry run, nothing written)")
+    else:
+        print(f"Converted {converted} of {matched} documents in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
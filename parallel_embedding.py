@@ -0,0 +1,144 @@
+"""
+Parallel face embedding extraction for offline evaluation.
+
+Images are split into chunks and embedded by a process pool. Every worker
+process owns its own detection + ArcFace models with a capped number of
+ONNX Runtime intra-op threads (workers x threads ~= cores, and OpenCV's own
+thread pool is disabled in workers), so the pool scales with cores instead
+of oversubscribing them. Inside a worker a prefetch thread reads and
+decodes the next images of the chunk while the models run on the current
+one. Results come back in input order whatever order chunks finish in.
+
+Bulk enrollment (bulk_enroll.py) uses the same pool with details=True to
+also get the bounding box and template quality of each face.
+"""
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+
+from face_models import load_face_analysis
+from face_selection import select_face
+from face_templates import template_quality
+
+_worker_model = None
+
+
+def _init_worker(det_size, intra_op_threads, precision):
+    """Process pool initializer: load this worker's models once"""
+    global _worker_model
+    cv2.setNumThreads(1)
+    _worker_model = load_face_analysis(det_size=det_size, intra_op_threads=intra_op_threads,
+                                       allowed_modules=['detection', 'recognition'], precision=precision)
+
+
+def _prefetch(paths, images):
+    """Decode the chunk's images ahead of the model"""
+    for index, path in enumerate(paths):
+        images.put((index, cv2.imread(str(path))))
+    images.put(None)
+
+
+def _embed_chunk(paths, prefetch=4, face_selection='first', details=False):
+    """
+    Worker task: normed embedding of the face chosen by `face_selection` in
+    every image (None when none), or (embedding, bbox, quality) with details
+    """
+    images = queue.Queue(maxsize=prefetch)
+    threading.Thread(target=_prefetch, args=(paths, images), daemon=True).start()
+
+    embeddings = [None] * len(paths)
+    while True:
+        item = images.get()
+        if item is None:
+            break
+        index, img = item
+        if img is None:
+            continue
+        try:
+            faces = _worker_model.get(img)
+        except Exception as e:
+            print(f"Error processing {paths[index]}: {e}")
+            continue
+        face = select_face(faces, img.shape, face_selection)
+        if face is None:
+            continue
+        embedding = face.normed_embedding.astype(np.float32)
+        if details:
+            embedding = (embedding, face.bbox.astype(int).tolist(), template_quality(face))
+        embeddings[index] = embedding
+    return embeddings
+
+
+class ParallelEmbedder:
+    """
+    Embed many images with a pool of model-owning worker processes.
+
+    Args:
+        workers: Worker processes (default: cores / threads_per_worker)
+        threads_per_worker: ONNX Runtime intra-op threads per worker
+        chunk_size: Images per task
+        det_size: Detector input size
+        precision: Model precision (see face_models.load_models)
+        face_selection: Which face of multi-face images to embed (see face_selection.py)
+    """
+
+    def __init__(self, workers=None, threads_per_worker=1, chunk_size=32, det_size=(640, 640), precision='fp32',
+                 face_selection='first'):
+        self.threads_per_worker = threads_per_worker
+        self.workers = workers or max(1, (os.cpu_count() or 1) // threads_per_worker)
+        self.chunk_size = chunk_size
+        self.det_size = det_size
+        self.precision = precision
+        self.face_selection = face_selection
+        self._pool = None
+
+    def _ensure_pool(self):
+        # Models are only loaded once there is something to embed; spawn
+        # avoids forking a parent that may already hold onnxruntime threads
+        if self._pool is None:
+            print(f"Starting {self.workers} embedding workers x {self.threads_per_worker} threads...")
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(self.det_size, self.threads_per_worker, self.precision),
+            )
+        return self._pool
+
+    def embed_paths(self, paths, desc="Embedding images", details=False):
+        """
+        Embeddings (or None) for paths, in the same order; with details,
+        (embedding, bbox, template quality) tuples instead of embeddings
+        """
+        paths = [str(path) for path in paths]
+        if not paths:
+            return []
+        pool = self._ensure_pool()
+        chunks = [paths[i:i + self.chunk_size] for i in range(0, len(paths), self.chunk_size)]
+        futures = {pool.submit(_embed_chunk, chunk, 4, self.face_selection, details): index
+                   for index, chunk in enumerate(chunks)}
+
+        results = [None] * len(chunks)
+        with tqdm(total=len(paths), desc=desc, unit='img') as progress:
+            for future in as_completed(futures):
+                index = futures[future]
+                results[index] = future.result()
+                progress.update(len(chunks[index]))
+        return [embedding for chunk in results for embedding in chunk]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,57 @@
+"""
+Short-lived cache of face crops for lazily served previews.
+
+API responses can reference a crop by id instead of inlining a base64 JPEG.
+Only the (small, size-limited) BGR crop is kept; it is JPEG-encoded the
+first time the preview URL is actually fetched, so clients that never show
+it never pay for the encoding.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+from image_io import encode_jpeg
+
+
+class CropCache:
+    """TTL + size bounded map of crop id -> face crop"""
+
+    def __init__(self, ttl=60.0, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        while self._entries:
+            crop_id, entry = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_entries and entry['expires'] > now:
+                break
+            del self._entries[crop_id]
+
+    def put(self, crop_bgr, quality):
+        """Store a copy of the crop and return its id"""
+        crop_id = uuid.uuid4().hex
+        now = time.monotonic()
+        with self._lock:
+            self._entries[crop_id] = {
+                'expires': now + self.ttl,
+                'crop': np.array(crop_bgr, copy=True),  # Don't keep the whole frame alive
+                'quality': quality,
+                'jpeg': None,
+            }
+            self._evict(now)
+        return crop_id
+
+    def get_jpeg(self, crop_id):
+        """JPEG bytes of a cached crop (encoded on first access), or None if expired"""
+        with self._lock:
+            entry = self._entries.get(crop_id)
+            if entry is None or entry['expires'] <= time.monotonic():
+                return None
+            if entry['jpeg'] is None:
+                entry['jpeg'] = encode_jpeg(entry['crop'], entry['quality'])
+            return entry['jpeg']
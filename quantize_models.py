@@ -0,0 +1,174 @@
+"""
+Produce INT8-quantized copies of the detector and ArcFace models.
+
+    python quantize_models.py                                  # dynamic, weights only
+    python quantize_models.py --mode static --calibration dataset1 dataset2
+
+The quantized files are written to <pack>/int8/ under the original file
+names and are picked up with MODEL_PRECISION=int8 (see face_models.py).
+
+- dynamic: weights are stored as 8-bit, activations are quantized on the fly
+  per batch. No calibration data needed.
+- static: activations are quantized too (QDQ format), with ranges
+  calibrated on real images from the test datasets: full frames for the
+  detector, aligned 112x112 face crops (found by the FP32 detector) for
+  ArcFace. Usually faster than dynamic, but check the accuracy with
+  benchmark_precision.py before deploying.
+"""
+import argparse
+import json
+import os
+import os.path as osp
+import random
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+import cv2
+import numpy as np
+import onnxruntime
+from insightface.utils import face_align
+from onnxruntime.quantization import (CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType,
+                                      quantize_dynamic, quantize_static)
+from onnxruntime.quantization.shape_inference import quant_pre_process
+
+from face_models import load_models, precision_model_path, PRECISION_SUBDIRS
+from test_datasets import IMAGE_EXTENSIONS
+
+
+class BlobCalibrationReader(CalibrationDataReader):
+    """Feeds preprocessed input blobs to the static quantization calibrator"""
+
+    def __init__(self, input_name, blobs):
+        self.input_name = input_name
+        self._blobs = iter(blobs)
+
+    def get_next(self):
+        blob = next(self._blobs, None)
+        return None if blob is None else {self.input_name: blob}
+
+
+def calibration_images(dataset_paths, num_images, seed=42):
+    """A random sample of image paths across the datasets"""
+    paths = [p for dataset in dataset_paths for p in sorted(Path(dataset).rglob('*'))
+             if p.suffix.lower() in IMAGE_EXTENSIONS]
+    random.Random(seed).shuffle(paths)
+    return paths[:num_images]
+
+
+def detector_blob(det_model, img_bgr, det_size):
+    """The detector input for an image, letterboxed exactly like RetinaFace.detect()"""
+    width, height = det_size
+    scale = min(width / img_bgr.shape[1], height / img_bgr.shape[0])
+    resized = cv2.resize(img_bgr, (int(img_bgr.shape[1] * scale), int(img_bgr.shape[0] * scale)))
+    det_img = np.zeros((height, width, 3), dtype=np.uint8)
+    det_img[:resized.shape[0], :resized.shape[1]] = resized
+    mean = det_model.input_mean
+    return cv2.dnn.blobFromImage(det_img, 1.0 / det_model.input_std, det_size, (mean, mean, mean), swapRB=True)
+
+
+def calibration_blobs(models, image_paths, det_size):
+    """Detector and recognition calibration blobs from the sample images"""
+    det_model = models['detection']
+    det_model.prepare(ctx_id=0, input_size=det_size)
+    rec_model = models.get('recognition')
+    det_blobs, rec_blobs = [], []
+    for path in image_paths:
+        img = cv2.imread(str(path))
+        if img is None:
+            continue
+        det_blobs.append(detector_blob(det_model, img, det_size))
+        if rec_model is None:
+            continue
+        bboxes, kpss = det_model.detect(img, max_num=1)
+        if len(bboxes) == 0:
+            continue
+        crop = face_align.norm_crop(img, landmark=kpss[0], image_size=rec_model.input_size[0])
+        mean = rec_model.input_mean
+        rec_blobs.append(cv2.dnn.blobFromImage(crop, 1.0 / rec_model.input_std, rec_model.input_size,
+                                               (mean, mean, mean), swapRB=True))
+    return {'detection': det_blobs, 'recognition': rec_blobs}
+
+
+def quantize_model(model, output_path, mode, blobs=None, per_channel=False):
+    """Quantize one model file to output_path"""
+    with tempfile.TemporaryDirectory() as tmp:
+        # Shape inference + graph cleanup first, as recommended for onnxruntime quantization
+        source = osp.join(tmp, 'preprocessed.onnx')
+        try:
+            quant_pre_process(model.model_file, source, skip_symbolic_shape=True)
+        except Exception as e:
+            print(f"  Pre-processing skipped ({e})")
+            source = model.model_file
+
+        if mode == 'dynamic':
+            # ConvInteger on CPU needs uint8 weights
+            quantize_dynamic(source, output_path, weight_type=QuantType.QUInt8, per_channel=per_channel)
+        else:
+            quantize_static(source, output_path, BlobCalibrationReader(model.input_name, blobs),
+                            quant_format=QuantFormat.QDQ, activation_type=QuantType.QUInt8,
+                            weight_type=QuantType.QInt8, per_channel=per_channel,
+                            calibrate_method=CalibrationMethod.MinMax)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create INT8 copies of the face models')
+    parser.add_argument('--name', default='buffalo_l', help='InsightFace model pack')
+    parser.add_argument('--root', default='~/.insightface')
+    parser.add_argument('--models', nargs='+', default=['detection', 'recognition'],
+                        choices=['detection', 'recognition'])
+    parser.add_argument('--mode', choices=['dynamic', 'static'], default='dynamic')
+    parser.add_argument('--calibration', nargs='+', default=['dataset1', 'dataset2'],
+                        help='Dataset folders to draw calibration images from (static mode)')
+    parser.add_argument('--num-images', type=int, default=200, help='Calibration images (static mode)')
+    parser.add_argument('--det-size', type=int, default=640)
+    parser.add_argument('--per-channel', action='store_true', help='Per-channel weight quantization')
+    args = parser.parse_args()
+
+    model_dir, models = load_models(args.name, args.root, allowed_modules=['detection', 'recognition'])
+    blobs = {}
+    calibration_count = 0
+    if args.mode == 'static':
+        image_paths = calibration_images([d for d in args.calibration if os.path.exists(d)], args.num_images)
+        if not image_paths:
+            raise SystemExit(f"No calibration images found in {args.calibration}")
+        print(f"Collecting calibration inputs from {len(image_paths)} images...")
+        det_size = (args.det_size, args.det_size)
+        blobs = calibration_blobs(models, image_paths, det_size)
+        calibration_count = len(image_paths)
+        print(f"  {len(blobs['detection'])} detector frames, {len(blobs['recognition'])} aligned faces")
+
+    output_dir = osp.join(model_dir, PRECISION_SUBDIRS['int8'])
+    os.makedirs(output_dir, exist_ok=True)
+    quantized = {}
+    for task in args.models:
+        model = models.get(task)
+        if model is None:
+            print(f"No {task} model in {model_dir}, skipping")
+            continue
+        if args.mode == 'static' and not blobs.get(task):
+            print(f"No calibration data for {task}, skipping")
+            continue
+        output_path = precision_model_path(model.model_file, 'int8')
+        print(f"Quantizing {task} ({osp.basename(model.model_file)}, {args.mode})...")
+        quantize_model(model, output_path, args.mode, blobs.get(task), args.per_channel)
+        size_before = osp.getsize(model.model_file) / 1e6
+        size_after = osp.getsize(output_path) / 1e6
+        print(f"  {size_before:.1f} MB -> {size_after:.1f} MB: {output_path}")
+        quantized[task] = osp.basename(output_path)
+
+    manifest = {
+        'mode': args.mode,
+        'per_channel': args.per_channel,
+        'models': quantized,
+        'calibration_images': calibration_count,
+        'onnxruntime': onnxruntime.__version__,
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+    }
+    with open(osp.join(output_dir, 'quantization.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    print("\nDone. Start the app with MODEL_PRECISION=int8 and compare with benchmark_precision.py")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,465 @@
+"""
+Gallery partitioned across shard processes or nodes.
+
+    python sharded_gallery.py serve --bind 0.0.0.0:7001   # one shard node (key in GALLERY_SHARD_AUTHKEY)
+
+Users are assigned to a shard by a hash of their username, and every shard
+holds its users in its own EmbeddingGallery (centroid matrix, templates).
+A search scatters the probes to all shards at once, each shard answers
+with its local top k (multi-template re-scoring included), and the
+coordinator merges them into the global top k and applies the threshold.
+Registrations and template updates go to the owning shard only. Memory
+and per-query scan time per process are divided by the number of shards.
+
+Shards are reached through multiprocessing.connection (pickled messages
+over TCP, authenticated with a shared key), with a small pool of
+connections per shard so concurrent requests are served concurrently.
+ShardedGallery.spawn() starts local shard processes of this same server,
+so the sharded mode runs on one machine without a cluster.
+
+A search fails with ShardUnavailableError when any shard does not answer:
+partial results could accept the wrong user whose true match is on the
+missing shard. For the same reason a shard that restarted (it comes back
+empty) is reloaded from MongoDB by the first coordinator request that
+sees it, and requests answered by the empty shard are sent again.
+"""
+import argparse
+import os
+import queue
+import secrets
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+from embedding_codec import EMBEDDING_FIELDS, TEMPLATE_FIELDS, decode_embedding, decode_templates
+from gallery import EmbeddingGallery, EMBEDDING_DIM
+
+
+class ShardUnavailableError(RuntimeError):
+    """A shard did not answer (down, unreachable or slower than the timeout)"""
+
+
+def shard_of(username, shards):
+    """Stable shard number of a username (the same in every process and run)"""
+    return zlib.crc32(username.encode()) % shards
+
+
+def parse_address(text):
+    host, _, port = text.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+class ShardServer:
+    """Serves one shard's EmbeddingGallery, one thread per coordinator connection"""
+
+    def __init__(self, address, authkey, template_rerank_k=10):
+        self.gallery = EmbeddingGallery(template_rerank_k=template_rerank_k)
+        self.listener = Listener(address, authkey=authkey)
+        # Tells coordinators this process apart from an earlier (restarted) one
+        self.instance = secrets.token_hex(8)
+        self._add_lock = threading.Lock()
+
+    @property
+    def address(self):
+        return self.listener.address
+
+    def serve_forever(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except (AuthenticationError, OSError) as e:
+                print(f"🔒 [SHARD] Rejected connection: {e}")
+                continue
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        try:
+            while True:
+                op, args = conn.recv()
+                try:
+                    reply = (True, self._handle(op, *args))
+                except Exception as e:
+                    reply = (False, e)
+                conn.send((reply, (self.instance, self.gallery.version, len(self.gallery))))
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def _handle(self, op, *args):
+        gallery = self.gallery
+        if op == 'search_many':
+            return gallery.search_many(*args)
+        if op == 'add_many':
+            usernames, embeddings, templates = args
+            # Idempotent, so coordinators loading the same collection cannot duplicate users
+            with self._add_lock:
+                keep = [i for i, username in enumerate(usernames) if username not in gallery]
+                if keep:
+                    gallery.add_many([usernames[i] for i in keep], np.asarray(embeddings)[keep],
+                                     [templates[i] for i in keep])
+            return len(keep)
+        if op == 'update':
+            return gallery.update(*args)
+        if op == 'contains':
+            return args[0] in gallery
+        if op == 'score_all':
+            scores, usernames = gallery.score_all(*args)
+            return scores, list(usernames[:len(scores)])
+        if op == 'stats':
+            return {'users': len(gallery), 'nbytes': gallery.nbytes(), 'version': gallery.version,
+                    'instance': self.instance}
+        raise ValueError(f"Unknown shard operation '{op}'")
+
+
+class _ShardClient:
+    """Pool of connections to one shard; a connection carries one request at a time"""
+
+    def __init__(self, address, authkey, timeout):
+        self.address = address
+        self.authkey = authkey
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            try:
+                return Client(self.address, authkey=self.authkey)
+            except (OSError, AuthenticationError) as e:
+                raise ShardUnavailableError(f"Shard {self.address} unreachable: {e}") from e
+
+    def release(self, conn):
+        self._idle.put(conn)
+
+    def receive(self, conn):
+        """Reply to the request sent on conn; conn is closed (not reused) on failure"""
+        try:
+            if not conn.poll(self.timeout):
+                raise ShardUnavailableError(f"Shard {self.address} did not answer within {self.timeout}s")
+            reply = conn.recv()
+        except (EOFError, OSError) as e:
+            conn.close()
+            self.close()  # The idle connections most likely died with it (shard restarted)
+            raise ShardUnavailableError(f"Shard {self.address} connection lost: {e}") from e
+        except ShardUnavailableError:
+            conn.close()
+            raise
+        self.release(conn)
+        return reply
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class ShardedGallery:
+    """
+    Coordinator with the EmbeddingGallery interface used by app.py, over
+    shard servers at `addresses`.
+
+    len() and `version` come from the shard states (process instance,
+    gallery version, size) piggybacked on every reply, so they cost no
+    round trip. `version` is this coordinator's own counter, bumped
+    whenever a shard's state changes, so it sees changes made by other
+    coordinators (or a shard restart) at its next request to that shard.
+
+    Once load_from_collection() has run, a shard answering from a new
+    process instance is reloaded with its users from the same collection
+    before its replies are used.
+    """
+
+    def __init__(self, addresses, authkey, timeout=5.0, dim=EMBEDDING_DIM):
+        self.dim = dim
+        self.index = None  # Shards search exactly; no ANN index
+        # Each shard re-scores its own template shortlist, and the coordinator
+        # does not know whether multi-template users exist: not exact
+        self.exact_search = False
+        self._clients = [_ShardClient(address, authkey, timeout) for address in addresses]
+        self._states = [None] * len(addresses)
+        self._instances = [None] * len(addresses)  # Instance whose users this coordinator loaded
+        self._reload_locks = [threading.Lock() for _ in addresses]
+        self._state_lock = threading.Lock()
+        self._version = 0
+        self._collection = None
+        self._processes = []
+        self.refresh()
+
+    @classmethod
+    def spawn(cls, shards, authkey=None, timeout=5.0, template_rerank_k=10, startup_timeout=60.0):
+        """Start `shards` local shard processes and connect to them"""
+        authkey = authkey or secrets.token_bytes(16)
+        processes = []
+        addresses = []
+        for _ in range(shards):
+            # The child exits when its stdin closes, i.e. when this process goes away
+            process = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), 'serve', '--bind', '127.0.0.1:0', '--with-parent',
+                 '--template-rerank-k', str(template_rerank_k)],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+                env={**os.environ, 'GALLERY_SHARD_AUTHKEY': authkey.hex()})
+            processes.append(process)
+        deadline = time.monotonic() + startup_timeout
+        for process in processes:
+            line = _read_line(process, deadline - time.monotonic())
+            if line is None or len(line.split()) != 2 or line.split()[0] != 'READY':
+                for started in processes:
+                    started.kill()
+                reason = f'did not start within {startup_timeout}s' if line is None else 'failed to start'
+                raise ShardUnavailableError(f"Local shard process {reason}")
+            addresses.append(parse_address(line.split()[1]))
+            threading.Thread(target=_forward_output, args=(process,), daemon=True).start()
+        print(f"🧩 [SHARDS] Started {shards} local shard processes")
+        gallery = cls(addresses, authkey, timeout)
+        gallery._processes = processes
+        return gallery
+
+    @property
+    def shards(self):
+        return len(self._clients)
+
+    @property
+    def version(self):
+        return self._version
+
+    def __len__(self):
+        return sum(state[2] for state in self._states if state is not None)
+
+    @staticmethod
+    def _result(reply):
+        (ok, result), _ = reply
+        if not ok:
+            raise result
+        return result
+
+    def _observe(self, shard, reply):
+        """
+        Record the shard state of a reply. Returns True when the reply came
+        from a shard process that restarted since its users were loaded: the
+        shard has been reloaded meanwhile and the request must be sent again.
+        """
+        state = reply[1]
+        with self._state_lock:
+            if state != self._states[shard]:
+                self._states[shard] = state
+                self._version += 1
+        instance = state[0]
+        if self._instances[shard] == instance:
+            return False
+        with self._reload_locks[shard]:
+            if self._instances[shard] is None or self._collection is None:
+                self._instances[shard] = instance  # First contact: loaded by load_from_collection()
+                return False
+            if self._instances[shard] != instance:
+                print(f"🧩 [SHARDS] Shard {self._clients[shard].address} restarted, reloading its users")
+                self._load(self._collection, only_shard=shard)
+                self._instances[shard] = instance
+        return True
+
+    def _request(self, shard, op, args):
+        """Raw reply of one shard to one request"""
+        client = self._clients[shard]
+        conn = client.acquire()
+        try:
+            conn.send((op, args))
+        except OSError as e:
+            conn.close()
+            client.close()
+            raise ShardUnavailableError(f"Shard {client.address} connection lost: {e}") from e
+        return client.receive(conn)
+
+    def _call(self, shard, op, *args):
+        reply = self._request(shard, op, args)
+        if self._observe(shard, reply):
+            reply = self._request(shard, op, args)
+            self._observe(shard, reply)
+        return self._result(reply)
+
+    def _scatter(self, op, *args):
+        """Send the request to every shard first, then collect the replies, so shards work in parallel"""
+        sent = []
+        failure = None
+        for shard, client in enumerate(self._clients):
+            try:
+                conn = client.acquire()
+                conn.send((op, args))
+                sent.append((shard, conn))
+            except (OSError, ShardUnavailableError) as e:
+                client.close()
+                failure = failure or ShardUnavailableError(f"Shard {client.address}: {e}")
+        replies = {}
+        for shard, conn in sent:
+            try:
+                replies[shard] = self._clients[shard].receive(conn)
+            except ShardUnavailableError as e:
+                failure = failure or e
+        if failure is not None:
+            raise failure
+        results = []
+        for shard in range(self.shards):
+            reply = replies[shard]
+            if self._observe(shard, reply):
+                reply = self._request(shard, op, args)
+                self._observe(shard, reply)
+            results.append(self._result(reply))
+        return results
+
+    def refresh(self):
+        """Fetch every shard's size and version; returns the per-shard stats"""
+        return self._scatter('stats')
+
+    def load_from_collection(self, collection, batch_size=10000):
+        """
+        Stream the MongoDB collection to the shards in batches, so the
+        coordinator never holds the whole gallery. Users a shard already
+        holds (loaded by another coordinator or an earlier run) are skipped.
+        The collection is kept to reload shards that restart.
+        """
+        self._load(collection, batch_size=batch_size)
+        self._collection = collection
+        self.refresh()
+        return len(self)
+
+    def _load(self, collection, batch_size=10000, only_shard=None):
+        """Send the users of the collection (those of `only_shard` if given) to their shards"""
+        buckets = [([], [], []) for _ in range(self.shards)]
+
+        def flush(shard):
+            usernames, embeddings, templates = buckets[shard]
+            if usernames:
+                # Straight to the shard: during a reload its new instance is not recorded yet
+                reply = self._request(shard, 'add_many', (usernames, np.stack(embeddings), templates))
+                self._result(reply)
+                buckets[shard] = ([], [], [])
+
+        for user in collection.find({}, {'username': 1, '_id': 0, **EMBEDDING_FIELDS, **TEMPLATE_FIELDS}):
+            if 'embedding' not in user:
+                continue
+            shard = shard_of(user['username'], self.shards)
+            if only_shard is not None and shard != only_shard:
+                continue
+            usernames, embeddings, templates = buckets[shard]
+            usernames.append(user['username'])
+            embeddings.append(np.asarray(decode_embedding(user), dtype=np.float32))
+            templates.append(decode_templates(user) if len(user.get('templates') or []) > 1 else None)
+            if len(usernames) >= batch_size:
+                flush(shard)
+        for shard in range(self.shards):
+            flush(shard)
+
+    def add(self, username, embedding, templates=None):
+        self._call(shard_of(username, self.shards), 'add_many', [username],
+                   np.asarray(embedding, dtype=np.float32).reshape(1, -1), [templates])
+
+    def add_many(self, usernames, embeddings, templates=None):
+        """Append users, one request per shard"""
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(usernames), -1)
+        templates = templates if templates is not None else [None] * len(usernames)
+        owners = np.array([shard_of(username, self.shards) for username in usernames], dtype=np.int64)
+        for shard in range(self.shards):
+            rows = np.flatnonzero(owners == shard)
+            if len(rows):
+                self._call(shard, 'add_many', [usernames[i] for i in rows], embeddings[rows],
+                           [templates[i] for i in rows])
+
+    def update(self, username, embedding, templates=None, revision=0):
+        self._call(shard_of(username, self.shards), 'update', username, embedding, templates, revision)
+
+    def __contains__(self, username):
+        return self._call(shard_of(username, self.shards), 'contains', username)
+
+    def nbytes(self):
+        return sum(stats['nbytes'] for stats in self.refresh())
+
+    def score_all(self, probe):
+        """Scores against every user of every shard (for debug dumps)"""
+        replies = self._scatter('score_all', probe)
+        scores = np.concatenate([shard_scores for shard_scores, _ in replies])
+        return scores, [username for _, usernames in replies for username in usernames]
+
+    def search_many(self, probes, k=10):
+        """Global top-k (scores, usernames) per probe, merged from every shard's local top-k"""
+        probes = np.asarray(probes, dtype=np.float32).reshape(-1, self.dim)
+        replies = self._scatter('search_many', probes, k)
+        results = []
+        for position in range(len(probes)):
+            scores = np.concatenate([reply[position][0] for reply in replies])
+            usernames = [username for reply in replies for username in reply[position][1]]
+            order = np.argsort(-scores, kind='stable')[:k]
+            results.append((scores[order], [usernames[i] for i in order]))
+        return results
+
+    def search(self, probe, k=10):
+        return self.search_many([probe], k)[0]
+
+    def identify(self, probe, threshold=0.25, k=5):
+        scores, usernames = self.search(probe, k=k)
+        return EmbeddingGallery._decide(scores, usernames, threshold)
+
+    def identify_many(self, probes, threshold=0.25, k=5):
+        return [EmbeddingGallery._decide(scores, usernames, threshold)
+                for scores, usernames in self.search_many(probes, k)]
+
+    def close(self):
+        for client in self._clients:
+            client.close()
+        for process in self._processes:
+            process.stdin.close()
+            process.wait(timeout=10)
+        self._processes = []
+
+
+def _read_line(process, timeout):
+    """Next line of the process' stdout, or None when none comes within `timeout` seconds"""
+    lines = queue.Queue()
+    threading.Thread(target=lambda: lines.put(process.stdout.readline()), daemon=True).start()
+    try:
+        return lines.get(timeout=max(timeout, 0))
+    except queue.Empty:
+        return None
+
+
+def _forward_output(process):
+    # Keep the shard's log lines flowing (and its stdout pipe from filling up)
+    for line in process.stdout:
+        print(line, end='')
+
+
+def _exit_with_parent():
+    # Local shards: stdin is a pipe from the coordinator and closes when it exits
+    sys.stdin.read()
+    os._exit(0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gallery shard server")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve = subparsers.add_parser('serve', help='Serve one gallery shard')
+    serve.add_argument('--bind', default='0.0.0.0:7001', help='host:port to listen on (port 0 picks a free one)')
+    serve.add_argument('--template-rerank-k', type=int, default=int(os.environ.get('TEMPLATE_RERANK_K', 10)))
+    serve.add_argument('--with-parent', action='store_true', help='Exit when stdin closes (local shards)')
+    args = parser.parse_args()
+
+    authkey = os.environ.get('GALLERY_SHARD_AUTHKEY')
+    if not authkey:
+        raise SystemExit("Set GALLERY_SHARD_AUTHKEY (hex) to the key shared with the coordinators")
+    server = ShardServer(parse_address(args.bind), bytes.fromhex(authkey), args.template_rerank_k)
+    if args.with_parent:
+        threading.Thread(target=_exit_with_parent, daemon=True).start()
+    host, port = server.address
+    print(f"READY {host}:{port}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,384 @@
+"""
+Gallery shared by the worker processes of a node through memory-mapped files.
+
+Under a multi-process server (gunicorn-style workers) every worker would
+otherwise load its own copy of every embedding from MongoDB. Here the
+centroid matrix and the extra templates of multi-template users live in
+files under one directory (in /dev/shm they stay in RAM) that every worker
+maps read-only, so the node holds a single copy in its page cache:
+
+    CURRENT                     published state: generation, version, size, log_bytes, template_rows, content
+    matrix.<generation>.f32     capacity x 512 float32 rows (normalized centroids)
+    templates.<generation>.f32  template rows of multi-template users
+    users.<generation>.jsonl    append-only log, one line per added or updated user
+    LOCK                        fcntl lock serializing writers
+
+A registration in any worker takes the lock, writes its row past the
+published size (or in place for a template update, as EmbeddingGallery
+does), appends a log line and atomically replaces CURRENT with the next
+version. The other workers notice the change by reading the few bytes of
+CURRENT once per search and replay only the new log lines; the rows
+themselves are already in the shared mapping. Running out of capacity
+writes a new generation with doubled files, and the old generation's files
+are unlinked (workers still mapping them keep them alive until they switch).
+
+The first worker to start loads MongoDB and publishes the gallery; later
+workers (and restarts) map it without reading the embeddings again, unless
+the collection's users no longer match it (users enrolled, updated or
+deleted while no server was running, e.g. by bulk_enroll.py). They are
+compared by count and by an order-independent digest of every user's
+username and template revision (`content`, see fingerprint()).
+"""
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+from embedding_codec import EMBEDDING_FIELDS, TEMPLATE_FIELDS, decode_embedding, decode_templates
+from gallery import EmbeddingGallery, EMBEDDING_DIM
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Users that have an embedding; the others are skipped by the loaders
+ENROLLED = {'embedding': {'$exists': True}}
+
+_DIGEST_MODULUS = 1 << 160
+
+
+def _content_digest(users, digest=0, sign=1):
+    """Add (or with sign=-1 remove) (username, revision) pairs to an order-independent digest"""
+    for username, revision in users:
+        line = EmbeddingGallery._fingerprint_line(username, revision)
+        digest += sign * int.from_bytes(hashlib.sha1(line.encode()).digest(), 'big')
+    return digest % _DIGEST_MODULUS
+
+
+class SharedGallery(EmbeddingGallery):
+    """
+    EmbeddingGallery whose storage is the memory-mapped gallery in `directory`.
+
+    Searches run the inherited code over the mapped matrix after applying
+    the changes other workers published; add/add_many/update publish
+    instead of writing private memory. There is no ANN index: it would be
+    a private per-process copy again.
+    """
+
+    def __init__(self, directory, dim=EMBEDDING_DIM, initial_capacity=1024, template_rerank_k=10):
+        if fcntl is None:
+            raise RuntimeError("The shared gallery needs POSIX file locks (fcntl)")
+        self._published_version = 0
+        super().__init__(dim, 1, template_rerank_k)
+        self.directory = directory
+        self.initial_capacity = initial_capacity
+        self._state = None
+        self._current = None  # Raw bytes of the applied CURRENT
+        self._template_rows = None
+        self._sync_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._sync()
+
+    # -- Reading the published state ---------------------------------------
+
+    def _path(self, name, generation=None):
+        return os.path.join(self.directory, name if generation is None else f"{name}.{generation}")
+
+    @property
+    def version(self):
+        self._sync()
+        return self._published_version
+
+    @version.setter
+    def version(self, value):
+        self._published_version = value
+
+    def _read_current(self):
+        try:
+            with open(self._path('CURRENT'), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _sync(self):
+        """Apply what any worker published since the last call (one small read when nothing was)"""
+        current = self._read_current()
+        if current is None or current == self._current:
+            return
+        with self._sync_lock:
+            for _ in range(3):
+                try:
+                    state = json.loads(current)
+                    if self._state is None or state['version'] != self._state['version']:
+                        self._apply(state)
+                    self._current = current
+                    return
+                except FileNotFoundError:
+                    # A new generation replaced the files while they were being opened
+                    current = self._read_current()
+
+    def _read_log(self, generation, start, end):
+        with open(self._path('users', generation) + '.jsonl', 'rb') as f:
+            f.seek(start)
+            return [json.loads(line) for line in f.read(end - start).splitlines() if line]
+
+    def _map(self, name, generation):
+        return np.memmap(self._path(name, generation) + '.f32', dtype=np.float32, mode='r').reshape(-1, self.dim)
+
+    def _apply(self, state):
+        generation = state['generation']
+        if self._state is None or self._state['generation'] != generation:
+            matrix = self._map('matrix', generation)
+            template_rows = self._map('templates', generation)
+            records = self._read_log(generation, 0, state['log_bytes'])
+            usernames, templates, revisions = [], [], []
+            multi_template_users = self._replay(records, usernames, templates, revisions, template_rows)
+            with self._lock:
+                self._matrix = matrix
+                self._template_rows = template_rows
+                self._usernames = usernames
+                self._templates = templates
+                self._revisions = revisions
+                self._rows = {username: row for row, username in enumerate(usernames)}
+                self._multi_template_users = multi_template_users
+                self._size = state['size']
+                self.version = state['version']
+        else:
+            records = self._read_log(generation, self._state['log_bytes'], state['log_bytes'])
+            with self._lock:
+                self._multi_template_users += self._replay(
+                    records, self._usernames, self._templates, self._revisions, self._template_rows)
+                for record in records:
+                    self._rows[record['username']] = record['row']
+                self._size = state['size']
+                self.version = state['version']
+        self._state = state
+
+    @staticmethod
+    def _replay(records, usernames, templates, revisions, template_rows):
+        """Apply log records to the lists; returns the change in multi-template users"""
+        change = 0
+        for record in records:
+            start, count = record['templates'] or (0, 0)
+            matrix = template_rows[start:start + count] if count else None
+            if record['row'] == len(usernames):
+                usernames.append(record['username'])
+                templates.append(matrix)
+                revisions.append(record['revision'])
+                change += matrix is not None
+            else:
+                change += (matrix is not None) - (templates[record['row']] is not None)
+                templates[record['row']] = matrix
+                revisions[record['row']] = record['revision']
+        return change
+
+    def _snapshot(self):
+        self._sync()
+        return super()._snapshot()
+
+    def __len__(self):
+        self._sync()
+        return self._size
+
+    def __contains__(self, username):
+        self._sync()
+        return username in self._rows
+
+    def score_all(self, probe):
+        self._sync()
+        return super().score_all(probe)
+
+    @property
+    def exact_search(self):
+        self._sync()
+        return self._multi_template_users == 0
+
+    # -- Publishing ----------------------------------------------------------
+
+    @contextmanager
+    def _writer(self):
+        """Exclusive writer lock across processes, with the latest state applied"""
+        with open(self._path('LOCK'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._sync()
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self._sync()
+
+    def _publish(self, state):
+        temporary = self._path('CURRENT.tmp')
+        with open(temporary, 'w') as f:
+            json.dump(state, f)
+        os.replace(temporary, self._path('CURRENT'))
+
+    def fingerprint(self):
+        """
+        Order-independent digest of the usernames and template revisions
+        (compared with the collection's by load_from_collection)
+        """
+        self._sync()
+        return self._state.get('content', '') if self._state is not None else ''
+
+    def _write_generation(self, generation, version, vectors, users, capacity, template_capacity):
+        """
+        Write a complete generation and publish it. `users` holds
+        (username, template matrix or None, revision) per row of `vectors`.
+        """
+        matrix = np.memmap(self._path('matrix', generation) + '.f32', dtype=np.float32, mode='w+',
+                           shape=(capacity, self.dim))
+        matrix[:len(vectors)] = vectors
+        template_rows = np.memmap(self._path('templates', generation) + '.f32', dtype=np.float32, mode='w+',
+                                  shape=(template_capacity, self.dim))
+        position = 0
+        lines = []
+        for row, (username, templates, revision) in enumerate(users):
+            span = None
+            if templates is not None:
+                template_rows[position:position + len(templates)] = templates
+                span = [position, len(templates)]
+                position += len(templates)
+            lines.append(json.dumps({'username': username, 'row': row, 'templates': span, 'revision': revision}))
+        matrix.flush()
+        template_rows.flush()
+        del matrix, template_rows
+        log = ''.join(line + '\n' for line in lines).encode()
+        with open(self._path('users', generation) + '.jsonl', 'wb') as f:
+            f.write(log)
+
+        content = _content_digest((username, revision) for username, _, revision in users)
+        self._publish({'generation': generation, 'version': version, 'size': len(vectors),
+                       'log_bytes': len(log), 'template_rows': position, 'content': f"{content:040x}"})
+        for name, suffix in (('matrix', '.f32'), ('templates', '.f32'), ('users', '.jsonl')):
+            for old in range(1, generation):
+                try:
+                    os.remove(self._path(name, old) + suffix)
+                except FileNotFoundError:
+                    pass
+
+    @staticmethod
+    def _capacity(rows, minimum):
+        capacity = max(minimum, 1)
+        while capacity < rows:
+            capacity *= 2
+        return capacity
+
+    def _grow(self, rows, template_rows):
+        """New generation holding the current users with room for at least the given totals"""
+        state = self._state
+        users = [(self._usernames[row], self._templates[row], self._revisions[row]) for row in range(self._size)]
+        capacity = self._capacity(rows, 2 * self._matrix.shape[0])
+        template_capacity = self._capacity(template_rows, 2 * self._template_rows.shape[0])
+        self._write_generation(state['generation'] + 1, state['version'] + 1, self._matrix[:self._size],
+                               users, capacity, template_capacity)
+        self._sync()
+
+    def _write(self, entries):
+        """
+        Publish added or updated users: entries of (username, normalized
+        vector, template matrix or None, revision, row or None for a new user)
+        """
+        with self._writer():
+            if self._state is None:
+                self._write_generation(1, 1, np.empty((0, self.dim), np.float32), [], self.initial_capacity,
+                                       self.initial_capacity)
+                self._sync()
+            new_rows = sum(row is None for *_, row in entries)
+            new_templates = sum(len(t) for _, _, t, _, _ in entries if t is not None)
+            if (self._size + new_rows > self._matrix.shape[0]
+                    or self._state['template_rows'] + new_templates > self._template_rows.shape[0]):
+                # Template rows replaced by updates are garbage; growing compacts them away
+                live_templates = sum(len(t) for t in self._templates[:self._size] if t is not None)
+                self._grow(self._size + new_rows, live_templates + new_templates)
+
+            state = self._state
+            generation = state['generation']
+            matrix = np.memmap(self._path('matrix', generation) + '.f32', dtype=np.float32, mode='r+',
+                               shape=self._matrix.shape)
+            template_rows = np.memmap(self._path('templates', generation) + '.f32', dtype=np.float32, mode='r+',
+                                      shape=self._template_rows.shape)
+            size = state['size']
+            position = state['template_rows']
+            content = int(state.get('content') or '0', 16)
+            revisions = {}
+            lines = []
+            for username, vector, templates, revision, row in entries:
+                if row is None:
+                    row = size
+                    size += 1
+                else:
+                    previous = revisions.get(row, self._revisions[row])
+                    content = _content_digest([(username, previous)], content, sign=-1)
+                content = _content_digest([(username, revision)], content)
+                revisions[row] = revision
+                # Rows past the published size are invisible until CURRENT changes;
+                # updated rows change in place, like EmbeddingGallery.update()
+                matrix[row] = vector
+                span = None
+                if templates is not None:
+                    template_rows[position:position + len(templates)] = templates
+                    span = [position, len(templates)]
+                    position += len(templates)
+                lines.append(json.dumps({'username': username, 'row': row, 'templates': span, 'revision': revision}))
+            del matrix, template_rows
+
+            with open(self._path('users', generation) + '.jsonl', 'r+b') as f:
+                # Drop a tail left by a writer that died before publishing
+                f.seek(state['log_bytes'])
+                f.write(''.join(line + '\n' for line in lines).encode())
+                f.truncate()
+                log_bytes = f.tell()
+            self._publish({'generation': generation, 'version': state['version'] + 1, 'size': size,
+                           'log_bytes': log_bytes, 'template_rows': position, 'content': f"{content:040x}"})
+
+    def add(self, username, embedding, templates=None):
+        self._write([(username, self._normalize(embedding), self._template_matrix(templates), 0, None)])
+
+    def add_many(self, usernames, embeddings, templates=None):
+        vectors = self._normalize_rows(embeddings)
+        templates = templates if templates is not None else [None] * len(vectors)
+        self._write([(username, vector, self._template_matrix(t), 0, None)
+                     for username, vector, t in zip(usernames, vectors, templates)])
+
+    def update(self, username, embedding, templates=None, revision=0):
+        """Replace a registered user's centroid and templates for every worker; KeyError for unknown users"""
+        self._sync()
+        row = self._rows[username]
+        self._write([(username, self._normalize(embedding), self._template_matrix(templates), revision, row)])
+
+    def attach_index(self, index, prebuilt=False):
+        raise ValueError("ANN indexes are not supported by the shared gallery")
+
+    def load_from_collection(self, collection):
+        """
+        Publish every user of the MongoDB collection, unless another worker
+        already published a gallery with the same users and template
+        revisions (only usernames and revisions are read to check that)
+        """
+        with self._writer():
+            if self._state is not None and self._size == collection.count_documents(ENROLLED):
+                enrolled = collection.find(ENROLLED, {'username': 1, 'template_revision': 1, '_id': 0})
+                content = _content_digest((user['username'], user.get('template_revision') or 0)
+                                          for user in enrolled)
+                if f"{content:040x}" == self._state.get('content'):
+                    return self._size
+
+            rows, users = [], []
+            for user in collection.find(ENROLLED, {'username': 1, '_id': 0, **EMBEDDING_FIELDS, **TEMPLATE_FIELDS}):
+                rows.append(self._normalize(decode_embedding(user)))
+                templates = self._template_matrix(decode_templates(user)) if user.get('templates') else None
+                users.append((user['username'], templates, user.get('template_revision') or 0))
+            vectors = np.stack(rows) if rows else np.empty((0, self.dim), np.float32)
+            template_count = sum(len(t) for _, t, _ in users if t is not None)
+
+            generation = self._state['generation'] + 1 if self._state is not None else 1
+            version = self._state['version'] + 1 if self._state is not None else 1
+            self._write_generation(generation, version, vectors, users,
+                                   self._capacity(len(users), self.initial_capacity),
+                                   self._capacity(template_count, self.initial_capacity))
+        return len(self)
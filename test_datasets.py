@@ -2,28 +2,53 @@ import cv2
 import numpy as np
 import os
 from pathlib import Path
-from insightface.app import FaceAnalysis
+from face_models import load_face_analysis, model_version
+from embedding_cache import EmbeddingCache, file_sha1
+from parallel_embedding import ParallelEmbedder
+import evaluation
+from evaluation import threshold_metrics
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 import json
 from datetime import datetime
 import random
 
-# Load ArcFace model
-print("Loading ArcFace model...")
-face_app = FaceAnalysis(providers=['CPUExecutionProvider'])
-face_app.prepare(ctx_id=0, det_size=(640, 640))
-print("Model loaded successfully!\n")
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.bmp']
 
-def get_embedding(image_path):
+# Embeddings are cached on disk by image content hash and model version, so
+# re-running the evaluation only embeds new or changed images (EMBEDDING_CACHE=0 disables)
+EMBEDDING_CACHE_DIR = os.environ.get('EMBEDDING_CACHE_DIR', 'embedding_cache')
+USE_EMBEDDING_CACHE = os.environ.get('EMBEDDING_CACHE', '1') == '1'
+
+# Parallel extraction: EMBEDDING_WORKERS processes, each with its own model
+# limited to EMBEDDING_THREADS_PER_WORKER ONNX Runtime threads (1 = sequential)
+EMBEDDING_THREADS_PER_WORKER = int(os.environ.get('EMBEDDING_THREADS_PER_WORKER', 2))
+EMBEDDING_WORKERS = int(os.environ.get('EMBEDDING_WORKERS', max(1, (os.cpu_count() or 1) // EMBEDDING_THREADS_PER_WORKER)))
+
+# Also score every genuine/impostor pair and report exact EER and FRR@FAR
+EXHAUSTIVE_EVALUATION = os.environ.get('EXHAUSTIVE_EVALUATION', '1') == '1'
+
+# ArcFace model, loaded on first use so other scripts can import the metrics
+face_app = None
+
+def get_face_app():
+    """Load the ArcFace model (detection + recognition only) once"""
+    global face_app
+    if face_app is None:
+        print("Loading ArcFace model...")
+        # Optimised graphs are cached between runs
+        face_app = load_face_analysis(det_size=(640, 640), allowed_modules=['detection', 'recognition'])
+        print("Model loaded successfully!\n")
+    return face_app
+
+def get_embedding(image_path, model=None):
     """Extract face embedding from an image"""
     try:
         img = cv2.imread(str(image_path))
         if img is None:
             return None
         
-        img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        faces = face_app.get(img)
+        faces = (model or get_face_app()).get(img)
         
         if not faces:
             return None
@@ -35,17 +60,24 @@ def get_embedding(image_path):
         print(f"Error processing {image_path}: {e}")
         return None
 
-def cosine_similarity(emb1, emb2):
-    """Calculate cosine similarity between two embeddings"""
-    return np.dot(emb1, emb2) / (np.linalg.norm(emb1) * np.linalg.norm(emb2))
+def pair_similarities(pairs):
+    """Cosine similarities of a list of pairs in one vectorized pass"""
+    if not pairs:
+        return np.empty(0, dtype=np.float32)
+    emb1 = np.stack([pair['img1']['embedding'] for pair in pairs]).astype(np.float32)
+    emb2 = np.stack([pair['img2']['embedding'] for pair in pairs]).astype(np.float32)
+    norms = np.linalg.norm(emb1, axis=1) * np.linalg.norm(emb2, axis=1)
+    return np.einsum('ij,ij->i', emb1, emb2) / norms
 
-def test_dataset(dataset_path, num_test_pairs=100):
+def test_dataset(dataset_path, num_test_pairs=100, cache=None, embedder=None):
     """
     Test face recognition on a dataset
     
     Args:
         dataset_path: Path to the dataset folder
         num_test_pairs: Number of positive and negative pairs to test
+        cache: Optional EmbeddingCache reused across runs
+        embedder: Optional ParallelEmbedder for images missing from the cache
     
     Returns:
         Dictionary containing test results
@@ -55,23 +87,67 @@ def test_dataset(dataset_path, num_test_pairs=100):
     print(f"Testing dataset: {dataset_path.name}")
     print(f"{'='*80}")
     
+    embeddings_db, failed_images = load_dataset_embeddings(dataset_path, cache=cache, embedder=embedder)
+    return evaluate_embeddings(dataset_path.name, embeddings_db, failed_images, num_test_pairs)
+
+def embed_images(image_paths, embed_fn=get_embedding, cache=None, embedder=None):
+    """
+    Embeddings (None where no face was found) for image_paths, in order.
+    Cached images are looked up by content hash; the rest are embedded by the
+    parallel embedder when given, otherwise one by one with embed_fn.
+    """
+    keys = [file_sha1(path) for path in image_paths] if cache is not None else None
+    embeddings = [None] * len(image_paths)
+    missing = []
+    for i in range(len(image_paths)):
+        if cache is not None:
+            found, embedding = cache.get(keys[i])
+            if found:
+                embeddings[i] = embedding
+                continue
+        missing.append(i)
+    
+    if embedder is not None:
+        computed = embedder.embed_paths([image_paths[i] for i in missing])
+    else:
+        computed = [embed_fn(image_paths[i]) for i in tqdm(missing, desc="Embedding images", unit='img')]
+    
+    for i, embedding in zip(missing, computed):
+        embeddings[i] = embedding
+        if cache is not None:
+            cache.put(keys[i], embedding)
+    return embeddings
+
+def load_dataset_embeddings(dataset_path, embed_fn=get_embedding, cache=None, embedder=None):
+    """
+    Embed every image of a dataset (one folder per person), looking images
+    up in the embedding cache first when one is given
+    
+    Returns:
+        ({person_id: [{'path', 'embedding'}, ...]}, failed image paths)
+    """
+    dataset_path = Path(dataset_path)
+    
     # Get all person folders
-    person_folders = [f for f in dataset_path.iterdir() if f.is_dir()]
+    person_folders = sorted(f for f in dataset_path.iterdir() if f.is_dir())
     print(f"Number of persons: {len(person_folders)}")
     
+    person_images = [
+        (person_folder.name, sorted(f for f in person_folder.iterdir() if f.suffix.lower() in IMAGE_EXTENSIONS))
+        for person_folder in person_folders
+    ]
+    image_paths = [img_path for _, images in person_images for img_path in images]
+    
     # Load all embeddings
+    print(f"\nLoading embeddings for all {len(image_paths)} images...")
+    embeddings = iter(embed_images(image_paths, embed_fn, cache, embedder))
     embeddings_db = {}
     failed_images = []
     
-    print("\nLoading embeddings for all images...")
-    for person_folder in tqdm(person_folders, desc="Processing persons"):
-        person_id = person_folder.name
+    for person_id, images in person_images:
         embeddings_db[person_id] = []
-        
-        images = [f for f in person_folder.iterdir() if f.suffix.lower() in ['.jpg', '.jpeg', '.png', '.bmp']]
-        
         for img_path in images:
-            embedding = get_embedding(img_path)
+            embedding = next(embeddings)
             if embedding is not None:
                 embeddings_db[person_id].append({
                     'path': str(img_path),
@@ -85,7 +161,19 @@ def test_dataset(dataset_path, num_test_pairs=100):
     
     print(f"\nSuccessfully processed {sum(len(v) for v in embeddings_db.values())} images")
     print(f"Failed to process {len(failed_images)} images")
+    if cache is not None:
+        cache.flush()
+        print(f"Embedding cache: {cache.hits} hits, {cache.misses} misses ({cache.model_version})")
+    
+    return embeddings_db, failed_images
+
+def evaluate_embeddings(dataset_name, embeddings_db, failed_images, num_test_pairs=100):
+    """
+    Sample positive/negative pairs from embedded images and evaluate thresholds
     
+    Returns:
+        (results dict, positive similarities, negative similarities)
+    """
     # Generate test pairs
     print(f"\nGenerating test pairs...")
     positive_pairs = []
@@ -123,16 +211,8 @@ def test_dataset(dataset_path, num_test_pairs=100):
     
     # Calculate similarities
     print("\nCalculating similarities...")
-    positive_similarities = []
-    negative_similarities = []
-    
-    for pair in tqdm(positive_pairs, desc="Positive pairs"):
-        sim = cosine_similarity(pair['img1']['embedding'], pair['img2']['embedding'])
-        positive_similarities.append(sim)
-    
-    for pair in tqdm(negative_pairs, desc="Negative pairs"):
-        sim = cosine_similarity(pair['img1']['embedding'], pair['img2']['embedding'])
-        negative_similarities.append(sim)
+    positive_similarities = pair_similarities(positive_pairs)
+    negative_similarities = pair_similarities(negative_pairs)
     
     # Calculate metrics for different thresholds
     thresholds = np.arange(0.3, 0.8, 0.05)
@@ -140,7 +220,7 @@ def test_dataset(dataset_path, num_test_pairs=100):
     best_accuracy = 0
     
     results = {
-        'dataset': dataset_path.name,
+        'dataset': dataset_name,
         'num_persons': len(person_ids),
         'num_images': sum(len(v) for v in embeddings_db.values()),
         'failed_images': len(failed_images),
@@ -158,44 +238,31 @@ def test_dataset(dataset_path, num_test_pairs=100):
             'min': float(np.min(negative_similarities)),
             'max': float(np.max(negative_similarities))
         },
-        'threshold_results': []
+        'threshold_results': [],
+        # Raw scores so any threshold can be evaluated exactly later
+        'raw_similarities': {
+            'positive': [float(sim) for sim in positive_similarities],
+            'negative': [float(sim) for sim in negative_similarities]
+        }
     }
     
     print("\nEvaluating at different thresholds...")
     for threshold in thresholds:
-        # True Positives: positive pairs with similarity >= threshold
-        tp = sum(1 for sim in positive_similarities if sim >= threshold)
-        # False Negatives: positive pairs with similarity < threshold
-        fn = len(positive_similarities) - tp
-        # True Negatives: negative pairs with similarity < threshold
-        tn = sum(1 for sim in negative_similarities if sim < threshold)
-        # False Positives: negative pairs with similarity >= threshold
-        fp = len(negative_similarities) - tn
-        
-        accuracy = (tp + tn) / (tp + tn + fp + fn) if (tp + tn + fp + fn) > 0 else 0
-        precision = tp / (tp + fp) if (tp + fp) > 0 else 0
-        recall = tp / (tp + fn) if (tp + fn) > 0 else 0
-        f1_score = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
-        
-        results['threshold_results'].append({
-            'threshold': float(threshold),
-            'accuracy': float(accuracy),
-            'precision': float(precision),
-            'recall': float(recall),
-            'f1_score': float(f1_score),
-            'tp': int(tp),
-            'tn': int(tn),
-            'fp': int(fp),
-            'fn': int(fn)
-        })
+        threshold_result = threshold_metrics(positive_similarities, negative_similarities, threshold)
+        results['threshold_results'].append(threshold_result)
         
-        if accuracy > best_accuracy:
-            best_accuracy = accuracy
+        if threshold_result['accuracy'] > best_accuracy:
+            best_accuracy = threshold_result['accuracy']
             best_threshold = threshold
     
     results['best_threshold'] = float(best_threshold)
     results['best_accuracy'] = float(best_accuracy)
     
+    if EXHAUSTIVE_EVALUATION and len(person_ids) >= 2:
+        # Every pair, exact EER / FRR@FAR / FAR@FRR (see evaluation.py)
+        print("\nScoring all pairs...")
+        results['exhaustive'], _ = evaluation.evaluate(embeddings_db)
+    
     return results, positive_similarities, negative_similarities
 
 def plot_results(results_list, positive_sims_list, negative_sims_list):
@@ -336,6 +403,15 @@ def print_summary(results_list):
         print(f"\n  Confusion Matrix:")
         print(f"    TP: {best_result['tp']:3d}  FP: {best_result['fp']:3d}")
         print(f"    FN: {best_result['fn']:3d}  TN: {best_result['tn']:3d}")
+        
+        if 'exhaustive' in results:
+            exhaustive = results['exhaustive']
+            print(f"\nAll Pairs ({exhaustive['genuine_pairs']:,} genuine, {exhaustive['impostor_pairs']:,} impostor):")
+            print(f"  EER: {exhaustive['eer']:.2%} at threshold {exhaustive['eer_threshold']:.4f}")
+            at = exhaustive['at_threshold']
+            print(f"  At {at['threshold']}: FAR {at['far']:.4%}, FRR {at['frr']:.4%}")
+            for point in exhaustive['frr_at_far']:
+                print(f"  FRR @ FAR {point['far']:g}: {point['frr']:.2%} (threshold {point['threshold']:.4f})")
 
 def main():
     # Set random seed for reproducibility
@@ -347,15 +423,23 @@ def main():
     all_results = []
     all_positive_sims = []
     all_negative_sims = []
+    cache = EmbeddingCache(EMBEDDING_CACHE_DIR, model_version()) if USE_EMBEDDING_CACHE else None
+    embedder = None
+    if EMBEDDING_WORKERS > 1:
+        embedder = ParallelEmbedder(workers=EMBEDDING_WORKERS, threads_per_worker=EMBEDDING_THREADS_PER_WORKER)
     
-    for dataset in datasets:
-        if os.path.exists(dataset):
-            results, pos_sims, neg_sims = test_dataset(dataset, num_test_pairs=100)
-            all_results.append(results)
-            all_positive_sims.append(pos_sims)
-            all_negative_sims.append(neg_sims)
-        else:
-            print(f"\nWarning: Dataset '{dataset}' not found!")
+    try:
+        for dataset in datasets:
+            if os.path.exists(dataset):
+                results, pos_sims, neg_sims = test_dataset(dataset, num_test_pairs=100, cache=cache, embedder=embedder)
+                all_results.append(results)
+                all_positive_sims.append(pos_sims)
+                all_negative_sims.append(neg_sims)
+            else:
+                print(f"\nWarning: Dataset '{dataset}' not found!")
+    finally:
+        if embedder is not None:
+            embedder.close()
     
     if all_results:
         # Print summary
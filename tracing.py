@@ -0,0 +1,84 @@
+"""
+Per-request trace ids and structured (JSON lines) logging.
+
+A trace lives in a context variable for the duration of one request, so
+stage timings recorded anywhere on the request thread (see metrics.span)
+are collected on it and emitted with the request's log line.
+"""
+import contextvars
+import json
+import logging
+import time
+import uuid
+
+_current_trace = contextvars.ContextVar('face_auth_trace', default=None)
+
+
+class Trace:
+    """Trace id plus accumulated per-stage durations of one request"""
+
+    def __init__(self, trace_id=None):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    def add_stage(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def stage_ms(self):
+        return {stage: round(seconds * 1000, 2) for stage, seconds in self.stages.items()}
+
+
+def begin_trace(trace_id=None):
+    trace = Trace(trace_id)
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def end_trace():
+    trace = _current_trace.get()
+    _current_trace.set(None)
+    return trace
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, tagged with the current trace id"""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': record.getMessage(),
+        }
+        trace = current_trace()
+        if trace is not None:
+            entry['trace_id'] = trace.trace_id
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def get_logger(name='face_auth'):
+    """Logger writing structured JSON lines to stderr (configured once)"""
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(JsonFormatter())
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+
+def log_event(logger, event, **fields):
+    """Log a structured event with extra key/value fields"""
+    logger.info(event, extra={'fields': fields})
@@ -0,0 +1,163 @@
+"""
+Short-lived caches for repeated verification frames.
+
+The login page often submits near-identical frames (retries, double
+clicks, live detection polling, the same person at the same kiosk). Two
+small TTL + size bounded LRU caches let those skip work:
+
+- FrameCache: a perceptual hash (dHash) of the decoded frame -> the face
+  detected in it, so a repeated frame skips detection and recognition.
+  Frames match when their hashes differ in at most `max_distance` bits,
+  which absorbs JPEG re-encoding noise. Two different people in front of
+  the same camera can hash that close too, so the reused face is only
+  good for previews (detect_face), never for verification.
+- DecisionCache: recent probe embeddings -> their gallery decision. A
+  probe at distance d = ||p - q|| from a cached probe q moves every cosine
+  score by at most d, so when the gallery scores every user exactly the
+  cached decision cannot change if the best score is more than d away
+  from the threshold and more than 2d ahead of the runner-up. Approximate
+  searches (an ANN index, the template shortlist of multi-template users)
+  can rank a nearby probe differently, so callers only use this cache
+  with an exact gallery. Reported similarities are those of the cached
+  probe, within d of the exact ones.
+
+Decisions depend on the gallery, so they are tagged with the gallery
+version they were computed against; any registration or template change
+bumps the version and the next lookup drops every stale decision.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+# Set bits of every byte value, for Hamming distances between packed hashes
+_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1)
+
+
+def dhash(img_bgr, size=16):
+    """Difference hash: signs of horizontal gradients of a size x size thumbnail, packed (size^2 bits)"""
+    gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY) if img_bgr.ndim == 3 else img_bgr
+    thumbnail = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA).astype(np.int16)
+    return np.packbits(thumbnail[:, 1:] > thumbnail[:, :-1])
+
+
+class _LRUCache:
+    """Insertion/use ordered entries with a TTL and a maximum count"""
+
+    def __init__(self, ttl=10.0, max_entries=256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._next_key = 0
+
+    def _evict(self, now):
+        # Least recently used first; expired entries are dropped wherever they are
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        for key in [key for key, entry in self._entries.items() if entry['expires'] <= now]:
+            del self._entries[key]
+
+    def _put(self, entry):
+        now = time.monotonic()
+        entry['expires'] = now + self.ttl
+        self._entries[self._next_key] = entry
+        self._next_key += 1
+        self._evict(now)
+
+    def _hit(self, key):
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FrameCache(_LRUCache):
+    """Perceptual hash of a decoded frame -> the face found in it"""
+
+    def __init__(self, ttl=10.0, max_entries=256, max_distance=4, hash_size=16):
+        super().__init__(ttl, max_entries)
+        self.max_distance = max_distance
+        self.hash_size = hash_size
+
+    def key(self, img_bgr):
+        return img_bgr.shape[:2], dhash(img_bgr, self.hash_size)
+
+    def get(self, key):
+        """The cached face of the closest matching frame, or None"""
+        shape, frame_hash = key
+        with self._lock:
+            self._evict(time.monotonic())
+            candidates = [k for k, entry in self._entries.items() if entry['shape'] == shape]
+            if not candidates:
+                return None
+            hashes = np.stack([self._entries[k]['hash'] for k in candidates])
+            distances = _POPCOUNT[hashes ^ frame_hash].sum(axis=1)
+            closest = int(np.argmin(distances))
+            if distances[closest] > self.max_distance:
+                return None
+            return self._hit(candidates[closest])['face']
+
+    def put(self, key, face):
+        shape, frame_hash = key
+        with self._lock:
+            self._put({'shape': shape, 'hash': frame_hash, 'face': face})
+
+
+class DecisionCache(_LRUCache):
+    """Probe embedding -> gallery decision, valid for one gallery version"""
+
+    def __init__(self, ttl=10.0, max_entries=256):
+        super().__init__(ttl, max_entries)
+        self._version = None
+
+    def _current(self, version):
+        """False for a gallery version older than the cached decisions'; a newer one drops them"""
+        if self._version is not None and version < self._version:
+            return False
+        if version != self._version:
+            self._entries.clear()
+            self._version = version
+        return True
+
+    def get(self, probe, threshold, version):
+        """A cached decision that an exact search of the probe would repeat, or None"""
+        probe = np.asarray(probe, dtype=np.float32).reshape(-1)
+        probe = probe / max(np.linalg.norm(probe), 1e-12)
+        with self._lock:
+            if not self._current(version):
+                return None
+            self._evict(time.monotonic())
+            candidates = [k for k, entry in self._entries.items() if entry['threshold'] == threshold]
+            if not candidates:
+                return None
+            similarities = np.stack([self._entries[k]['probe'] for k in candidates]) @ probe
+            # Only the nearest cached probe is tried: it has the tightest bound
+            nearest = int(np.argmax(similarities))
+            entry = self._entries[candidates[nearest]]
+            distance = float(np.sqrt(max(0.0, 2.0 - 2.0 * float(similarities[nearest]))))
+            if abs(entry['best'] - threshold) <= distance or entry['gap'] <= 2 * distance:
+                return None
+            return self._hit(candidates[nearest])['decision']
+
+    def put(self, probe, threshold, version, best, runner_up, decision):
+        """
+        Remember the decision for `probe` computed against gallery `version`
+        (read before the search); `best` and `runner_up` are its two highest
+        scores (runner_up None when there was no second candidate)
+        """
+        probe = np.asarray(probe, dtype=np.float32).reshape(-1)
+        probe = probe / max(np.linalg.norm(probe), 1e-12)
+        gap = best - runner_up if runner_up is not None else np.inf
+        with self._lock:
+            if not self._current(version):
+                return
+            self._put({'probe': probe, 'threshold': threshold, 'best': float(best), 'gap': float(gap),
+                       'decision': decision})
@@ -0,0 +1,98 @@
+"""
+Sampled, asynchronous diagnostic dumps of failed verifications.
+
+The full "every user's similarity, sorted" table used to be printed on each
+failed login. That is O(N log N) work plus N stdout writes on the request
+thread. Now a failed verification is only sampled for a dump, and the probe
+is handed to a background thread that scores, sorts and writes the table to
+a log file. Dumps are dropped rather than queued when the writer falls behind.
+"""
+import queue
+import random
+import threading
+import time
+
+import numpy as np
+
+
+class ScoreDumper:
+    """
+    Write full score tables for a sample of failed verifications.
+
+    Args:
+        score_fn: Called in the writer thread as score_fn(probe) -> (scores, usernames)
+        path: File the tables are appended to
+        sample_rate: Fraction of failed verifications to dump (0 disables)
+        max_rows: Rows written per table (0 for every user)
+        queue_size: Dumps waiting for the writer before new ones are dropped
+    """
+
+    def __init__(self, score_fn, path='verify_debug.log', sample_rate=0.0, max_rows=0, queue_size=32):
+        self.score_fn = score_fn
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_rows = max_rows
+        self.dumped = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        if sample_rate > 0:
+            self._thread = threading.Thread(target=self._writer, name='verify-debug', daemon=True)
+            self._thread.start()
+
+    def maybe_dump(self, probe, threshold, trace_id=None):
+        """Queue a dump for this failed verification if it is sampled; never blocks"""
+        if self._thread is None or random.random() >= self.sample_rate:
+            return False
+        try:
+            self._queue.put_nowait((np.array(probe, dtype=np.float32), threshold, trace_id, time.time()))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def _writer(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            try:
+                self._write_table(*job)
+                self.dumped += 1
+            except Exception as e:
+                print(f"💥 [VERIFY-DEBUG] Failed to write score dump: {e}")
+
+    def _write_table(self, probe, threshold, trace_id, timestamp):
+        scores, usernames = self.score_fn(probe)
+        order = np.argsort(-scores)
+        if self.max_rows:
+            order = order[:self.max_rows]
+
+        lines = [
+            "=" * 60,
+            f"Failed verification at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))}"
+            f" (trace {trace_id or '-'})",
+            f"Threshold: {threshold} | Users scored: {len(scores)}",
+        ]
+        for rank, i in enumerate(order, 1):
+            score = float(scores[i])
+            status = "✓ PASS" if score > threshold else "✗ FAIL"
+            lines.append(f"{rank:4d}. {usernames[i]:20s} | Similarity: {score:.4f} | {status}")
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+
+    def stats(self):
+        return {
+            'sample_rate': self.sample_rate,
+            'queued': self._queue.qsize(),
+            'dumped': self.dumped,
+            'dropped': self.dropped,
+        }
+
+    def shutdown(self, wait=True):
+        """Stop the writer after the queued dumps have been written"""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        if wait:
+            self._thread.join()
@@ -1,11 +1,10 @@
 import cv2
 import numpy as np
 import matplotlib.pyplot as plt
-from insightface.app import FaceAnalysis
+from face_models import load_face_analysis
 
 # Load ArcFace model
-app = FaceAnalysis(providers=['CPUExecutionProvider'])
-app.prepare(ctx_id=0, det_size=(640,640))
+app = load_face_analysis(det_size=(640,640), allowed_modules=['detection', 'recognition'])
 
 
 def get_embedding(image_path):